@@ -0,0 +1,173 @@
+"""
+Cache of the outputs of the frozen layers at the input of a model.
+
+model_selection_no_backend.py puts a frozen EfficientNet (hub.KerasLayer with
+trainable=False) in front of the dense head of each trial, so every epoch of
+every trial recomputes the same forward pass of the backbone over the same
+images. split_frozen_prefix() finds the leading non-trainable layers of a
+Sequential model and returns them as a prefix model, plus a head model that
+shares the remaining layers (and their weights) with the full model.
+get_activations() runs the prefix once per (backbone, image size, split)
+and keeps its outputs in memory and in a feature_store.py folder under
+ACTIVATION_CACHE_DIR, so later epochs, trials and runs only train the head.
+
+For partial fine-tuning of a functional model, such as ResNet152 with its
+first 483 layers frozen in single_model_train_test.py, split_frozen_layers()
+cuts the model with split_at_layer() after the last frozen layer
+(conv4_block36_out), whose output must be the only tensor used by the later
+layers. The activations at this
+boundary are larger than feature vectors, and can be stored as float16.
+
+The head is trained with the callbacks of the full model. Only the
+checkpoints need the full model: keep_full_model() wraps the ModelCheckpoint
+callbacks such that they save the full model, with the trained head weights.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from feature_store import has_split, read_split, write_split
+
+ACTIVATION_CACHE_DIR = "../../outputs/activation_cache/"
+
+_activations = {}  # (folder, split) -> (X, y), per process
+
+
+def get_num_frozen_layers(model):
+    """Number of leading layers of model that are not trainable."""
+    num_frozen_layers = 0
+    for layer in model.layers:
+        if layer.trainable:
+            break
+        num_frozen_layers += 1
+    return num_frozen_layers
+
+
+def split_frozen_prefix(model):
+    """
+    Return (prefix_model, head_model) for a Sequential model that starts
+    with frozen layers, or None if it does not. The head shares its layers
+    with model, so training the head trains model.
+    """
+    num_frozen_layers = get_num_frozen_layers(model)
+    if num_frozen_layers == 0 or num_frozen_layers == len(model.layers):
+        return None
+    prefix_model = tf.keras.Sequential(model.layers[:num_frozen_layers])
+    activation_shape = model.layers[num_frozen_layers - 1].output.shape[1:]
+    head_model = tf.keras.Sequential(
+        [tf.keras.Input(shape=activation_shape)] + model.layers[num_frozen_layers:]
+    )
+    return prefix_model, head_model
+
+
+def split_at_layer(model, layer_name):
+    """
+    Return (prefix_model, suffix_model) of a functional model cut after the
+    layer layer_name. The suffix shares its layers with model.
+    """
+    boundary = model.get_layer(layer_name).output
+    prefix_model = tf.keras.Model(model.input, boundary)
+    suffix_model = tf.keras.Model(boundary, model.output)
+    return prefix_model, suffix_model
+
+
+def split_frozen_layers(model):
+    """
+    Functional counterpart of split_frozen_prefix(): return (prefix_model,
+    suffix_model) cut after the leading frozen layers of model, or None if
+    there are none.
+    """
+    num_frozen_layers = get_num_frozen_layers(model)
+    if num_frozen_layers == 0 or num_frozen_layers == len(model.layers):
+        return None
+    return split_at_layer(model, model.layers[num_frozen_layers - 1].name)
+
+
+def get_cache_folder(
+    backbone_name, image_size, image_names, cache_dir=ACTIVATION_CACHE_DIR
+):
+    """Folder of the activations of one backbone, image size and set of images."""
+    key = json.dumps(
+        [backbone_name, list(image_size), [str(name) for name in image_names]]
+    )
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+
+def get_activations(
+    prefix_model,
+    backbone_name,
+    image_size,
+    split,
+    image_names,
+    labels,
+    get_dataset,
+    cache_dir=ACTIVATION_CACHE_DIR,
+    dtype=None,
+):
+    """
+    Return (X, y) with the outputs of prefix_model for the images of one
+    split, in the order of image_names. get_dataset() returns the unshuffled
+    batches of these images and is only called if they are not cached yet.
+    With dtype (e.g. np.float16), X is stored with this type.
+    """
+    folder = get_cache_folder(backbone_name, image_size, image_names, cache_dir)
+    if (folder, split) not in _activations:
+        if not has_split(folder, split):
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            print("Computing the activations of the frozen layers for", split, "...")
+            X = prefix_model.predict(get_dataset(), verbose=0)
+            if dtype is not None:
+                X = X.astype(dtype)
+            y = np.asarray(labels, dtype=np.float32)
+            write_split(folder, split, X, y, image_names, backbone_name, image_size[0])
+        _activations[(folder, split)] = read_split(folder, split)
+    return _activations[(folder, split)]
+
+
+class FullModelCallback(tf.keras.callbacks.Callback):
+    """Forward the calls of the head's fit() to a callback bound to full_model."""
+
+    def __init__(self, callback, full_model):
+        super().__init__()
+        self.callback = callback
+        self.full_model = full_model
+
+    def set_model(self, model):
+        super().set_model(model)
+        self.callback.set_model(self.full_model)
+
+    def set_params(self, params):
+        super().set_params(params)
+        self.callback.set_params(params)
+
+    def on_train_begin(self, logs=None):
+        self.callback.on_train_begin(logs)
+
+    def on_train_end(self, logs=None):
+        self.callback.on_train_end(logs)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.callback.on_epoch_begin(epoch, logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.callback.on_epoch_end(epoch, logs)
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.callback.on_train_batch_end(batch, logs)
+
+
+def keep_full_model(callbacks, full_model):
+    """Make the ModelCheckpoint callbacks save full_model instead of the head."""
+    return [
+        (
+            FullModelCallback(callback, full_model)
+            if isinstance(callback, tf.keras.callbacks.ModelCheckpoint)
+            else callback
+        )
+        for callback in callbacks
+    ]
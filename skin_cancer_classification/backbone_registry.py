@@ -0,0 +1,238 @@
+"""
+Offline registry of the pretrained backbones.
+
+The scripts used to hardcode the TF Hub URLs of EfficientNetV2 B1 and XL,
+and ResNet152 downloads its ImageNet weights at first use, so they could not
+start on a machine without network. Here each backbone has a name
+(MODEL_NAME in the scripts), and fetch() copies it once, on a machine with
+network, into BACKBONE_DIR:
+
+BACKBONE_DIR/registry.json                 index: name -> type, path, source
+BACKBONE_DIR/<name>/                       SavedModel of a TF Hub backbone
+BACKBONE_DIR/<name>/<name>.weights.h5      weights of a tf.keras.applications backbone
+
+load_backbone(name) reads only the local copy when the name is in the index,
+and fails for a name that is not, so the cold start never depends on a
+download (with the environment variable BACKBONE_OFFLINE=0, it falls back to
+the original source instead). It loads through backbones.py, so a second
+load in the same process reuses the loaded SavedModel or weights. The backbone "tiny_random" is a small randomly
+initialized, seeded CNN that needs no files, to run the scripts in tests.
+
+Copy the backbones with
+python backbone_registry.py --fetch efficientnet_v2_imagenet1k_b1 resnet152
+and measure the cold start (load and first call) and the warm load with
+python backbone_registry.py --measure efficientnet_v2_imagenet1k_b1
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_hub as hub
+
+from backbones import application, clear, hub_layer, record_load_time
+
+BACKBONE_DIR = "../../backbones/"
+INDEX_FILE_NAME = "registry.json"
+# set BACKBONE_OFFLINE=0 to download the backbones that are not in the registry
+OFFLINE = os.environ.get("BACKBONE_OFFLINE", "1") != "0"
+
+# name -> how to get the backbone and its default input size
+KNOWN_BACKBONES = {
+    "efficientnet_v2_imagenet1k_b1": {  # 7 M parameters
+        "type": "hub",
+        "source": "https://tfhub.dev/google/imagenet/efficientnet_v2_imagenet1k_b1/feature_vector/2",
+        "num_pixels": 240,
+    },
+    "efficientnet_v2_imagenet21k_ft1k_xl": {  # 200 M parameters
+        "type": "hub",
+        "source": "https://tfhub.dev/google/imagenet/efficientnet_v2_imagenet21k_ft1k_xl/feature_vector/2",
+        "num_pixels": 512,
+    },
+    "resnet152": {
+        "type": "application",
+        "source": "ResNet152",
+        "num_pixels": 224,
+    },
+    "tiny_random": {
+        "type": "random",
+        "source": None,
+        "num_pixels": 64,
+    },
+}
+
+APPLICATIONS = {"ResNet152": tf.keras.applications.ResNet152}
+
+
+def read_index(backbone_dir=BACKBONE_DIR):
+    index_file = os.path.join(backbone_dir, INDEX_FILE_NAME)
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file, "r") as f:
+        return json.load(f)
+
+
+def write_index(index, backbone_dir=BACKBONE_DIR):
+    index_file = os.path.join(backbone_dir, INDEX_FILE_NAME)
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, index_file)
+
+
+def resolve(name, backbone_dir=BACKBONE_DIR):
+    """
+    Return the description of backbone name, with "path" set to its local
+    copy if it is in the registry, or to None otherwise.
+    """
+    if name not in KNOWN_BACKBONES:
+        raise KeyError(
+            "Unknown backbone " + name + ", use one of " + str(sorted(KNOWN_BACKBONES))
+        )
+    entry = dict(KNOWN_BACKBONES[name], name=name, path=None)
+    index = read_index(backbone_dir)
+    if name in index:
+        entry["path"] = os.path.join(backbone_dir, index[name]["path"])
+    return entry
+
+
+def fetch(name, backbone_dir=BACKBONE_DIR):
+    """Copy backbone name into backbone_dir and add it to the index."""
+    entry = resolve(name, backbone_dir)
+    if entry["type"] == "random":
+        print("Backbone", name, "does not need files")
+        return
+    if not os.path.exists(backbone_dir):
+        os.makedirs(backbone_dir)
+    folder = os.path.join(backbone_dir, name)
+    tmp_folder = folder + ".tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    if entry["type"] == "hub":
+        # hub.resolve() downloads the SavedModel (into TFHUB_CACHE_DIR) and returns its folder
+        shutil.copytree(hub.resolve(entry["source"]), tmp_folder)
+        path = name
+    else:
+        os.makedirs(tmp_folder)
+        model = APPLICATIONS[entry["source"]](weights="imagenet", include_top=False)
+        model.save_weights(os.path.join(tmp_folder, name + ".weights.h5"))
+        path = os.path.join(name, name + ".weights.h5")
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp_folder, folder)
+    index = read_index(backbone_dir)
+    index[name] = {
+        "type": entry["type"],
+        "path": path,
+        "source": entry["source"],
+        "fetched": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    write_index(index, backbone_dir)
+    print("Fetched", name, "into", folder)
+
+
+def get_tiny_random_backbone(input_shape=None, num_features=16, seed=0):
+    """Small seeded CNN with the interface of a feature vector backbone."""
+    initializer = tf.keras.initializers.GlorotUniform(seed=seed)
+    return tf.keras.Sequential(
+        [
+            tf.keras.Input(shape=input_shape or (None, None, 3)),
+            tf.keras.layers.Conv2D(
+                8, 3, strides=4, activation="relu", kernel_initializer=initializer
+            ),
+            tf.keras.layers.GlobalAveragePooling2D(),
+            tf.keras.layers.Dense(num_features, kernel_initializer=initializer),
+        ],
+        name="tiny_random",
+    )
+
+
+def load_backbone(name, input_shape=None, trainable=False, backbone_dir=BACKBONE_DIR):
+    """
+    Return backbone name as a Keras layer (a hub.KerasLayer or a Model)
+    that maps images to a feature vector, from its local copy if it is in
+    the registry.
+    """
+    entry = resolve(name, backbone_dir)
+    if entry["type"] == "random":
+        start_time = time.time()
+        backbone = get_tiny_random_backbone(input_shape)
+        backbone.trainable = trainable
+        record_load_time(name, start_time, cached=False)
+        return backbone
+    if entry["path"] is None:
+        if OFFLINE:
+            raise FileNotFoundError(
+                "Backbone "
+                + name
+                + " is not in "
+                + backbone_dir
+                + ", run python backbone_registry.py --fetch "
+                + name
+                + " on a machine with network (or set BACKBONE_OFFLINE=0 to"
+                + " download it now)"
+            )
+        print("Backbone", name, "is not in the registry, using", entry["source"])
+    if entry["type"] == "hub":
+        handle = entry["path"] or entry["source"]
+        if input_shape is None:
+            return hub_layer(handle, trainable=trainable)
+        return hub_layer(handle, trainable=trainable, input_shape=input_shape)
+    weights = entry["path"] or "imagenet"
+    backbone = application(
+        APPLICATIONS[entry["source"]],
+        weights=weights,
+        include_top=False,
+        input_shape=input_shape,
+    )
+    backbone.trainable = trainable
+    return backbone
+
+
+def measure_cold_start(name, num_pixels=None, batch_size=1, backbone_dir=BACKBONE_DIR):
+    """
+    Latencies in seconds of the first load and first call of backbone name
+    in a process (cold), and of a second load and call (warm).
+    """
+    num_pixels = num_pixels or KNOWN_BACKBONES[name]["num_pixels"]
+    input_shape = (num_pixels, num_pixels, 3)
+    images = np.zeros((batch_size,) + input_shape, dtype=np.float32)
+    clear()
+    latencies = {}
+    for start in ("cold", "warm"):
+        start_time = time.time()
+        backbone = load_backbone(name, input_shape, backbone_dir=backbone_dir)
+        latencies[start + "_load"] = time.time() - start_time
+        start_time = time.time()
+        backbone(images)
+        latencies[start + "_first_call"] = time.time() - start_time
+    return latencies
+
+
+if __name__ == "__main__":
+    print("=====================================")
+    print("Registry of pretrained backbones")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--fetch", nargs="*", default=[], help="Names of the backbones to copy"
+    )
+    parser.add_argument(
+        "--measure", nargs="*", default=[], help="Names of the backbones to time"
+    )
+    parser.add_argument(
+        "--backbone_dir", type=str, default=BACKBONE_DIR, help="Registry folder"
+    )
+    args = parser.parse_args()
+
+    for name in args.fetch:
+        fetch(name, args.backbone_dir)
+    for name in args.measure:
+        latencies = measure_cold_start(name, backbone_dir=args.backbone_dir)
+        for key, seconds in latencies.items():
+            print(name, key, round(seconds, 3), "s")
+    index = read_index(args.backbone_dir)
+    for name in sorted(KNOWN_BACKBONES):
+        print(name, "->", index[name]["path"] if name in index else "not fetched")
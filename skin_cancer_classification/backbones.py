@@ -0,0 +1,95 @@
+"""
+Per-process cache of the pretrained backbones.
+
+Each trial of model_selection_no_backend.py creates a new
+hub.KerasLayer(model_url), and get_training_model_resnet() of
+single_model_train_test.py calls ResNet152(weights="imagenet"). After
+clear_session(), both parse the SavedModel (or the .h5 file) and read
+hundreds of MB of weights again. Here the first call of each process loads
+them, and later calls reuse them:
+
+hub_layer()    keeps the object of hub.load(url) and wraps it in a new
+               hub.KerasLayer. A trainable layer first gets the initial
+               values of the variables back, since the object is shared.
+application()  keeps the weights of a tf.keras.applications model (e.g.
+               ResNet152) as arrays, builds the architecture with
+               weights=None and copies the arrays into it.
+
+Every call appends its latency to load_times, e.g.
+{"name": "ResNet152", "seconds": 0.8, "cached": True}, and the Optuna scripts
+add the last one to the history of the trial as "backbone_load_time".
+"""
+
+import json
+import time
+
+import tensorflow as tf
+import tensorflow_hub as hub
+
+_hub_objects = {}  # handle -> (object of hub.load(), initial variable values)
+_application_weights = {}  # (application name, arguments) -> list of arrays
+load_times = []  # one dictionary per call, in the order of the calls
+
+
+def record_load_time(name, start_time, cached):
+    seconds = time.time() - start_time
+    load_times.append({"name": name, "seconds": seconds, "cached": cached})
+    print("Loaded", name, "in", round(seconds, 3), "s", "(cached)" if cached else "")
+    return seconds
+
+
+def get_last_load_time():
+    """Latency in seconds of the last backbone load, or None."""
+    if len(load_times) == 0:
+        return None
+    return load_times[-1]["seconds"]
+
+
+def hub_layer(handle, trainable=False, **kwargs):
+    """
+    Same as hub.KerasLayer(handle, trainable=trainable, **kwargs), but the
+    SavedModel of handle (a URL or a local folder) is loaded only once per
+    process. Two trainable layers of the same handle share their variables,
+    so only one of them should be used at a time.
+    """
+    start_time = time.time()
+    cached = handle in _hub_objects
+    if not cached:
+        hub_object = hub.load(handle)
+        initial_values = [variable.numpy() for variable in hub_object.variables]
+        _hub_objects[handle] = (hub_object, initial_values)
+    hub_object, initial_values = _hub_objects[handle]
+    if cached and trainable:
+        # undo the fine-tuning of an earlier trial
+        for variable, value in zip(hub_object.variables, initial_values):
+            variable.assign(value)
+    layer = hub.KerasLayer(hub_object, trainable=trainable, **kwargs)
+    record_load_time(handle, start_time, cached)
+    return layer
+
+
+def application(constructor, weights="imagenet", **kwargs):
+    """
+    Same as constructor(weights=weights, **kwargs) for a model of
+    tf.keras.applications, e.g. application(ResNet152, include_top=False),
+    but the weights are read from disk only once per process. Each call
+    returns a new model with its own variables.
+    """
+    start_time = time.time()
+    name = constructor.__name__
+    key = (name, weights, json.dumps(kwargs, sort_keys=True, default=str))
+    cached = key in _application_weights
+    if cached:
+        model = constructor(weights=None, **kwargs)
+        model.set_weights(_application_weights[key])
+    else:
+        model = constructor(weights=weights, **kwargs)
+        _application_weights[key] = model.get_weights()
+    record_load_time(name, start_time, cached)
+    return model
+
+
+def clear():
+    """Forget the loaded backbones, e.g. to measure a cold start."""
+    _hub_objects.clear()
+    _application_weights.clear()
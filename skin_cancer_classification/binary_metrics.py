@@ -0,0 +1,159 @@
+"""
+Vectorized metrics of a binary classifier from its scores.
+
+single_model_train_test.py thresholded the scores in a Python loop and then
+called roc_curve, auc, recall_score, f1_score, precision_score,
+precision_recall_curve and confusion_matrix of scikit-learn, each of them
+sorting or scanning the arrays again. BinaryMetrics sorts the scores once and
+keeps, for each distinct score (in decreasing order), the cumulative numbers
+of true and false positives when it is used as threshold (predicted positive
+if score >= threshold). All the metrics are derived from these two arrays:
+
+roc_curve(), roc_auc()            same values as sklearn roc_curve and auc
+pr_curve(), average_precision()   same as sklearn precision_recall_curve (recent
+                                  versions, which no longer stop at full recall)
+confusion_matrix(threshold)       [[tn, fp], [fn, tp]], positive if score > threshold
+scores_at(threshold)              recall, precision and F1 at threshold
+best_f1(), youden()               thresholds maximizing F1 and TPR - FPR
+
+StreamingBinaryMetrics accumulates the counts of batches of scores in [0, 1]
+in num_bins histogram bins, so a large test set never needs all its scores in
+memory. Its result() is a BinaryMetrics whose thresholds are the lower bin
+edges, exact up to the bin width.
+"""
+
+import numpy as np
+
+
+class BinaryMetrics:
+    """
+    thresholds: distinct scores in decreasing order, tps and fps: numbers of
+    positives and negatives with score >= thresholds[i].
+    """
+
+    def __init__(self, thresholds, tps, fps):
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.tps = np.asarray(tps, dtype=np.int64)
+        self.fps = np.asarray(fps, dtype=np.int64)
+        self.num_positives = int(self.tps[-1]) if len(self.tps) > 0 else 0
+        self.num_negatives = int(self.fps[-1]) if len(self.fps) > 0 else 0
+
+    @classmethod
+    def from_scores(cls, labels, scores):
+        labels = np.asarray(labels).ravel() > 0.5
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        if len(scores) == 0:
+            return cls([], [], [])
+        order = np.argsort(-scores, kind="mergesort")
+        scores = scores[order]
+        labels = labels[order]
+        # last position of each distinct score
+        distinct = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1]
+        tps = np.cumsum(labels)[distinct]
+        fps = distinct + 1 - tps
+        return cls(scores[distinct], tps, fps)
+
+    def get_rates(self):
+        tpr = self.tps / max(self.num_positives, 1)
+        fpr = self.fps / max(self.num_negatives, 1)
+        return fpr, tpr
+
+    def roc_curve(self, drop_intermediate=True):
+        """
+        (fpr, tpr, thresholds), starting at (0, 0) with threshold inf. As
+        sklearn roc_curve, drop_intermediate drops the collinear points,
+        which do not change the curve.
+        """
+        fpr, tpr = self.get_rates()
+        thresholds = self.thresholds
+        if drop_intermediate and len(thresholds) > 2:
+            corners = np.flatnonzero(
+                np.r_[True, np.diff(self.fps, 2) | np.diff(self.tps, 2), True]
+            )
+            fpr, tpr, thresholds = fpr[corners], tpr[corners], thresholds[corners]
+        return np.r_[0.0, fpr], np.r_[0.0, tpr], np.r_[np.inf, thresholds]
+
+    def roc_auc(self):
+        fpr, tpr, _ = self.roc_curve()
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def pr_curve(self):
+        """
+        (precision, recall, thresholds) in the order of sklearn
+        precision_recall_curve (recent scikit-learn): increasing thresholds
+        over all the distinct scores, ending at recall 0 and precision 1.
+        """
+        precision = self.tps / np.maximum(self.tps + self.fps, 1)
+        recall = self.tps / max(self.num_positives, 1)
+        return (
+            np.r_[precision[::-1], 1.0],
+            np.r_[recall[::-1], 0.0],
+            self.thresholds[::-1],
+        )
+
+    def average_precision(self):
+        precision, recall, _ = self.pr_curve()
+        return float(-np.sum(np.diff(recall) * precision[:-1]))
+
+    def get_counts(self, threshold=0.5):
+        """(tp, fp, fn, tn) when the examples with score > threshold are positive."""
+        num_above = np.searchsorted(-self.thresholds, -threshold, side="left")
+        tp = int(self.tps[num_above - 1]) if num_above > 0 else 0
+        fp = int(self.fps[num_above - 1]) if num_above > 0 else 0
+        return tp, fp, self.num_positives - tp, self.num_negatives - fp
+
+    def confusion_matrix(self, threshold=0.5):
+        tp, fp, fn, tn = self.get_counts(threshold)
+        return np.array([[tn, fp], [fn, tp]])
+
+    def scores_at(self, threshold=0.5):
+        """(recall, precision, f1) when the examples with score > threshold are positive."""
+        tp, fp, fn, _ = self.get_counts(threshold)
+        recall = tp / max(tp + fn, 1)
+        precision = tp / max(tp + fp, 1)
+        f1 = 2 * tp / max(2 * tp + fp + fn, 1)
+        return recall, precision, f1
+
+    def best_f1(self):
+        """(threshold, f1) with the largest F1 (positive if score >= threshold)."""
+        if len(self.thresholds) == 0:
+            return float("nan"), 0.0
+        f1 = 2 * self.tps / np.maximum(self.tps + self.fps + self.num_positives, 1)
+        best = int(np.argmax(f1))
+        return float(self.thresholds[best]), float(f1[best])
+
+    def youden(self):
+        """(threshold, tpr - fpr) with the largest Youden index."""
+        if len(self.thresholds) == 0:
+            return float("nan"), 0.0
+        fpr, tpr = self.get_rates()
+        best = int(np.argmax(tpr - fpr))
+        return float(self.thresholds[best]), float(tpr[best] - fpr[best])
+
+
+class StreamingBinaryMetrics:
+    """Accumulate batches of scores in [0, 1] and return a BinaryMetrics."""
+
+    def __init__(self, num_bins=10000):
+        self.num_bins = num_bins
+        self.positive_counts = np.zeros(num_bins, dtype=np.int64)
+        self.negative_counts = np.zeros(num_bins, dtype=np.int64)
+
+    def update(self, labels, scores):
+        labels = np.asarray(labels).ravel() > 0.5
+        scores = np.clip(np.asarray(scores, dtype=np.float64).ravel(), 0.0, 1.0)
+        bins = np.minimum((scores * self.num_bins).astype(np.int64), self.num_bins - 1)
+        self.positive_counts += np.bincount(bins[labels], minlength=self.num_bins)
+        self.negative_counts += np.bincount(bins[~labels], minlength=self.num_bins)
+
+    def result(self):
+        used = np.flatnonzero(self.positive_counts + self.negative_counts)[::-1]
+        thresholds = used / self.num_bins
+        tps = np.cumsum(self.positive_counts[used])
+        fps = np.cumsum(self.negative_counts[used])
+        return BinaryMetrics(thresholds, tps, fps)
+
+
+def roc_auc(labels, scores):
+    """Area under the ROC curve, as sklearn roc_auc_score."""
+    return BinaryMetrics.from_scores(labels, scores).roc_auc()
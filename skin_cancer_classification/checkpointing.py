@@ -0,0 +1,124 @@
+"""
+Deferred checkpointing of the models of an Optuna study.
+
+ModelCheckpoint(save_best_only=True) writes a full SavedModel directory
+(optuna_best_model_<n>) each time the monitored metric improves, for every
+trial, and most of these trials are later discarded. Instead,
+InMemoryCheckpoint keeps a copy of the best weights in memory during the
+trial, and the model is written to disk only if the trial enters the current
+top-k of the study (is_in_top_k). collect_garbage() deletes the directories
+of the finished trials that are no longer in the top-k, e.g. after each
+trial with study.optimize(..., callbacks=[GarbageCollectionCallback(...)]).
+"""
+
+import os
+import shutil
+
+import numpy as np
+import optuna
+import tensorflow as tf
+
+MODEL_PREFIX = "optuna_best_model_"  # followed by the trial number
+
+
+class InMemoryCheckpoint(tf.keras.callbacks.Callback):
+    """
+    Same choice of weights as ModelCheckpoint(save_best_only=True), but the
+    best weights are kept in memory until save() is called.
+    """
+
+    def __init__(self, monitor="val_accuracy", mode="max"):
+        super().__init__()
+        self.monitor = monitor
+        self.monitor_op = np.greater if mode == "max" else np.less
+        self.best = -np.inf if mode == "max" else np.inf
+        self.best_weights = None
+        self.best_epoch = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        current = (logs or {}).get(self.monitor)
+        if current is None:
+            return
+        if self.monitor_op(current, self.best):
+            self.best = current
+            self.best_epoch = epoch
+            self.best_weights = self.model.get_weights()
+
+    def save(self, model, file_name):
+        """Save model with the best weights, keeping its current weights."""
+        current_weights = model.get_weights()
+        if self.best_weights is not None:
+            model.set_weights(self.best_weights)
+        model.save(file_name)
+        model.set_weights(current_weights)
+
+
+def get_trained_trials(study):
+    """
+    Complete trials that trained a model. The trials memoized by
+    trial_cache.py (user attribute "memoized_from") only repeat the value of
+    earlier trials and have no model directory, so they do not take a place
+    in the top-k.
+    """
+    return [
+        trial
+        for trial in study.get_trials(
+            deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)
+        )
+        if "memoized_from" not in trial.user_attrs
+    ]
+
+
+def get_top_k_trials(study, k):
+    """Numbers of the k best trained trials of a single-objective study."""
+    trials = get_trained_trials(study)
+    maximize = study.direction == optuna.study.StudyDirection.MAXIMIZE
+    trials = sorted(trials, key=lambda trial: trial.value, reverse=maximize)
+    return set(trial.number for trial in trials[:k])
+
+
+def is_in_top_k(study, value, k):
+    """Whether a trial with this value would enter the top-k of the study."""
+    values = [trial.value for trial in get_trained_trials(study)]
+    if study.direction == optuna.study.StudyDirection.MAXIMIZE:
+        num_better = sum(other > value for other in values)
+    else:
+        num_better = sum(other < value for other in values)
+    return num_better < k
+
+
+def collect_garbage(study, output_dir, k, verbose=1):
+    """
+    Delete the model directories of the finished trials that are not in the
+    top-k of the study. The directories of running trials are kept.
+    Returns the numbers of the deleted trials.
+    """
+    top_k_trials = get_top_k_trials(study, k)
+    states = {trial.number: trial.state for trial in study.get_trials(deepcopy=False)}
+    deleted = []
+    for name in sorted(os.listdir(output_dir)):
+        number = name[len(MODEL_PREFIX) :]
+        if not name.startswith(MODEL_PREFIX) or not number.isdigit():
+            continue
+        number = int(number)
+        if number in top_k_trials or number not in states:
+            continue
+        if not states[number].is_finished():
+            continue
+        shutil.rmtree(os.path.join(output_dir, name))
+        deleted.append(number)
+    if verbose and len(deleted) > 0:
+        print("Deleted the models of trials", deleted, "(not in the top", k, "trials)")
+    return deleted
+
+
+class GarbageCollectionCallback:
+    """Callback of study.optimize() that calls collect_garbage() after each trial."""
+
+    def __init__(self, output_dir, k, verbose=1):
+        self.output_dir = output_dir
+        self.k = k
+        self.verbose = verbose
+
+    def __call__(self, study, trial):
+        collect_garbage(study, self.output_dir, self.k, self.verbose)
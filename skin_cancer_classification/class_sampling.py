@@ -0,0 +1,87 @@
+"""
+Seeded class subsampling on integer index arrays.
+
+The scripts used to subsample the negative (and positive) examples with
+df.sample(frac=1) without a seed, filtering, copying and concatenating the
+DataFrame and shuffling it again, on every trial. subsample_indices() works
+on the label array only and returns the integer positions of the chosen rows,
+so that building a subset is cheap and the same seed always gives the same
+subset. The caches then see the same image names for the same subset:
+activation_cache.get_cache_folder() keys the activations of a subset by the
+hash of its image names, and image_cache.py keys each image by its name.
+
+take() builds the DataFrame of a subset with DataFrame.take(), which copies
+the chosen rows (pandas has no view for arbitrary row positions). The copy
+is made once per subset, from the position array, instead of the shuffles,
+filters and concatenations of the old functions.
+
+For a fixed seed, the rows chosen for n examples of a class are the first n
+rows of a per-class permutation, so smaller subsets are contained in larger
+ones. The DataFrame helpers keep the names of the old functions.
+"""
+
+import numpy as np
+
+SEED = 42
+
+
+def subsample_indices(labels, num_examples_per_class, seed=SEED, shuffle=True):
+    """
+    Positions of a subset with num_examples_per_class[label] examples of each
+    label (None keeps all examples of the label, and labels that are not in
+    the dictionary are dropped). The positions are shuffled, or sorted if
+    shuffle is False.
+    """
+    labels = np.asarray(labels)
+    rng = np.random.default_rng(seed)
+    indices = []
+    for label in sorted(num_examples_per_class):
+        class_indices = rng.permutation(np.flatnonzero(labels == label))
+        num_examples = num_examples_per_class[label]
+        if num_examples is not None:
+            class_indices = class_indices[: int(round(num_examples))]
+        indices.append(class_indices)
+    indices = np.concatenate(indices)
+    if shuffle:
+        return rng.permutation(indices)
+    return np.sort(indices)
+
+
+def take(df, indices):
+    """Copy of the rows of df at the given positions, with a new 0-based index."""
+    return df.take(indices).reset_index(drop=True)
+
+
+def decrease_num_negatives(df, desired_num_negative_examples, seed=SEED):
+    """
+    Keep desired_num_negative_examples negatives (target '0') and all
+    positives (target '1') of df, shuffled.
+    """
+    indices = subsample_indices(
+        df["target"].to_numpy(), {"0": desired_num_negative_examples, "1": None}, seed
+    )
+    return take(df, indices)
+
+
+def get_balanced_dataframe(
+    df, desired_num_negative_examples, desired_num_positive_examples, seed=SEED
+):
+    """Keep the given numbers of negatives and positives of df, shuffled."""
+    indices = subsample_indices(
+        df["target"].to_numpy(),
+        {"0": desired_num_negative_examples, "1": desired_num_positive_examples},
+        seed,
+    )
+    return take(df, indices)
+
+
+def decrease_num_negatives_and_positives(
+    df, desired_num_negative_examples, num_examples, seed=SEED
+):
+    """Keep num_examples rows of df, desired_num_negative_examples of them negatives."""
+    return get_balanced_dataframe(
+        df,
+        desired_num_negative_examples,
+        num_examples - desired_num_negative_examples,
+        seed,
+    )
@@ -0,0 +1,167 @@
+"""
+XLA-compiled training loop for the dense heads trained on backend outputs.
+
+With batch sizes between 1 and 15, an epoch over the ~5.6k feature vectors
+has hundreds of tiny steps, and model.fit() spends more time in Python
+(dispatching each step and calling the callbacks) than in the matrix
+products. fit_compiled() is an alternative to model.fit() for these models:
+each call to a tf.function(jit_compile=True) runs steps_per_execution
+micro-batches in a loop compiled by XLA, and the Keras callbacks are called
+once per epoch, with the same logs ("loss", "accuracy", "auc", "val_loss",
+"val_accuracy", "val_auc") that model.fit() gives them. EarlyStopping,
+ModelCheckpoint, ReduceLROnPlateau and TFKerasPruningCallback only act at the
+end of the epochs, so they behave as with model.fit().
+
+As with model.fit(x, y, steps_per_epoch=num_train // batch_size), each epoch
+shuffles the training set and uses only full batches.
+"""
+
+import weakref
+
+import numpy as np
+import tensorflow as tf
+
+STEPS_PER_EXECUTION = 32  # micro-batches per call of the compiled function
+
+# compiled functions of each model, such that several calls of fit_compiled()
+# (e.g., one per epoch in fidelity.fit_with_fidelity) do not compile again
+compiled_functions = weakref.WeakKeyDictionary()
+
+
+def get_compiled_functions(model):
+    if model in compiled_functions:
+        return compiled_functions[model]
+    loss_function = tf.keras.losses.BinaryCrossentropy()
+
+    def compute_loss(y, y_pred, sample_weight=None):
+        loss = loss_function(y, y_pred, sample_weight=sample_weight)
+        if model.losses:  # regularization
+            loss += tf.add_n(model.losses)
+        return loss
+
+    @tf.function(jit_compile=True)
+    def train_steps(x_batches, y_batches, w_batches, num_steps):
+        """
+        Run one optimizer step for each of the first num_steps micro-batches,
+        given as (steps_per_execution, batch_size, ...). The last call of an
+        epoch is padded, so that the function is compiled only once.
+        """
+        losses = tf.TensorArray(tf.float32, size=x_batches.shape[0])
+        predictions = tf.TensorArray(tf.float32, size=x_batches.shape[0])
+        for step in tf.range(num_steps):
+            with tf.GradientTape() as tape:
+                y_pred = tf.reshape(model(x_batches[step], training=True), [-1])
+                loss = compute_loss(y_batches[step], y_pred, w_batches[step])
+            gradients = tape.gradient(loss, model.trainable_variables)
+            model.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            losses = losses.write(step, loss)
+            predictions = predictions.write(step, y_pred)
+        return losses.stack(), predictions.stack()
+
+    @tf.function(jit_compile=True)
+    def test_step(x, y):
+        y_pred = tf.reshape(model(x, training=False), [-1])
+        return compute_loss(y, y_pred), y_pred
+
+    compiled_functions[model] = (train_steps, test_step)
+    return compiled_functions[model]
+
+
+def get_metrics(y, y_pred, prefix=""):
+    """Accuracy and AUC computed as the Keras metrics of model.compile()."""
+    auc = tf.keras.metrics.AUC()
+    auc.update_state(y, y_pred)
+    return {
+        prefix + "accuracy": float(np.mean((y_pred > 0.5) == (y > 0.5))),
+        prefix + "auc": float(auc.result()),
+    }
+
+
+def fit_compiled(
+    model,
+    x,
+    y,
+    batch_size,
+    epochs=1,
+    validation_data=None,
+    class_weight=None,
+    callbacks=None,
+    verbose=1,
+    initial_epoch=0,
+    steps_per_epoch=None,
+    steps_per_execution=STEPS_PER_EXECUTION,
+):
+    """
+    Train a compiled binary classifier as model.fit() does, with the given
+    subset of its arguments, and return the History object.
+    """
+    train_steps, test_step = get_compiled_functions(model)
+    if hasattr(model.optimizer, "build"):
+        # create the slots of Adam outside of the compiled function
+        model.optimizer.build(model.trainable_variables)
+
+    x = np.asarray(x, dtype=np.float32)
+    y = np.asarray(y, dtype=np.float32).reshape(-1)
+    sample_weight = np.ones_like(y)
+    if class_weight is not None:
+        sample_weight = np.where(y == 1, class_weight[1], class_weight[0]).astype(
+            np.float32
+        )
+    if steps_per_epoch is None:
+        steps_per_epoch = len(y) // batch_size
+    steps_per_execution = min(steps_per_execution, steps_per_epoch)
+    if validation_data is not None:
+        x_val = tf.constant(validation_data[0], dtype=tf.float32)
+        y_val = np.asarray(validation_data[1], dtype=np.float32).reshape(-1)
+
+    callback_list = tf.keras.callbacks.CallbackList(
+        callbacks,
+        add_history=True,
+        add_progbar=verbose != 0,
+        model=model,
+        verbose=verbose,
+        epochs=epochs,
+        steps=steps_per_epoch,
+    )
+    model.stop_training = False
+    callback_list.on_train_begin()
+    for epoch in range(initial_epoch, epochs):
+        callback_list.on_epoch_begin(epoch)
+        # shuffle, keep full batches and pad to a multiple of steps_per_execution
+        permutation = np.random.permutation(len(y))[: steps_per_epoch * batch_size]
+        padding = -steps_per_epoch % steps_per_execution
+        permutation = np.concatenate([permutation, permutation[: padding * batch_size]])
+        x_epoch = x[permutation].reshape((-1, batch_size) + x.shape[1:])
+        y_epoch = y[permutation].reshape((-1, batch_size))
+        w_epoch = sample_weight[permutation].reshape((-1, batch_size))
+        losses, predictions = [], []
+        for start in range(0, steps_per_epoch, steps_per_execution):
+            stop = min(start + steps_per_execution, steps_per_epoch)
+            callback_list.on_train_batch_begin(start)
+            step_losses, step_predictions = train_steps(
+                x_epoch[start : start + steps_per_execution],
+                y_epoch[start : start + steps_per_execution],
+                w_epoch[start : start + steps_per_execution],
+                tf.constant(stop - start),
+            )
+            losses.append(step_losses.numpy()[: stop - start])
+            predictions.append(step_predictions.numpy()[: stop - start])
+            callback_list.on_train_batch_end(
+                stop - 1, {"loss": float(np.mean(np.concatenate(losses)))}
+            )
+        logs = {"loss": float(np.mean(np.concatenate(losses)))}
+        logs.update(
+            get_metrics(
+                y_epoch[:steps_per_epoch].reshape(-1),
+                np.concatenate(predictions).reshape(-1),
+            )
+        )
+        if validation_data is not None:
+            val_loss, val_predictions = test_step(x_val, y_val)
+            logs["val_loss"] = float(val_loss)
+            logs.update(get_metrics(y_val, val_predictions.numpy(), prefix="val_"))
+        callback_list.on_epoch_end(epoch, logs)
+        if model.stop_training:
+            break
+    callback_list.on_train_end()
+    return model.history
@@ -0,0 +1,188 @@
+"""
+tf.data input pipeline that replaces ImageDataGenerator.flow_from_dataframe.
+
+The generators iterate from Python in a single thread, so Keras waits for the
+input stage while only one core is busy. Here the JPEG files are decoded and
+resized in parallel (num_parallel_calls), rescaled inside the graph and
+prefetched. Optionally, the decoded uint8 images are kept with cache() after
+the first epoch, or read from the memory-mapped shards of image_cache.py.
+
+The returned datasets carry the attributes samples, n and classes, as the
+DataFrameIterator does, such that the scripts can keep using
+train_generator.samples and test_generator.classes. make_example_dataset()
+does not depend on the batch size, and batch_dataset() adds the batching
+layer, such that a search can prepare the examples only once.
+"""
+
+import tensorflow as tf
+
+from image_cache import IMAGE_CACHE_DIR, open_image_cache
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def decode_and_resize(file_name, image_size):
+    return decode_image(tf.io.read_file(file_name), image_size)
+
+
+def decode_image(contents, image_size):
+    # nearest interpolation and uint8 pixels, as flow_from_dataframe does by default
+    image = tf.io.decode_jpeg(contents, channels=3)
+    image = tf.image.resize(image, image_size, method="nearest")
+    image.set_shape((image_size[0], image_size[1], 3))
+    return image
+
+
+def make_example_dataset(
+    dataframe,
+    directory,
+    image_size,
+    cache=False,
+    use_image_cache=False,
+    image_cache_dir=IMAGE_CACHE_DIR,
+    x_col="image_name",
+    y_col="target",
+):
+    """
+    Create an unbatched tf.data.Dataset with (uint8 image, label) examples
+    from the rows of dataframe. It does not depend on the batch size, so it
+    can be created once and batched by batch_dataset() for each trial.
+    """
+    image_names = dataframe[x_col].tolist()
+    # same label encoding as flow_from_dataframe: sorted class names '0' -> 0, '1' -> 1
+    labels = dataframe[y_col].astype(int).to_numpy()
+
+    if use_image_cache:
+        image_cache = open_image_cache(
+            image_names, directory, image_size, image_cache_dir
+        )
+
+        def read_from_cache(name):
+            return image_cache.get_images([name.decode()])[0]
+
+        def load(name, label):
+            image = tf.numpy_function(read_from_cache, [name], tf.uint8)
+            image.set_shape((image_size[0], image_size[1], 3))
+            return image, label
+
+        dataset = tf.data.Dataset.from_tensor_slices((image_names, labels))
+    else:
+        file_names = [tf.io.gfile.join(directory, name) for name in image_names]
+
+        def load(file_name, label):
+            return decode_and_resize(file_name, image_size), label
+
+        dataset = tf.data.Dataset.from_tensor_slices((file_names, labels))
+
+    dataset = dataset.map(load, num_parallel_calls=AUTOTUNE)
+    if cache:
+        # keep uint8 images (4 times smaller than float32) after the first epoch
+        dataset = dataset.cache()
+    set_iterator_attributes(dataset, image_names, labels)
+    return dataset
+
+
+def set_iterator_attributes(dataset, image_names, labels):
+    # mimic the DataFrameIterator attributes used by the scripts
+    dataset.samples = len(image_names)
+    dataset.n = len(image_names)
+    dataset.classes = labels
+    dataset.filenames = image_names
+
+
+def batch_dataset(examples, batch_size, shuffle=True, drop_remainder=False, seed=None):
+    """
+    Shuffle and batch the dataset of make_example_dataset(), with images
+    rescaled to [0, 1], and prefetch the batches.
+    """
+    dataset = examples
+    if shuffle:
+        dataset = dataset.shuffle(
+            examples.samples, seed=seed, reshuffle_each_iteration=True
+        )
+    dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    dataset = dataset.map(
+        lambda x, y: (tf.cast(x, tf.float32) / 255.0, tf.cast(y, tf.float32)),
+        num_parallel_calls=AUTOTUNE,
+    )
+    dataset = dataset.prefetch(AUTOTUNE)
+    set_iterator_attributes(dataset, examples.filenames, examples.classes)
+    return dataset
+
+
+def make_dataset(
+    dataframe,
+    directory,
+    image_size,
+    batch_size,
+    shuffle=True,
+    cache=False,
+    drop_remainder=False,
+    use_image_cache=False,
+    image_cache_dir=IMAGE_CACHE_DIR,
+    x_col="image_name",
+    y_col="target",
+    seed=None,
+):
+    """
+    Create a tf.data.Dataset with batches (images rescaled to [0, 1], labels)
+    from the rows of dataframe.
+    """
+    examples = make_example_dataset(
+        dataframe,
+        directory,
+        image_size,
+        cache=cache,
+        use_image_cache=use_image_cache,
+        image_cache_dir=image_cache_dir,
+        x_col=x_col,
+        y_col=y_col,
+    )
+    return batch_dataset(examples, batch_size, shuffle, drop_remainder, seed)
+
+
+def batch_datasets(
+    train_examples, validation_examples, test_examples, batch_size, shuffle=True
+):
+    """
+    Batch the example datasets of the three sets, in the order returned by
+    get_datasets(). When shuffling, the training set drops the last partial
+    batch, such that its length matches steps_per_epoch=samples // batch_size.
+    The test set is never shuffled, so its predictions are in the order of
+    its rows (see evaluation.py).
+    """
+    return (
+        batch_dataset(train_examples, batch_size, shuffle, drop_remainder=shuffle),
+        batch_dataset(validation_examples, batch_size, shuffle),
+        batch_dataset(test_examples, batch_size, shuffle=False),
+    )
+
+
+def get_datasets(
+    traindf,
+    testdf,
+    validationdf,
+    directory,
+    image_size,
+    batch_size,
+    shuffle=True,
+    cache=False,
+    use_image_cache=False,
+    image_cache_dir=IMAGE_CACHE_DIR,
+):
+    """
+    Return train, validation and test datasets in the same order as
+    get_data_generators(), see batch_datasets().
+    """
+    examples = [
+        make_example_dataset(
+            df,
+            directory,
+            image_size,
+            cache=cache,
+            use_image_cache=use_image_cache,
+            image_cache_dir=image_cache_dir,
+        )
+        for df in (traindf, validationdf, testdf)
+    ]
+    return batch_datasets(*examples, batch_size, shuffle)
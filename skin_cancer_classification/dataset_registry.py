@@ -0,0 +1,86 @@
+"""
+Process-level registry of datasets that are loaded only once.
+
+An Optuna study calls objective() once per trial, and reading the three sets
+of backend outputs at the top of each trial repeats the same disk reads
+(on NFS, a visible fraction of the study time). get_datasets() loads the
+data on the first call for a given folder and afterwards returns the same
+read-only arrays. The hit and miss counters confirm that trials do not read
+from disk again (a miss is a read from disk, a hit a call of get_datasets()
+that did not read). get_fingerprint() hashes the contents of the datasets, also
+once per process.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+_datasets = {}
+_fingerprints = {}
+_stats = {"hits": 0, "misses": 0}
+
+
+def read_only(data):
+    """Return read-only views of the arrays in the (nested) tuple data."""
+    if isinstance(data, (tuple, list)):
+        return tuple(read_only(item) for item in data)
+    view = np.asarray(data).view()
+    view.flags.writeable = False
+    return view
+
+
+def load(folder, read_function):
+    """
+    Return the datasets stored in folder, reading them (and counting a miss)
+    only if they are not loaded yet. Does not count hits.
+    """
+    key = os.path.abspath(folder)
+    if key not in _datasets:
+        _stats["misses"] += 1
+        _datasets[key] = read_only(read_function())
+    return _datasets[key]
+
+
+def get_datasets(folder, read_function):
+    """
+    Return the datasets stored in folder. read_function() is only called
+    the first time the folder is requested in this process.
+    """
+    if os.path.abspath(folder) in _datasets:
+        _stats["hits"] += 1
+    return load(folder, read_function)
+
+
+def get_fingerprint(folder, read_function):
+    """
+    Hex digest of the shapes, dtypes and contents of the datasets stored in
+    folder, such that results computed with other data are not mixed up.
+    """
+    key = os.path.abspath(folder)
+    if key not in _fingerprints:
+        digest = hashlib.sha256()
+        # not through get_datasets(): the lookups of trial_cache.py are not hits
+        for array in flatten(load(folder, read_function)):
+            digest.update(str((array.shape, array.dtype.str)).encode())
+            digest.update(np.ascontiguousarray(array).data)
+        _fingerprints[key] = digest.hexdigest()
+    return _fingerprints[key]
+
+
+def flatten(data):
+    """Arrays of the (nested) tuple data, in order."""
+    if isinstance(data, tuple):
+        return [array for item in data for array in flatten(item)]
+    return [data]
+
+
+def get_stats():
+    return dict(_stats, num_datasets=len(_datasets))
+
+
+def clear():
+    _datasets.clear()
+    _fingerprints.clear()
+    _stats["hits"] = 0
+    _stats["misses"] = 0
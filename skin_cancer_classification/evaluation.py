@@ -0,0 +1,69 @@
+"""
+Single-pass evaluation of a binary classifier on the test set.
+
+single_model_train_test.py called model.evaluate(test_generator) and then
+model.predict(test_generator), so every test image was decoded and run
+through the network twice, and since the test generator shuffled the images,
+the predictions were not in the order of test_generator.classes.
+evaluate_test_set() streams the test set once and returns, in this order,
+
+loss, accuracy, auc, scores, labels
+
+where loss (binary cross-entropy plus regularization, as model.evaluate()),
+accuracy (threshold 0.5) and auc (tf.keras.metrics.AUC) are the values of
+model.evaluate(), and scores and labels are the model outputs and the labels
+of the same batches, so they are always aligned. With an unshuffled test set,
+they are in the order of its rows. The Optuna scripts use it for their
+sanity check on the test set.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+
+def iterate_batches(data, batch_size=32):
+    """
+    Yield (x, y) batches of data: a tf.data.Dataset, a Keras Sequence or
+    DataFrameIterator (one pass over its batches), or a tuple (x, y) of arrays.
+    """
+    if isinstance(data, tf.data.Dataset):
+        yield from data
+    elif isinstance(data, (tuple, list)):
+        x, y = data
+        for start in range(0, len(y), batch_size):
+            yield x[start : start + batch_size], y[start : start + batch_size]
+    else:
+        for index in range(len(data)):
+            yield data[index]
+
+
+def evaluate_test_set(model, data, batch_size=32):
+    """
+    Return (loss, accuracy, auc, scores, labels) of model on data (see
+    iterate_batches()), computed with a single pass over the data.
+    """
+    loss_function = tf.keras.losses.BinaryCrossentropy()
+
+    @tf.function(reduce_retracing=True)
+    def test_step(x, y):
+        y_pred = tf.reshape(model(x, training=False), [-1])
+        loss = loss_function(y, y_pred)
+        if model.losses:  # regularization
+            loss += tf.add_n(model.losses)
+        return loss, y_pred
+
+    auc = tf.keras.metrics.AUC()
+    total_loss = 0.0
+    scores, labels = [], []
+    for x, y in iterate_batches(data, batch_size):
+        y = tf.reshape(tf.cast(y, tf.float32), [-1])
+        loss, y_pred = test_step(tf.convert_to_tensor(x), y)
+        auc.update_state(y, y_pred)
+        total_loss += float(loss) * int(y.shape[0])
+        scores.append(y_pred.numpy())
+        labels.append(y.numpy())
+    scores = np.concatenate(scores)
+    labels = np.concatenate(labels)
+    loss = total_loss / len(labels)
+    accuracy = float(np.mean((scores > 0.5) == (labels > 0.5)))
+    return loss, accuracy, float(auc.result()), scores, labels
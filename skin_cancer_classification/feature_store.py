@@ -0,0 +1,77 @@
+"""
+Feature store for the outputs of the backend neural network.
+
+Each split (train, test, validation) is saved as raw .npy arrays plus a small
+JSON manifest, instead of a pickled (X, y) tuple:
+
+<split>_features.npy  backend outputs X, shape (N, num_features)
+<split>_labels.npy    labels y, shape (N,)
+<split>.json          image names, backbone name, resolution, shape and dtype
+
+The arrays are opened with np.load(mmap_mode='r'), so opening a split does not
+depend on the feature dimensionality, and several processes on the same host
+share the operating system page cache instead of each holding a private copy.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+def get_file_names(folder, dataset_type):
+    features_file = os.path.join(folder, dataset_type + "_features.npy")
+    labels_file = os.path.join(folder, dataset_type + "_labels.npy")
+    manifest_file = os.path.join(folder, dataset_type + ".json")
+    return features_file, labels_file, manifest_file
+
+
+def save_array(file_name, array):
+    # write to a temporary file first, such that a reader never sees a partial file
+    tmp_file = file_name + ".tmp.npy"
+    np.save(tmp_file, array)
+    os.replace(tmp_file, file_name)
+
+
+def write_split(folder, dataset_type, X, y, image_names, backbone_name, num_pixels):
+    features_file, labels_file, manifest_file = get_file_names(folder, dataset_type)
+    X = np.ascontiguousarray(X)
+    y = np.ascontiguousarray(y)
+    save_array(features_file, X)
+    save_array(labels_file, y)
+    manifest = {
+        "dataset_type": dataset_type,
+        "backbone_name": backbone_name,
+        "resolution": [num_pixels, num_pixels],
+        "num_examples": int(X.shape[0]),
+        "features_shape": list(X.shape),
+        "features_dtype": str(X.dtype),
+        "labels_dtype": str(y.dtype),
+        "image_names": [str(name) for name in image_names],
+    }
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
+    print("Wrote", features_file, labels_file, manifest_file)
+
+
+def has_split(folder, dataset_type):
+    return all(os.path.exists(f) for f in get_file_names(folder, dataset_type))
+
+
+def read_manifest(folder, dataset_type):
+    _, _, manifest_file = get_file_names(folder, dataset_type)
+    with open(manifest_file, "r") as f:
+        return json.load(f)
+
+
+def read_split(folder, dataset_type, mmap_mode="r"):
+    """
+    Return (X, y) for the given split, as the pickled tuples did. With
+    mmap_mode='r' the arrays are read-only memory maps of the .npy files.
+    """
+    features_file, labels_file, _ = get_file_names(folder, dataset_type)
+    X = np.load(features_file, mmap_mode=mmap_mode)
+    y = np.load(labels_file, mmap_mode=mmap_mode)
+    return X, y
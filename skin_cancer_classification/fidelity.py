@@ -0,0 +1,190 @@
+"""
+Training-set size as a fidelity for Hyperband.
+
+HyperbandPruner only uses the epochs as budget, and every epoch of every
+trial trains over the whole training set. With a data fidelity, the epochs
+of the low rungs only see a nested, seeded subset of the training set: 10% of
+the examples until the first rung, and reduction_factor times more at each
+rung a trial is promoted to. The cost of discarding a bad configuration is
+then proportional to the data it actually needed.
+
+With MIN_RESOURCE = 1 and REDUCTION_FACTOR = 3 (passed to HyperbandPruner by
+the scripts), the pruner checks the trials of its bracket 0 after the epochs
+1, 3 and 9 (0-based), so get_fraction() gives 10% for epochs 0-1, 30% for
+epochs 2-3, 90% for epochs 4-9 and the whole set afterwards. The schedule
+follows bracket 0: the brackets s > 0 check later (first at step 3, then 9),
+so their trials spend a few more epochs than needed at a low fidelity.
+
+The subsets are nested (each one is a prefix of the next one) and stratified
+by class, and they depend only on the seed, so all trials see the same data.
+
+The image resolution is a fidelity for convolutional networks in the same
+way: get_image_size() gives a quarter of the full size until the first rung,
+half until the second one, and the full size afterwards. The cost of a
+convolution grows with the number of pixels, so the epochs of the low rungs
+are 16 and 4 times cheaper.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+MIN_FRACTION = 0.1  # fraction of the training set before the first rung
+# rungs of the schedules; the scripts pass them to optuna.pruners.HyperbandPruner
+# when a fidelity is used, since its default min_resource="auto" would put its
+# rungs elsewhere
+MIN_RESOURCE = 1
+REDUCTION_FACTOR = 3
+SEED = 42
+RESOLUTION_SCALES = (0.25, 0.5, 1.0)  # fraction of the full image size at each rung
+
+
+def get_rung(epoch, min_resource=MIN_RESOURCE, reduction_factor=REDUCTION_FACTOR):
+    """
+    Hyperband rung of epoch (0-based): the number of promotion checks that a
+    trial training epoch has passed. TFKerasPruningCallback reports the
+    0-based epoch as step, and bracket 0 of HyperbandPruner checks at steps
+    min_resource * reduction_factor**r (1, 3, 9, ...), so the epochs after
+    each check (2, 4, 10, ...) start a new rung.
+    """
+    rung = 0
+    while min_resource * reduction_factor**rung <= epoch - 1:
+        rung += 1
+    return rung
+
+
+def get_fraction(
+    epoch,
+    min_fraction=MIN_FRACTION,
+    min_resource=MIN_RESOURCE,
+    reduction_factor=REDUCTION_FACTOR,
+):
+    """
+    Fraction of the training set used at epoch (0-based). The fraction grows
+    by reduction_factor at each rung.
+    """
+    rung = get_rung(epoch, min_resource, reduction_factor)
+    return round(min(1.0, min_fraction * reduction_factor**rung), 6)
+
+
+def get_image_size(
+    epoch,
+    full_size,
+    scales=RESOLUTION_SCALES,
+    min_resource=MIN_RESOURCE,
+    reduction_factor=REDUCTION_FACTOR,
+):
+    """
+    Number of pixels per side of the images at epoch (0-based), the fraction
+    scales[rung] of full_size (the last scale for the later rungs). With the
+    default rungs (see get_rung(), bracket 0 of the pruner): a quarter for
+    epochs 0-1, half for epochs 2-3 and the full size from epoch 4.
+    """
+    rung = get_rung(epoch, min_resource, reduction_factor)
+    return int(round(full_size * scales[min(rung, len(scales) - 1)]))
+
+
+def nested_subset_indices(labels, fraction, seed=SEED):
+    """
+    Indices of a stratified subset with the given fraction of the examples.
+    For a fixed seed, the subset of a smaller fraction is always contained in
+    the subset of a larger one.
+    """
+    labels = np.asarray(labels)
+    rng = np.random.default_rng(seed)
+    indices = []
+    for label in np.unique(labels):
+        class_indices = rng.permutation(np.flatnonzero(labels == label))
+        num_examples = max(1, int(round(fraction * len(class_indices))))
+        indices.append(class_indices[:num_examples])
+    return np.sort(np.concatenate(indices))
+
+
+def make_persistent(callback):
+    """
+    Keras callbacks such as EarlyStopping and ReduceLROnPlateau reset their
+    state in on_train_begin. Calling model.fit() once per epoch (to change the
+    training subset) would then reset them every epoch, so this keeps only the
+    first on_train_begin() call. restart() calls it again.
+    """
+    if hasattr(callback, "restart_training"):
+        return callback  # already persistent
+    on_train_begin = callback.on_train_begin
+    callback.restart_training = on_train_begin
+    if isinstance(callback, tf.keras.callbacks.ModelCheckpoint):
+        # ModelCheckpoint sets its best score only in __init__
+        callback.initial_best = callback.best
+
+    def on_first_train_begin(logs=None):
+        if not getattr(callback, "started_training", False):
+            callback.started_training = True
+            on_train_begin(logs)
+
+    callback.on_train_begin = on_first_train_begin
+    return callback
+
+
+def restart(callback):
+    """
+    Forget the best score (and the patience counters) of a persistent
+    callback, e.g. because the validation metrics of the next epochs are
+    measured at another image size and cannot be compared with the earlier
+    ones.
+    """
+    callback.restart_training()
+    if isinstance(callback, tf.keras.callbacks.ModelCheckpoint):
+        callback.best = callback.initial_best
+
+
+def fit_with_fidelity(
+    model,
+    get_fit_arguments,
+    epochs,
+    callbacks,
+    fit_function=None,
+    schedule=get_fraction,
+    history_key="train_fraction",
+    restart_on_change=False,
+    **fit_kwargs
+):
+    """
+    Train model one epoch at a time, calling get_fit_arguments(fraction) to
+    get the training data of each epoch (a dictionary with the arguments of
+    model.fit(), such as x, y and steps_per_epoch). Returns a History object
+    as model.fit() does, including the fraction used at each epoch.
+    fit_function replaces model.fit, e.g. compiled_training.fit_compiled.
+    schedule(epoch) replaces get_fraction(epoch), e.g. to change the image
+    size, and its value is saved in the history as history_key. With
+    restart_on_change, the callbacks are restarted (see restart()) when the
+    value of schedule() changes, so ModelCheckpoint(save_best_only=True),
+    EarlyStopping and ReduceLROnPlateau only compare epochs of the same value.
+    """
+    if fit_function is None:
+        fit_function = model.fit
+    callbacks = [make_persistent(callback) for callback in callbacks]
+    merged_history = tf.keras.callbacks.History()
+    merged_history.history = {}
+    history = merged_history.history
+    for epoch in range(epochs):
+        fraction = schedule(epoch)
+        if restart_on_change and fraction != history.get(history_key, [fraction])[-1]:
+            for callback in callbacks:
+                restart(callback)
+        try:
+            epoch_history = fit_function(
+                initial_epoch=epoch,
+                epochs=epoch + 1,
+                callbacks=callbacks,
+                **get_fit_arguments(fraction),
+                **fit_kwargs
+            )
+        except Exception:
+            # e.g. optuna.TrialPruned: model.history keeps all the epochs so far
+            model.history = merged_history
+            raise
+        for key, values in epoch_history.history.items():
+            history.setdefault(key, []).extend(values)
+        history.setdefault(history_key, []).append(fraction)
+        if model.stop_training:  # set by EarlyStopping
+            break
+    model.history = merged_history
+    return merged_history
@@ -0,0 +1,236 @@
+"""
+Persistent cache of decoded and resized images.
+
+Decoding the 600x450 JPEG files of HAM10000 dominates the epoch time of the
+small models, and ImageDataGenerator.flow_from_dataframe repeats this work
+on every epoch of every trial. This module decodes each image only once per
+target size and stores the uint8 pixels in .npy shards, which are later
+opened as memory maps. The cache is keyed by (image_name, target_size):
+
+CACHE_DIR/<height>x<width>/index.json     maps image_name -> [shard, row]
+CACHE_DIR/<height>x<width>/shard_<id>.npy   uint8 array (N, height, width, 3)
+CACHE_DIR/<height>x<width>/index.lock     lock held while building the cache
+
+Several processes (e.g. the workers of optuna_workers.py) can build the
+same cache: build_image_cache() holds index.lock (fcntl.flock) from reading
+the index to writing it, so the other processes wait and then only decode
+the images that are still missing. Shard names are unique (process id and
+random suffix), so a shard is never overwritten, even on systems without
+fcntl.
+
+Use flow_from_cache() as a drop-in replacement for
+ImageDataGenerator(rescale=1./255).flow_from_dataframe().
+"""
+
+import contextlib
+import json
+import os
+import uuid
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.preprocessing.image import img_to_array, load_img
+
+try:
+    import fcntl  # file locks between processes (not available on Windows)
+except ImportError:
+    fcntl = None
+
+IMAGE_CACHE_DIR = "../../data_ham1000/image_cache/"
+SHARD_SIZE = 1024  # images per shard file
+
+
+def get_cache_folder(target_size, cache_dir=IMAGE_CACHE_DIR):
+    return os.path.join(cache_dir, str(target_size[0]) + "x" + str(target_size[1]))
+
+
+def read_index(cache_folder):
+    index_file = os.path.join(cache_folder, "index.json")
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file, "r") as f:
+        return json.load(f)
+
+
+def write_index(cache_folder, index):
+    # write to a temporary file first, such that a reader never sees a partial index
+    index_file = os.path.join(cache_folder, "index.json")
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_file, index_file)
+
+
+@contextlib.contextmanager
+def lock_cache_folder(cache_folder):
+    """Hold an exclusive lock on cache_folder, shared by all processes."""
+    with open(os.path.join(cache_folder, "index.lock"), "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def decode_image(file_name, target_size):
+    """
+    Decode and resize one image the same way flow_from_dataframe does
+    (PIL with nearest interpolation), keeping uint8 pixels.
+    """
+    image = load_img(file_name, target_size=target_size, interpolation="nearest")
+    return img_to_array(image, dtype="uint8")
+
+
+def build_image_cache(
+    image_names, directory, target_size, cache_dir=IMAGE_CACHE_DIR, verbose=1
+):
+    """
+    Decode the images in image_names that are not cached yet for target_size
+    and append them as new shards. Returns the updated index.
+    """
+    cache_folder = get_cache_folder(target_size, cache_dir)
+    if not os.path.exists(cache_folder):
+        # exist_ok: another process may create it at the same time
+        os.makedirs(cache_folder, exist_ok=True)
+        print("Created folder ", cache_folder)
+
+    with lock_cache_folder(cache_folder):
+        # read the index under the lock, after the shards of other processes
+        index = read_index(cache_folder)
+        missing = [name for name in dict.fromkeys(image_names) if name not in index]
+        for start in range(0, len(missing), SHARD_SIZE):
+            names = missing[start : start + SHARD_SIZE]
+            add_shard(cache_folder, index, names, directory, target_size)
+            if verbose:
+                print("Cached", start + len(names), "of", len(missing), "images")
+    return index
+
+
+def add_shard(cache_folder, index, names, directory, target_size):
+    """Decode names into a new shard and add them to the index (under the lock)."""
+    shard_name = "shard_{}_{}.npy".format(os.getpid(), uuid.uuid4().hex[:8])
+    shard_file = os.path.join(cache_folder, shard_name)
+    tmp_file = shard_file + ".tmp.npy"
+    shard = np.lib.format.open_memmap(
+        tmp_file,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(names), target_size[0], target_size[1], 3),
+    )
+    for row, name in enumerate(names):
+        shard[row] = decode_image(os.path.join(directory, name), target_size)
+        index[name] = [shard_name, row]
+    shard.flush()
+    del shard
+    os.replace(tmp_file, shard_file)
+    write_index(cache_folder, index)
+
+
+class ImageCache:
+    """
+    Read-only view of the cached images of a given target size.
+    Shards are opened as memory maps, so several processes share the page cache.
+    """
+
+    def __init__(self, target_size, cache_dir=IMAGE_CACHE_DIR):
+        self.target_size = tuple(target_size)
+        self.cache_folder = get_cache_folder(target_size, cache_dir)
+        self.index = read_index(self.cache_folder)
+        self.shards = {}
+
+    def get_shard(self, shard_name):
+        if shard_name not in self.shards:
+            self.shards[shard_name] = np.load(
+                os.path.join(self.cache_folder, shard_name), mmap_mode="r"
+            )
+        return self.shards[shard_name]
+
+    def get_images(self, image_names):
+        """Return a uint8 array (N, height, width, 3) with the given images."""
+        images = np.empty(
+            (len(image_names), self.target_size[0], self.target_size[1], 3),
+            dtype=np.uint8,
+        )
+        for i, name in enumerate(image_names):
+            shard_name, row = self.index[name]
+            images[i] = self.get_shard(shard_name)[row]
+        return images
+
+
+# ImageCache objects opened in this process, by cache folder
+open_caches = {}
+
+
+def open_image_cache(image_names, directory, target_size, cache_dir=IMAGE_CACHE_DIR):
+    """
+    Return an ImageCache that contains image_names, decoding the missing
+    images first. The ImageCache (and its memory-mapped shards) is opened only
+    once per process, and reused while it has all the requested images.
+    """
+    key = os.path.abspath(get_cache_folder(target_size, cache_dir))
+    image_cache = open_caches.get(key)
+    if image_cache is None or any(
+        name not in image_cache.index for name in image_names
+    ):
+        build_image_cache(image_names, directory, target_size, cache_dir)
+        image_cache = ImageCache(target_size, cache_dir)
+        open_caches[key] = image_cache
+    return image_cache
+
+
+class CachedImageIterator(tf.keras.utils.Sequence):
+    """
+    Batches of images read from an ImageCache. It mimics the attributes of the
+    DataFrameIterator returned by flow_from_dataframe with class_mode='binary'
+    (samples, n, classes, filenames, batch_size) and rescales pixels by 1/255.
+    """
+
+    def __init__(self, image_cache, image_names, labels, batch_size, shuffle=True):
+        super().__init__()
+        self.image_cache = image_cache
+        self.filenames = list(image_names)
+        self.classes = np.asarray(labels, dtype=np.int32)
+        self.n = len(self.filenames)
+        self.samples = self.n
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.index_array = np.arange(self.n)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        batch = self.index_array[idx * self.batch_size : (idx + 1) * self.batch_size]
+        names = [self.filenames[i] for i in batch]
+        x = self.image_cache.get_images(names).astype(np.float32) / 255.0
+        y = self.classes[batch].astype(np.float32)
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.index_array)
+
+
+def flow_from_cache(
+    dataframe,
+    directory,
+    target_size,
+    batch_size,
+    x_col="image_name",
+    y_col="target",
+    shuffle=True,
+    cache_dir=IMAGE_CACHE_DIR,
+):
+    """
+    Drop-in replacement for
+    ImageDataGenerator(rescale=1./255).flow_from_dataframe(..., class_mode='binary')
+    that decodes missing images once and then reads them from the cache.
+    """
+    image_names = dataframe[x_col].tolist()
+    image_cache = open_image_cache(image_names, directory, target_size, cache_dir)
+    # same label encoding as flow_from_dataframe: sorted class names '0' -> 0, '1' -> 1
+    labels = dataframe[y_col].astype(int).to_numpy()
+    return CachedImageIterator(image_cache, image_names, labels, batch_size, shuffle)
@@ -22,6 +22,10 @@ import matplotlib.pyplot as plt
 import numpy as np
 #import sklearn.metrics 
 #from sklearn.metrics import confusion_matrix, roc_curve, auc, recall_score, f1_score, precision_score, precision_recall_curve
+from sklearn.linear_model import LogisticRegression, RidgeClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import LinearSVC
 #from tensorflow.keras.models import Model
 from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
 from tensorflow.keras.backend import clear_session
@@ -30,6 +34,8 @@ import os
 import sys
 import shutil
 import pickle
+import functools
+import time
 #import argparse
 import pandas as pd
 from tensorflow.keras.applications.resnet import ResNet152, preprocess_input
@@ -41,6 +47,19 @@ from tensorflow.keras import regularizers
 import optuna
 from optuna.integration import TFKerasPruningCallback
 
+import dataset_registry
+from class_sampling import decrease_num_negatives
+from binary_metrics import roc_auc
+from checkpointing import GarbageCollectionCallback, InMemoryCheckpoint, collect_garbage, is_in_top_k
+from feature_store import has_split, read_split
+from compiled_training import fit_compiled
+from evaluation import evaluate_test_set
+from fidelity import MIN_RESOURCE, REDUCTION_FACTOR, fit_with_fidelity, get_fraction, nested_subset_indices
+from run_log import EpochTimer, log_run
+from population_training import PopulationHeads, ask_population, fit_population
+from study_storage import get_storage
+from trial_cache import get_cached_value
+
 from tensorflow.keras.optimizers import RMSprop
 
 #To avoid the warning in
@@ -66,12 +85,26 @@ ID = 52 # identifier for this simulation - use USE_CLASS_WEIGHT=True and 3000 ex
 USE_CLASS_WEIGHT = False # class weight for unbalanced sets
 EPOCHS = 100 # maximum number of epochs
 NUM_OPTUNA_TRIALS = 150 
+METRIC_TO_MONITOR = 'val_accuracy' # or 'val_auc'. Optuna needs to use the same metric for all trials
+# "mlp" is the Keras dense head, the other ones are linear models of scikit-learn that train in milliseconds
+MODEL_FAMILIES = ["mlp", "logistic_regression", "linear_svm", "ridge"]
+USE_COMPILED_TRAINING = False # use True to train the dense heads with the XLA-compiled loop of compiled_training.py instead of model.fit()
+USE_DATA_FIDELITY = False # use True to train the low Hyperband rungs on nested subsets of the training set, see fidelity.py
+NUM_SAVED_MODELS = 10 # only the best trials keep their optuna_best_model_<n> folder, see checkpointing.py (None saves every trial)
+MEMOIZE_TRIALS = True # trials that repeat a trained configuration return its value without training, see trial_cache.py
+MAX_CONFIG_REPEATS = 1 # number of times a configuration is trained before its mean value is reused (> 1 averages out training noise)
+POPULATION_SIZE = 1 # use > 1 to train this many trials at once in one vectorized model, see population_training.py
 #IMAGESIZE = (240, 240)      # Define the input shape of the images
 INPUTSHAPE = (1280,) # (240, 240, 3)  # NN input
 #BEST_MODEL = None # Best NN model 
 #CURRENT_MODEL = None
 VERBOSITY_LEVEL = 1 #use 1 to see the progress bar when training and testing
 
+STUDY_NAME = 'ID_' + str(ID)
+STORAGE_TYPE = "sqlite" # "sqlite", "journal" (many concurrent workers) or "rdb" (database server), see study_storage.py
+STORAGE_URL = "sqlite:///../../outputs/optuna_db.sqlite3" # Optuna database (sqlite or rdb), shared by all workers of optuna_workers.py
+JOURNAL_FILE = "../../outputs/optuna_journal.log" # used when STORAGE_TYPE = "journal"
+
 #folder with 3 files storing pre-computed backend outputs
 INPUT_DIR = '../../backend_output/efficientnet_v2_imagenet1k_b1_N5589_id_1/'
 
@@ -99,6 +132,14 @@ def calculate_class_weights(y):
         return weight_for_0, weight_for_1
 
 def read_three_datasets():
+    if has_split(INPUT_DIR, "train"):
+        # memory-mapped arrays written by save_backend_output.py, see feature_store.py
+        val_data = read_split(INPUT_DIR, "validation")
+        train_data = read_split(INPUT_DIR, "train")
+        test_data = read_split(INPUT_DIR, "test")
+        return train_data, test_data, val_data
+
+    # folders created before the feature store only have pickle files
     file_name = os.path.join(INPUT_DIR, "validation.pickle")
     val_data = read_dataset(file_name)
     file_name = os.path.join(INPUT_DIR, "train.pickle")
@@ -114,27 +155,22 @@ def read_dataset(file_name):
         examples = pickle.load(file_pi)
     return examples
 
-def objective(trial): # uses effnet
-    # Clear clutter from previous Keras session graphs.
-    clear_session()
-
-    num_output_neurons = 1
-
-    train_data, test_data, val_data = read_three_datasets()    
-    # train_generator, validation_generator, test_generator = get_data_generators(num_desired_negative_train_examples, batch_size)
-    #test_generator = None #not used here
-
-    # Define the CNN model
-    model = Sequential()
-    #model.add(Input(input_shape=INPUTSHAPE))
-
-    # Load the respective EfficientNet model but exclude the classification layers
-    #trainable = False
-    #model_url = 'https://tfhub.dev/google/imagenet/efficientnet_v2_imagenet1k_b1/feature_vector/2'
-    #extractor = hub.KerasLayer(model_url, input_shape=INPUTSHAPE, trainable=trainable)
-    
-    ############ Optuna parameters
-
+def get_cached_trial_value(trial):
+    '''
+    Mean value of the earlier trainings of the configuration of trial (with the same
+    data and training settings), or None if it must be trained. See trial_cache.py.
+    '''
+    if not MEMOIZE_TRIALS:
+        return None
+    fingerprint = dataset_registry.get_fingerprint(INPUT_DIR, read_three_datasets)
+    settings = {"epochs": EPOCHS, "use_class_weight": USE_CLASS_WEIGHT,
+                "metric_to_monitor": METRIC_TO_MONITOR, "use_data_fidelity": USE_DATA_FIDELITY}
+    return get_cached_value(trial, fingerprint, settings, MAX_CONFIG_REPEATS)
+
+def suggest_hyperparameters(trial):
+    '''
+    Sample the search space of the dense heads. Returns a dictionary used by build_model().
+    '''
     ############ Optuna parameters
     batch_size = trial.suggest_int("batch_size", 1, 15) 
     num_dense_layers = trial.suggest_int("num_dense_layers", 1, 4) # number of layers
@@ -146,6 +182,7 @@ def objective(trial): # uses effnet
     dropout_rate = trial.suggest_float("dropout", 0.2, 0.7)
     use_batch_normalization= trial.suggest_categorical("batch_nor", [True, False])
     use_regularizers= trial.suggest_categorical("regul", [True, False])
+    l1_weight, l2_weight = 0, 0
     if use_regularizers:
         l1_weight = trial.suggest_categorical("l1_weight", [0, 1e-5, 1e-4, 1e-3, 1e-2])
         l2_weight = trial.suggest_categorical("l2_weight", [0, 1e-5, 1e-4, 1e-3, 1e-2])
@@ -153,6 +190,33 @@ def objective(trial): # uses effnet
     # We compile our model with a sampled learning rate.
     learning_rate = trial.suggest_float("lea_rate", 1e-5, 1e-2, log=True)
 
+    return {"batch_size": batch_size,
+            "num_dense_layers": num_dense_layers,
+            "num_neurons_per_layer": num_neurons_per_layer,
+            "dropout_rate": dropout_rate,
+            "use_batch_normalization": use_batch_normalization,
+            "use_regularizers": use_regularizers,
+            "l1_weight": l1_weight,
+            "l2_weight": l2_weight,
+            "activation": activation,
+            "learning_rate": learning_rate}
+
+
+def build_model(hyperparameters):
+    num_output_neurons = 1
+    num_dense_layers = hyperparameters["num_dense_layers"]
+    num_neurons_per_layer = hyperparameters["num_neurons_per_layer"]
+    dropout_rate = hyperparameters["dropout_rate"]
+    use_batch_normalization = hyperparameters["use_batch_normalization"]
+    use_regularizers = hyperparameters["use_regularizers"]
+    l1_weight = hyperparameters["l1_weight"]
+    l2_weight = hyperparameters["l2_weight"]
+    activation = hyperparameters["activation"]
+
+    # Define the CNN model
+    model = Sequential()
+    #model.add(Input(input_shape=INPUTSHAPE))
+
     print("num_neurons_per_layer =", num_neurons_per_layer)
     #first layer
     if use_regularizers:
@@ -214,14 +278,108 @@ def objective(trial): # uses effnet
     else:
         model.add(Dense(num_output_neurons, activation="sigmoid"))
 
+    return model
+
+
+def linear_objective(trial, model_family):
+    '''
+    Train a linear model of scikit-learn on the backend outputs and return the same
+    metric as objective(). The features are standardized before the linear model.
+    '''
+    start_time = time.time()
+    train_data, test_data, val_data = dataset_registry.get_datasets(INPUT_DIR, read_three_datasets)
+    trial.set_user_attr("dataset_registry", dataset_registry.get_stats())
+
+    class_weight = None
+    if USE_CLASS_WEIGHT:
+        class_weight = "balanced" # same weights as calculate_class_weights()
+
+    if model_family == "logistic_regression":
+        C = trial.suggest_float("C", 1e-4, 1e2, log=True)
+        classifier = LogisticRegression(C=C, class_weight=class_weight, max_iter=1000)
+    elif model_family == "linear_svm":
+        C = trial.suggest_float("C", 1e-4, 1e2, log=True)
+        classifier = LinearSVC(C=C, class_weight=class_weight, dual=False)
+    elif model_family == "ridge":
+        alpha = trial.suggest_float("alpha", 1e-3, 1e3, log=True)
+        classifier = RidgeClassifier(alpha=alpha, class_weight=class_weight)
+    else:
+        raise Exception("Unknown model family " + model_family)
+    model = make_pipeline(StandardScaler(), classifier)
+
+    cached_value = get_cached_trial_value(trial)
+    if cached_value is not None:
+        return cached_value
+
+    print("")
+    print("------------------------------------------------------------")
+    print("  Hyperparameters of Optuna trial # ", trial.number)
+    print("------------------------------------------------------------")
+    for key, value in trial.params.items():
+        print("    {}: {}".format(key, value))
+
+    model.fit(train_data[0], train_data[1])
+
+    # AUC from the decision function (scores), the accuracy from the predicted labels
+    history = {}
+    for name, data in (("", train_data), ("val_", val_data), ("test_", test_data)):
+        history[name + 'accuracy'] = [model.score(data[0], data[1])]
+        history[name + 'auc'] = [roc_auc(data[1], model.decision_function(data[0]))]
+    history['num_desired_train_examples'] = len(train_data[1])
+
+    best_model_name = os.path.join(OUTPUT_DIR, 'optuna_best_model_' + str(trial.number))
+    if NUM_SAVED_MODELS is None or is_in_top_k(trial.study, history[METRIC_TO_MONITOR][-1], NUM_SAVED_MODELS):
+        if not os.path.exists(best_model_name):
+            os.makedirs(best_model_name)
+        with open(os.path.join(best_model_name, 'sklearn_model.pickle'), 'wb') as file_pi:
+            pickle.dump(model, file_pi)
+    log_run(STUDY_NAME, trial.number, history, trial.params, value=history[METRIC_TO_MONITOR][-1],
+            start_time=start_time, duration=time.time() - start_time)
+
+    print('Train accuracy:', history['accuracy'][-1])
+    print('Train AUC:', history['auc'][-1])
+    # test data cannot be used in model selection. This is just sanity check
+    print('Test accuracy:', history['test_accuracy'][-1])
+    print('Test AUC:', history['test_auc'][-1])
+    print('Val accuracy:', history['val_accuracy'][-1])
+    print('Val AUC:', history['val_auc'][-1])
+
+    return history[METRIC_TO_MONITOR][-1]
+
+
+def objective(trial): # uses effnet
+    # cheap linear models compete with the dense heads in the same study
+    model_family = trial.suggest_categorical("model_family", MODEL_FAMILIES)
+    if model_family != "mlp":
+        return linear_objective(trial, model_family)
+
+    start_time = time.time()
+    # Clear clutter from previous Keras session graphs.
+    clear_session()
+
+    # read from disk only in the first trial, later trials get the same read-only arrays
+    train_data, test_data, val_data = dataset_registry.get_datasets(INPUT_DIR, read_three_datasets)
+    trial.set_user_attr("dataset_registry", dataset_registry.get_stats())
+    # train_generator, validation_generator, test_generator = get_data_generators(num_desired_negative_train_examples, batch_size)
+    #test_generator = None #not used here
+
+    # Load the respective EfficientNet model but exclude the classification layers
+    #trainable = False
+    #model_url = 'https://tfhub.dev/google/imagenet/efficientnet_v2_imagenet1k_b1/feature_vector/2'
+    #extractor = hub.KerasLayer(model_url, input_shape=INPUTSHAPE, trainable=trainable)
+    
+    hyperparameters = suggest_hyperparameters(trial)
+    cached_value = get_cached_trial_value(trial)
+    if cached_value is not None:
+        return cached_value
+    batch_size = hyperparameters["batch_size"]
+    learning_rate = hyperparameters["learning_rate"]
+    model = build_model(hyperparameters)
     model.summary()
 
 
     # Define the metric for callbacks and Optuna
-    if True:
-        metric_to_monitor = 'val_accuracy' #trial.suggest_categorical("metric_to_monitor", ['val_accuracy', 'val_auc'])
-    else:
-        metric_to_monitor = 'val_auc'
+    metric_to_monitor = METRIC_TO_MONITOR
     metric_mode = 'max'
     early_stopping = EarlyStopping(monitor=metric_to_monitor, patience=3, mode=metric_mode, restore_best_weights=True)
     #early_stopping = EarlyStopping(monitor='val_auc', patience=5)
@@ -231,7 +389,11 @@ def objective(trial): # uses effnet
     #best_model_name = 'best_model_' + base_name + '.h5'
     best_model_name = 'optuna_best_model_' + str(trial.number)
     best_model_name = os.path.join(OUTPUT_DIR, best_model_name)
-    best_model_save = ModelCheckpoint(best_model_name, save_best_only=True, monitor=metric_to_monitor, mode=metric_mode)
+    if NUM_SAVED_MODELS is None:
+        best_model_save = ModelCheckpoint(best_model_name, save_best_only=True, monitor=metric_to_monitor, mode=metric_mode)
+    else:
+        # keep the best weights in memory, and save them only if the trial is in the top NUM_SAVED_MODELS
+        best_model_save = InMemoryCheckpoint(monitor=metric_to_monitor, mode=metric_mode)
 
     reduce_lr_loss = ReduceLROnPlateau(monitor=metric_to_monitor, factor=0.5, patience=3, verbose=VERBOSITY_LEVEL, min_delta=1e-4, mode=metric_mode)
     # Define Tensorboard as a Keras callback
@@ -268,28 +430,56 @@ def objective(trial): # uses effnet
         class_weight = {0: weight_for_0, 1: weight_for_1} # prepare dic for Keras
 
     # Training the model
-    history = model.fit(
-        x=train_data[0], 
-        y=train_data[1], 
-        steps_per_epoch=num_train // batch_size,
-        epochs=EPOCHS,
-        validation_data=(val_data[0], val_data[1]),
-        verbose=VERBOSITY_LEVEL,
-        class_weight=class_weight,
-        #callbacks=[early_stopping,reduce_lr_loss, tensorboard]
-        #callbacks=[TFKerasPruningCallback(trial, metric_to_monitor), early_stopping]
-        #callbacks=[early_stopping, best_model_save, reduce_lr_loss]
-        callbacks=[early_stopping, best_model_save, reduce_lr_loss, TFKerasPruningCallback(trial, metric_to_monitor)]
-    )
+    callbacks = [EpochTimer(), early_stopping, best_model_save, reduce_lr_loss, TFKerasPruningCallback(trial, metric_to_monitor)]
+    try:
+        if USE_DATA_FIDELITY:
+            # the epochs of low Hyperband rungs use only 10% of the training set, promoted trials see more
+            def get_fit_arguments(fraction):
+                subset = nested_subset_indices(train_data[1], fraction)
+                return dict(x=train_data[0][subset], y=train_data[1][subset],
+                            steps_per_epoch=max(1, len(subset) // batch_size))
+            history = fit_with_fidelity(model, get_fit_arguments, EPOCHS,
+                                        callbacks=callbacks,
+                                        fit_function=functools.partial(fit_compiled, model, batch_size=batch_size) if USE_COMPILED_TRAINING else None,
+                                        validation_data=(val_data[0], val_data[1]),
+                                        verbose=VERBOSITY_LEVEL,
+                                        class_weight=class_weight)
+        elif USE_COMPILED_TRAINING:
+            # several micro-batches per call of an XLA-compiled function, with the same callbacks
+            history = fit_compiled(model, train_data[0], train_data[1], batch_size,
+                                   epochs=EPOCHS,
+                                   validation_data=(val_data[0], val_data[1]),
+                                   class_weight=class_weight,
+                                   callbacks=callbacks,
+                                   verbose=VERBOSITY_LEVEL)
+        else:
+            history = model.fit(
+                x=train_data[0], 
+                y=train_data[1], 
+                steps_per_epoch=num_train // batch_size,
+                epochs=EPOCHS,
+                validation_data=(val_data[0], val_data[1]),
+                verbose=VERBOSITY_LEVEL,
+                class_weight=class_weight,
+                #callbacks=[early_stopping,reduce_lr_loss, tensorboard]
+                #callbacks=[TFKerasPruningCallback(trial, metric_to_monitor), early_stopping]
+                #callbacks=[early_stopping, best_model_save, reduce_lr_loss]
+                callbacks=callbacks
+            )
+    except optuna.TrialPruned:
+        # keep the epochs of pruned trials in the run log too
+        log_run(STUDY_NAME, trial.number, model.history.history, trial.params, state="PRUNED",
+                start_time=start_time, duration=time.time() - start_time)
+        raise
     #CURRENT_MODEL = tf.keras.models.clone_model(model)
 
     # add to history
     history.history['num_desired_train_examples'] = num_train
 
-    # https://stackoverflow.com/questions/41061457/keras-how-to-save-the-training-history-attribute-of-the-history-object
-    pickle_file_path = os.path.join(OUTPUT_DIR, 'optuna_best_model_' + str(trial.number), 'trainHistoryDict.pickle')
-    with open(pickle_file_path, 'wb') as file_pi:
-        pickle.dump(history.history, file_pi)
+    if NUM_SAVED_MODELS is not None:
+        if is_in_top_k(trial.study, history.history[metric_to_monitor][-1], NUM_SAVED_MODELS):
+            best_model_save.save(model, best_model_name)
+
     
     # Evaluate the model accuracy on the validation set.
     # score = model.evaluate(x_valid, y_valid, verbose=0)
@@ -301,10 +491,17 @@ def objective(trial): # uses effnet
         print('Train AUC:', history.history['auc'][-1])
 
     if True:  # test data cannot be used in model selection. This is just sanity check
-        test_loss, test_accuracy, test_auc = model.evaluate(x=test_data[0], y=test_data[1], verbose=VERBOSITY_LEVEL)
+        test_loss, test_accuracy, test_auc, _, _ = evaluate_test_set(model, test_data) # one pass, see evaluation.py
         print('Test loss:', test_loss)
         print('Test accuracy:', test_accuracy)
         print('Test AUC:', test_auc)
+        history.history['test_loss'] = test_loss
+        history.history['test_accuracy'] = test_accuracy
+        history.history['test_auc'] = test_auc
+
+    # one run log for all trials instead of a trainHistoryDict.pickle per trial
+    log_run(STUDY_NAME, trial.number, history.history, trial.params, value=history.history[metric_to_monitor][-1],
+            start_time=start_time, duration=time.time() - start_time)
 
     # Evaluate the model accuracy on the validation set.
     #val_loss, val_accuracy, val_auc = model.evaluate(validation_generator, verbose=VERBOSITY_LEVEL)
@@ -329,40 +526,144 @@ def objective(trial): # uses effnet
         
 
 
-def decrease_num_negatives(df, desired_num_negative_examples):
+def suggest_population_member(trial):
+    model_family = trial.suggest_categorical("model_family", MODEL_FAMILIES)
+    if model_family != "mlp":
+        return {"model_family": model_family, "batch_size": None}
+    hyperparameters = suggest_hyperparameters(trial)
+    hyperparameters["model_family"] = model_family
+    return hyperparameters
+
+
+def optimize_population(study, num_trials, population_size):
     '''
-    Create dataframe with desired_num_rows rows from df
+    Population mode: ask the sampler for population_size trials at once, train their heads
+    together on the same batches (see population_training.py) and tell Optuna the result of each one.
     '''
-    shuffled_df = df.sample(frac=1).reset_index(drop=True)
-    neg_examples = shuffled_df[shuffled_df['target'] == '0'].copy()
-    neg_examples = neg_examples.head( round(desired_num_negative_examples) ).copy()
-
-    pos_examples = shuffled_df[shuffled_df['target'] == '1'].copy()    
-    newdf = pd.concat([neg_examples, pos_examples], ignore_index=True)
-    newdf = newdf.sample(frac=1).reset_index(drop=True) #shuffle again
-    return newdf
+    train_data, test_data, val_data = dataset_registry.get_datasets(INPUT_DIR, read_three_datasets)
+    num_train = len(train_data[1])
 
+    class_weight = None # initialize
+    if USE_CLASS_WEIGHT:
+        weight_for_0, weight_for_1 = calculate_class_weights(train_data[1])
+        class_weight = {0: weight_for_0, 1: weight_for_1} # prepare dic for Keras
 
-if __name__ == '__main__':
-    print("=====================================")
-    print("Model selection using pre-computed backend outputs")
+    num_asked_trials = 0
+    while num_asked_trials < num_trials:
+        clear_session()
+        groups = ask_population(study, min(population_size, num_trials - num_asked_trials), suggest_population_member)
+        population_trials = [trial for group in groups.values() for trial, _ in group]
+        num_asked_trials += len(population_trials)
+        told = set() # numbers of the trials already told to the study
+
+        def tell(trial, *args, **kwargs):
+            study.tell(trial, *args, **kwargs)
+            told.add(trial.number)
+
+        try:
+            for batch_size, group in groups.items():
+                if batch_size is None:
+                    # linear models of scikit-learn are trained one by one
+                    for trial, hyperparameters in group:
+                        tell(trial, linear_objective(trial, hyperparameters["model_family"]))
+                    continue
+                if MEMOIZE_TRIALS:
+                    # configurations that were already trained are not trained again
+                    new_group = []
+                    for trial, hyperparameters in group:
+                        cached_value = get_cached_trial_value(trial)
+                        if cached_value is None:
+                            new_group.append((trial, hyperparameters))
+                        else:
+                            tell(trial, cached_value)
+                    group = new_group
+                    if len(group) == 0:
+                        continue
+                trials = [trial for trial, _ in group]
+                hyperparameters_list = [hyperparameters for _, hyperparameters in group]
+                print("Training trials", [trial.number for trial in trials], "together with batch_size", batch_size)
+
+                start_time = time.time() # the trials of a population share their training time
+                population = PopulationHeads(hyperparameters_list, INPUTSHAPE[0])
+                histories, pruned = fit_population(population, trials, train_data, val_data, batch_size, EPOCHS,
+                                                   metric_to_monitor=METRIC_TO_MONITOR, class_weight=class_weight,
+                                                   fraction_function=get_fraction if USE_DATA_FIDELITY else None,
+                                                   verbose=VERBOSITY_LEVEL)
+                # test data cannot be used in model selection. This is just sanity check
+                test_losses, test_logits = population.evaluate(test_data[0], test_data[1])
+
+                for k, (trial, hyperparameters) in enumerate(group):
+                    trial.set_user_attr("population_trials", [t.number for t in trials])
+
+                    # same output as ModelCheckpoint(save_best_only=True): the best weights of this head
+                    best_model_name = os.path.join(OUTPUT_DIR, 'optuna_best_model_' + str(trial.number))
+                    if NUM_SAVED_MODELS is None or (not pruned[k] and
+                            is_in_top_k(study, histories[k][METRIC_TO_MONITOR][-1], NUM_SAVED_MODELS)):
+                        model = build_model(hyperparameters)
+                        population.set_keras_weights(k, model)
+                        model.save(best_model_name)
+
+                    if pruned[k]:
+                        log_run(STUDY_NAME, trial.number, histories[k], trial.params, state="PRUNED",
+                                start_time=start_time, duration=time.time() - start_time)
+                        tell(trial, state=optuna.trial.TrialState.PRUNED)
+                        continue
+
+                    history = histories[k]
+                    history['num_desired_train_examples'] = num_train
+                    history['test_loss'] = test_losses[k]
+                    history['test_accuracy'] = np.mean((test_logits[k] > 0) == np.asarray(test_data[1]))
+                    log_run(STUDY_NAME, trial.number, history, trial.params, value=history[METRIC_TO_MONITOR][-1],
+                            start_time=start_time, duration=time.time() - start_time)
+
+                    print("Trial", trial.number)
+                    print('  Test loss:', test_losses[k])
+                    print('  Test accuracy:', history['test_accuracy'])
+                    print('  Val accuracy:', history['val_accuracy'][-1])
+                    print('  Val AUC:', history['val_auc'][-1])
+                    tell(trial, history[METRIC_TO_MONITOR][-1])
+        except BaseException:
+            # do not leave the other trials of the population RUNNING in the shared storage
+            for trial in population_trials:
+                if trial.number not in told:
+                    study.tell(trial, state=optuna.trial.TrialState.FAIL)
+            raise
+        if NUM_SAVED_MODELS is not None:
+            collect_garbage(study, OUTPUT_DIR, NUM_SAVED_MODELS)
+
+
+def run_study(study, num_trials):
+    if POPULATION_SIZE > 1:
+        optimize_population(study, num_trials, POPULATION_SIZE)
+    else:
+        callbacks = []
+        if NUM_SAVED_MODELS is not None:
+            # delete the models of the trials that drop out of the top NUM_SAVED_MODELS
+            callbacks.append(GarbageCollectionCallback(OUTPUT_DIR, NUM_SAVED_MODELS))
+        study.optimize(objective, n_trials=num_trials, callbacks=callbacks) #, callbacks=[save_best_model_callback]) #, timeout=600)
 
-    #copy script
-    copied_script = os.path.join(OUTPUT_DIR, os.path.basename(sys.argv[0]))
-    shutil.copy2(sys.argv[0], copied_script)
-    print("Just copied current script as file", copied_script)
 
+def create_study():
+    '''
+    Create the study, or load it if it already exists in STORAGE_URL
+    (e.g. when several workers of optuna_workers.py share it).
+    '''
     #study = optuna.create_study(direction="maximize")
+    if USE_DATA_FIDELITY:
+        # get_fraction() grows the data right after the promotion checks of bracket 0 of this pruner
+        pruner = optuna.pruners.HyperbandPruner(min_resource=MIN_RESOURCE, reduction_factor=REDUCTION_FACTOR)
+    else:
+        pruner = optuna.pruners.HyperbandPruner()
     study = optuna.create_study(direction="maximize",
-                                storage="sqlite:///../../outputs/optuna_db.sqlite3",  # Specify the storage URL here.
-                                study_name='ID_' + str(ID),
+                                storage=get_storage(STORAGE_TYPE, STORAGE_URL, JOURNAL_FILE),  # Specify the storage here.
+                                study_name=STUDY_NAME,
                                 sampler=optuna.samplers.TPESampler(), 
-                                pruner=optuna.pruners.HyperbandPruner())
-    #study.optimize(objective, n_trials=100)
-    pruned_trials = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.PRUNED])
-    complete_trials = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.COMPLETE])    
-    study.optimize(objective, n_trials=NUM_OPTUNA_TRIALS) #, callbacks=[save_best_model_callback]) #, timeout=600)
+                                pruner=pruner,
+                                load_if_exists=True)
+    return study
+
 
+def save_study_results(study):
     print("Number of finished trials: {}".format(len(study.trials)))
 
     trial = study.best_trial
@@ -412,3 +713,21 @@ if __name__ == '__main__':
     plt.savefig(os.path.join(OUTPUT_DIR, 'optuna_parameter_importance.png') )
     #fig.show()
 
+
+if __name__ == '__main__':
+    print("=====================================")
+    print("Model selection using pre-computed backend outputs")
+
+    #copy script
+    copied_script = os.path.join(OUTPUT_DIR, os.path.basename(sys.argv[0]))
+    shutil.copy2(sys.argv[0], copied_script)
+    print("Just copied current script as file", copied_script)
+
+    study = create_study()
+    #study.optimize(objective, n_trials=100)
+    pruned_trials = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.PRUNED])
+    complete_trials = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.COMPLETE])    
+    run_study(study, NUM_OPTUNA_TRIALS)
+    print("Dataset registry:", dataset_registry.get_stats()) # expect a single miss per process
+
+    save_study_results(study)
@@ -27,6 +27,7 @@ import os
 import sys
 import shutil
 import pickle
+import time
 #import argparse
 import pandas as pd
 from tensorflow.keras.applications.resnet import ResNet152, preprocess_input
@@ -38,6 +39,16 @@ from tensorflow.keras import regularizers
 import optuna
 from optuna.integration import TFKerasPruningCallback
 
+from activation_cache import get_activations, keep_full_model, split_frozen_prefix
+from backbone_registry import load_backbone
+from backbones import get_last_load_time
+from class_sampling import decrease_num_negatives
+from data_pipeline import batch_datasets, get_datasets, make_dataset, make_example_dataset
+from evaluation import evaluate_test_set
+from image_cache import flow_from_cache
+from fidelity import MIN_RESOURCE, REDUCTION_FACTOR, fit_with_fidelity, get_image_size, nested_subset_indices
+from run_log import log_run
+
 from keras.backend import clear_session
 from keras.datasets import mnist
 from keras.layers import Conv2D
@@ -67,27 +78,32 @@ if False:
 # Global variables
 ID = 24 # identifier for this simulation - use effnet as backend using val acc instead of AUC (23)
 EPOCHS = 10 # maximum number of epochs
+BACKBONE_NAME = 'efficientnet_v2_imagenet1k_b1' # EfficientNet of objective(), resolved by backbone_registry.py
 IMAGESIZE = (240, 240)      # Define the input shape of the images
 INPUTSHAPE = (240, 240, 3)  # NN input
 #BEST_MODEL = None # Best NN model 
 #CURRENT_MODEL = None
 VERBOSITY_LEVEL = 1 #use 1 to see the progress bar when training and testing
+USE_IMAGE_CACHE = True # read decoded images from image_cache.py instead of decoding JPEGs every epoch
+USE_TF_DATA = True # use the parallel tf.data pipeline of data_pipeline.py instead of Python generators
+USE_DATA_FIDELITY = False # use True to train the low Hyperband rungs on nested subsets of the training set, see fidelity.py
+USE_ACTIVATION_CACHE = True # compute the frozen backbone once per image size and set, and train only the head, see activation_cache.py
+ACTIVATION_BATCH_SIZE = 32 # batch size of the forward pass that fills the activation cache
+USE_PROGRESSIVE_RESOLUTION = False # use True to train simple_NN_objective() at 1/4 and 1/2 of IMAGESIZE in the low Hyperband rungs, see fidelity.py
 
 #Important: output folder
 OUTPUT_DIR = '../../outputs/optuna_no_backend_outputs/id_' + str(ID) + '/'
+RUN_NAME = 'no_backend_id_' + str(ID) # name of the trials in the run log, see run_log.py
 if not os.path.exists(OUTPUT_DIR):
     os.makedirs(OUTPUT_DIR)
     print("Created folder ", OUTPUT_DIR)
 
 #additional global variables
 num_desired_negative_train_examples = 324
+IMAGE_FOLDER = '../../data_ham1000/HAM10000_images_part_1/' # images of the train, validation, and test data
+prepared_data = {} # data preparation shared by all trials of the study, see get_prepared_data()
 
-def get_data_generators(num_desired_negative_train_examples, batch_size):
-    # Define the folders for train, validation, and test data
-    train_folder = '../../data_ham1000/HAM10000_images_part_1/'
-    validation_folder = '../../data_ham1000/HAM10000_images_part_1/'
-    test_folder = '../../data_ham1000/HAM10000_images_part_1/'
-
+def get_dataframes(num_desired_negative_train_examples):
     train_csv = "../../data_ham1000/train.csv"
     test_csv = "../../data_ham1000/test.csv"
     validation_csv = "../../data_ham1000/validation.csv"
@@ -109,6 +125,59 @@ def get_data_generators(num_desired_negative_train_examples, batch_size):
         print(testdf['target'].value_counts())
         print('validation:')
         print(validationdf['target'].value_counts())
+    return traindf, testdf, validationdf
+
+def get_prepared_data(num_desired_negative_train_examples, image_size=IMAGESIZE):
+    '''
+    Data preparation that does not depend on the trial, built once per study: the split
+    dataframes and, with USE_TF_DATA, the unbatched example datasets (which keep the
+    decoded images of cache() or the open image cache). Each trial only adds the batching.
+    The dataframes are shared by all image sizes.
+    '''
+    key = (num_desired_negative_train_examples, tuple(image_size))
+    if key not in prepared_data:
+        same_dataframes = [prepared["dataframes"] for (num_negatives, _), prepared in prepared_data.items()
+                           if num_negatives == num_desired_negative_train_examples]
+        if len(same_dataframes) > 0:
+            dataframes = same_dataframes[0]
+        else:
+            dataframes = get_dataframes(num_desired_negative_train_examples)
+            # flow_from_dataframe(validate_filenames=True) checks all files on each call, check them only once
+            dataframes = tuple(df[[os.path.isfile(os.path.join(IMAGE_FOLDER, name)) for name in df['image_name']]].reset_index(drop=True)
+                               for df in dataframes)
+        examples = None
+        if USE_TF_DATA:
+            traindf, testdf, validationdf = dataframes
+            examples = tuple(make_example_dataset(df, IMAGE_FOLDER, image_size, cache=not USE_IMAGE_CACHE, use_image_cache=USE_IMAGE_CACHE)
+                             for df in (traindf, validationdf, testdf))
+        prepared_data[key] = {"dataframes": dataframes, "examples": examples}
+    return prepared_data[key]
+
+def get_data_generators(num_desired_negative_train_examples, batch_size, dataframes=None, image_size=IMAGESIZE):
+    # Define the folders for train, validation, and test data
+    train_folder = IMAGE_FOLDER
+    validation_folder = IMAGE_FOLDER
+    test_folder = IMAGE_FOLDER
+
+    examples = None
+    if dataframes is None:
+        prepared = get_prepared_data(num_desired_negative_train_examples, image_size)
+        dataframes, examples = prepared["dataframes"], prepared["examples"]
+    traindf, testdf, validationdf = dataframes
+
+    if USE_TF_DATA:
+        # parallel decode, resize and rescale, prefetching batches while Keras trains
+        if examples is not None:
+            return batch_datasets(*examples, batch_size, shuffle=True)
+        return get_datasets(traindf, testdf, validationdf, train_folder, image_size, batch_size,
+                            shuffle=True, cache=not USE_IMAGE_CACHE, use_image_cache=USE_IMAGE_CACHE)
+
+    if USE_IMAGE_CACHE:
+        # decode each JPEG only once per image size, and read it from memory-mapped shards afterwards
+        train_generator = flow_from_cache(traindf, train_folder, image_size, batch_size, shuffle=True)
+        validation_generator = flow_from_cache(validationdf, validation_folder, image_size, batch_size, shuffle=True)
+        test_generator = flow_from_cache(testdf, test_folder, image_size, batch_size, shuffle=False)
+        return train_generator, validation_generator, test_generator
 
     train_datagen = ImageDataGenerator(rescale=1./255)
 
@@ -117,10 +186,11 @@ def get_data_generators(num_desired_negative_train_examples, batch_size):
             directory = train_folder,
             x_col="image_name", 
             y_col="target",
-            target_size=IMAGESIZE,
+            target_size=image_size,
             batch_size=batch_size,
             class_mode='binary',
-            shuffle=True
+            shuffle=True,
+            validate_filenames=False # checked in get_prepared_data()
         )        
 
     # Loading and preprocessing the training, validation, and test data
@@ -132,10 +202,11 @@ def get_data_generators(num_desired_negative_train_examples, batch_size):
             directory = validation_folder,
             x_col="image_name", 
             y_col="target",
-            target_size=IMAGESIZE,
+            target_size=image_size,
             batch_size=batch_size,
             class_mode='binary',
-            shuffle=True
+            shuffle=True,
+            validate_filenames=False # checked in get_prepared_data()
     )
 
     test_generator = test_datagen.flow_from_dataframe(
@@ -143,13 +214,73 @@ def get_data_generators(num_desired_negative_train_examples, batch_size):
             directory = test_folder,
             x_col="image_name", 
             y_col="target",
-            target_size=IMAGESIZE,
+            target_size=image_size,
             batch_size=batch_size,
             class_mode='binary',
-            shuffle=True
+            shuffle=False,
+            validate_filenames=False # checked in get_prepared_data()
     )
     return train_generator, validation_generator, test_generator
 
+def get_cached_activations(prefix_model, backbone_name, dataframes):
+    '''
+    Return the (X, y) arrays of the train, validation and test sets at the output of the
+    frozen layers prefix_model, in the order of the rows of dataframes. They are computed
+    only once per backbone_name, image size and set, see activation_cache.py.
+    '''
+    traindf, testdf, validationdf = dataframes
+    activations = []
+    for split, df in (('train', traindf), ('validation', validationdf), ('test', testdf)):
+        get_dataset = lambda df=df: make_dataset(df, IMAGE_FOLDER, IMAGESIZE, ACTIVATION_BATCH_SIZE, shuffle=False,
+                                                 use_image_cache=USE_IMAGE_CACHE)
+        activations.append(get_activations(prefix_model, backbone_name, IMAGESIZE, split, df['image_name'].tolist(),
+                                           df['target'].astype(int).to_numpy(), get_dataset))
+    return activations
+
+def fit_with_train_fraction(model, dataframes, batch_size, validation_generator, callbacks, train_data=None):
+    '''
+    Train model with the training set of each epoch given by fidelity.get_fraction(),
+    a nested subset of the examples in dataframes[0]. The generators of each fraction
+    are built once. With train_data (the cached activations of dataframes[0]), the
+    subsets are taken from these arrays instead.
+    '''
+    train_generators = {}
+    def get_fit_arguments(fraction):
+        if train_data is not None:
+            indices = nested_subset_indices(dataframes[0]['target'], fraction)
+            return dict(x=train_data[0][indices], y=train_data[1][indices], batch_size=batch_size, shuffle=True)
+        if fraction not in train_generators:
+            traindf = dataframes[0]
+            traindf = traindf.iloc[nested_subset_indices(traindf['target'], fraction)].reset_index(drop=True)
+            train_generators[fraction] = get_data_generators(num_desired_negative_train_examples, batch_size,
+                                                             (traindf, dataframes[1], dataframes[2]))[0]
+        train_generator = train_generators[fraction]
+        return dict(x=train_generator, steps_per_epoch=max(1, train_generator.samples // batch_size))
+    return fit_with_fidelity(model, get_fit_arguments, EPOCHS, callbacks,
+                             validation_data=validation_generator, verbose=VERBOSITY_LEVEL)
+
+def fit_with_image_size(model, batch_size, callbacks, trial):
+    '''
+    Train model with the image size of each epoch given by fidelity.get_image_size(), a
+    quarter and a half of IMAGESIZE in the low Hyperband rungs. The training and validation
+    data of each size are built once, and the current size is kept in the user attribute
+    "image_size" of the trial. The callbacks are restarted when the size changes, so
+    ModelCheckpoint, EarlyStopping and ReduceLROnPlateau never compare val_auc measured
+    at different sizes, and the saved best model is one of the last size.
+    '''
+    generators = {}
+    def get_fit_arguments(num_pixels):
+        if num_pixels not in generators:
+            generators[num_pixels] = get_data_generators(num_desired_negative_train_examples, batch_size,
+                                                         image_size=(num_pixels, num_pixels))
+        train_generator, validation_generator, _ = generators[num_pixels]
+        trial.set_user_attr("image_size", num_pixels)
+        return dict(x=train_generator, steps_per_epoch=max(1, train_generator.samples // batch_size),
+                    validation_data=validation_generator)
+    return fit_with_fidelity(model, get_fit_arguments, EPOCHS, callbacks,
+                             schedule=lambda epoch: get_image_size(epoch, IMAGESIZE[0]), history_key='image_size',
+                             restart_on_change=True, verbose=VERBOSITY_LEVEL)
+
 # not working! CURRENT_MODEL is None
 def save_best_model_callback(study, trial):
     global BEST_MODEL, OUTPUT_DIR
@@ -162,13 +293,16 @@ def save_best_model_callback(study, trial):
     
 
 def objective(trial): # uses effnet
+    start_time = time.time()
     # Clear clutter from previous Keras session graphs.
     clear_session()
 
     num_output_neurons = 1
 
     batch_size = trial.suggest_int("batch_size", 1, 15) 
+    # only the batching is rebuilt for each trial, see get_prepared_data()
     train_generator, validation_generator, test_generator = get_data_generators(num_desired_negative_train_examples, batch_size)
+    dataframes = get_prepared_data(num_desired_negative_train_examples)["dataframes"]
     #test_generator = None #not used here
 
     # Define the CNN model
@@ -176,8 +310,9 @@ def objective(trial): # uses effnet
 
     # Load the respective EfficientNet model but exclude the classification layers
     trainable = False
-    model_url = 'https://tfhub.dev/google/imagenet/efficientnet_v2_imagenet1k_b1/feature_vector/2'
-    extractor = hub.KerasLayer(model_url, input_shape=INPUTSHAPE, trainable=trainable)
+    # local copy of the registry (no download), loaded once per process, see backbone_registry.py
+    extractor = load_backbone(BACKBONE_NAME, INPUTSHAPE, trainable=trainable)
+    backbone_load_time = get_last_load_time()
     
     if False:
         num_dense_layers = 2
@@ -281,34 +416,60 @@ def objective(trial): # uses effnet
     for key, value in trial.params.items():
         print("    {}: {}".format(key, value))
 
-    model.compile(
-        loss="binary_crossentropy",
-        #optimizer=RMSprop(learning_rate=learning_rate),
-        optimizer=Adam(learning_rate=learning_rate),
-        metrics=["accuracy", tf.keras.metrics.AUC()] #always use both metrics, and choose one to guide Optuna
-    )
+    callbacks = [early_stopping, best_model_save, reduce_lr_loss, TFKerasPruningCallback(trial, metric_to_monitor[0])]
+    # with a frozen extractor, train only the head on its cached outputs (the head shares its layers with model)
+    frozen_prefix = split_frozen_prefix(model) if USE_ACTIVATION_CACHE else None
+    training_model = model
+    if frozen_prefix is not None:
+        prefix_model, training_model = frozen_prefix
+        train_data, validation_data, test_data = get_cached_activations(prefix_model, BACKBONE_NAME, dataframes)
+        callbacks = keep_full_model(callbacks, model) # the checkpoints still save the full model
+
+    metrics = ["accuracy", tf.keras.metrics.AUC()] #always use both metrics, and choose one to guide Optuna
+    optimizer = Adam(learning_rate=learning_rate) #RMSprop(learning_rate=learning_rate)
+    training_model.compile(loss="binary_crossentropy", optimizer=optimizer, metrics=metrics)
+    if training_model is not model:
+        model.compile(loss="binary_crossentropy", optimizer=optimizer, metrics=metrics) # saved with the checkpoints
 
     # Training the model
-    history = model.fit(
-        train_generator,
-        steps_per_epoch=train_generator.samples // batch_size,
-        epochs=EPOCHS,
-        validation_data=validation_generator,
-        verbose=VERBOSITY_LEVEL,
-        #callbacks=[early_stopping,reduce_lr_loss, tensorboard]
-        #callbacks=[TFKerasPruningCallback(trial, metric_to_monitor), early_stopping]
-        #callbacks=[early_stopping, best_model_save, reduce_lr_loss]
-        callbacks=[early_stopping, best_model_save, reduce_lr_loss, TFKerasPruningCallback(trial, metric_to_monitor[0])]
-    )
+    if USE_DATA_FIDELITY:
+        # the epochs of low Hyperband rungs use only a subset of the training set, promoted trials see more
+        if frozen_prefix is not None:
+            history = fit_with_train_fraction(training_model, dataframes, batch_size, validation_data, callbacks, train_data)
+        else:
+            history = fit_with_train_fraction(model, dataframes, batch_size, validation_generator, callbacks)
+    elif frozen_prefix is not None:
+        history = training_model.fit(
+            train_data[0],
+            train_data[1],
+            batch_size=batch_size,
+            epochs=EPOCHS,
+            validation_data=validation_data,
+            shuffle=True,
+            verbose=VERBOSITY_LEVEL,
+            callbacks=callbacks
+        )
+    else:
+        history = model.fit(
+            train_generator,
+            steps_per_epoch=train_generator.samples // batch_size,
+            epochs=EPOCHS,
+            validation_data=validation_generator,
+            verbose=VERBOSITY_LEVEL,
+            #callbacks=[early_stopping,reduce_lr_loss, tensorboard]
+            #callbacks=[TFKerasPruningCallback(trial, metric_to_monitor), early_stopping]
+            #callbacks=[early_stopping, best_model_save, reduce_lr_loss]
+            callbacks=callbacks
+        )
     #CURRENT_MODEL = tf.keras.models.clone_model(model)
 
     # add to history
     history.history['num_desired_train_examples'] = train_generator.samples
+    history.history['backbone_load_time'] = backbone_load_time
 
-    # https://stackoverflow.com/questions/41061457/keras-how-to-save-the-training-history-attribute-of-the-history-object
-    pickle_file_path = os.path.join(OUTPUT_DIR, 'optuna_best_model_' + str(trial.number), 'trainHistoryDict.pickle')
-    with open(pickle_file_path, 'wb') as file_pi:
-        pickle.dump(history.history, file_pi)
+    # one run log for all trials instead of a trainHistoryDict.pickle per trial
+    log_run(RUN_NAME, trial.number, history.history, trial.params, value=history.history[metric_to_monitor[0]][-1],
+            start_time=start_time, duration=time.time() - start_time)
     
     # Evaluate the model accuracy on the validation set.
     # score = model.evaluate(x_valid, y_valid, verbose=0)
@@ -320,7 +481,10 @@ def objective(trial): # uses effnet
         print('Train AUC:', history.history['auc'][-1])
 
     if True:  # test data cannot be used in model selection. This is just sanity check
-        test_loss, test_accuracy, test_auc = model.evaluate(test_generator, verbose=VERBOSITY_LEVEL)
+        if frozen_prefix is not None:
+            test_loss, test_accuracy, test_auc, _, _ = evaluate_test_set(training_model, test_data, batch_size)
+        else:
+            test_loss, test_accuracy, test_auc, _, _ = evaluate_test_set(model, test_generator) # one pass, see evaluation.py
         print('Test loss:', test_loss)
         print('Test accuracy:', test_accuracy)
         print('Test AUC:', test_auc)
@@ -348,13 +512,16 @@ def objective(trial): # uses effnet
         
 
 def simple_NN_objective(trial): # simple NN
+    start_time = time.time()
     # Clear clutter from previous Keras session graphs.
     clear_session()
 
     num_output_neurons = 1
 
     batch_size = trial.suggest_int("batch_size", 1, 15) 
+    # only the batching is rebuilt for each trial, see get_prepared_data()
     train_generator, validation_generator, test_generator = get_data_generators(num_desired_negative_train_examples, batch_size)
+    dataframes = get_prepared_data(num_desired_negative_train_examples)["dataframes"]
     #test_generator = None #not used here
 
     if False:
@@ -374,6 +541,8 @@ def simple_NN_objective(trial): # simple NN
 
     # Define the CNN model
     model = Sequential()
+    if USE_PROGRESSIVE_RESOLUTION:
+        model.add(Input(shape=(None, None, 3))) # the image size changes between epochs
 
     if True:
         num_conv_layers = 2
@@ -432,7 +601,10 @@ def simple_NN_objective(trial): # simple NN
         # Define the size of the pooling area for max pooling
         model.add(MaxPooling2D(pool_size=(2, 2)))
         model.add(Dropout(dropout_rate))
-    model.add(Flatten())
+    if USE_PROGRESSIVE_RESOLUTION:
+        model.add(GlobalAveragePooling2D()) # same number of weights for all image sizes
+    else:
+        model.add(Flatten())
     model.add(Dense(num_output_neurons, activation="sigmoid"))
     model.summary()
 
@@ -481,26 +653,41 @@ def simple_NN_objective(trial): # simple NN
     )
 
     # Training the model
-    history = model.fit(
-        train_generator,
-        steps_per_epoch=train_generator.samples // batch_size,
-        epochs=EPOCHS,
-        validation_data=validation_generator,
-        verbose=VERBOSITY_LEVEL,
-        #callbacks=[early_stopping,reduce_lr_loss, tensorboard]
-        #callbacks=[TFKerasPruningCallback(trial, metric_to_monitor), early_stopping]
-        #callbacks=[early_stopping, best_model_save, reduce_lr_loss]
-        callbacks=[early_stopping, best_model_save, reduce_lr_loss, TFKerasPruningCallback(trial, metric_to_monitor[0])]
-    )
+    if USE_PROGRESSIVE_RESOLUTION:
+        # the epochs of low Hyperband rungs use smaller images, promoted trials continue at IMAGESIZE
+        history = fit_with_image_size(model, batch_size, trial=trial,
+                                      callbacks=[early_stopping, best_model_save, reduce_lr_loss, TFKerasPruningCallback(trial, metric_to_monitor[0])])
+    elif USE_DATA_FIDELITY:
+        # the epochs of low Hyperband rungs use only a subset of the training set, promoted trials see more
+        history = fit_with_train_fraction(model, dataframes, batch_size, validation_generator,
+                                          callbacks=[early_stopping, best_model_save, reduce_lr_loss, TFKerasPruningCallback(trial, metric_to_monitor[0])])
+    else:
+        history = model.fit(
+            train_generator,
+            steps_per_epoch=train_generator.samples // batch_size,
+            epochs=EPOCHS,
+            validation_data=validation_generator,
+            verbose=VERBOSITY_LEVEL,
+            #callbacks=[early_stopping,reduce_lr_loss, tensorboard]
+            #callbacks=[TFKerasPruningCallback(trial, metric_to_monitor), early_stopping]
+            #callbacks=[early_stopping, best_model_save, reduce_lr_loss]
+            callbacks=[early_stopping, best_model_save, reduce_lr_loss, TFKerasPruningCallback(trial, metric_to_monitor[0])]
+        )
     #CURRENT_MODEL = tf.keras.models.clone_model(model)
 
     # add to history
     history.history['num_desired_train_examples'] = train_generator.samples
-
-    # https://stackoverflow.com/questions/41061457/keras-how-to-save-the-training-history-attribute-of-the-history-object
-    pickle_file_path = os.path.join(OUTPUT_DIR, 'optuna_best_model_' + str(trial.number), 'trainHistoryDict.pickle')
-    with open(pickle_file_path, 'wb') as file_pi:
-        pickle.dump(history.history, file_pi)
+    if USE_PROGRESSIVE_RESOLUTION and history.history['image_size'][-1] != IMAGESIZE[0]:
+        # stopped before reaching the full size: the objective of all trials is measured at IMAGESIZE
+        val_loss, val_accuracy, val_auc = model.evaluate(validation_generator, verbose=VERBOSITY_LEVEL)
+        history.history['full_size_val_loss'] = val_loss
+        history.history['full_size_val_accuracy'] = val_accuracy
+        history.history['full_size_val_auc'] = val_auc
+
+    # one run log for all trials instead of a trainHistoryDict.pickle per trial
+    log_run(RUN_NAME, trial.number, history.history, trial.params,
+            value=history.history.get('full_size_' + metric_to_monitor[0], history.history[metric_to_monitor[0]][-1]),
+            start_time=start_time, duration=time.time() - start_time)
     
     # Evaluate the model accuracy on the validation set.
     # score = model.evaluate(x_valid, y_valid, verbose=0)
@@ -512,15 +699,15 @@ def simple_NN_objective(trial): # simple NN
         print('Train AUC:', history.history['auc'][-1])
 
     if True:  # test data cannot be used in model selection. This is just sanity check
-        test_loss, test_accuracy, test_auc = model.evaluate(test_generator, verbose=VERBOSITY_LEVEL)
+        test_loss, test_accuracy, test_auc, _, _ = evaluate_test_set(model, test_generator) # one pass, see evaluation.py
         print('Test loss:', test_loss)
         print('Test accuracy:', test_accuracy)
         print('Test AUC:', test_auc)
 
     # Evaluate the model accuracy on the validation set.
     #val_loss, val_accuracy, val_auc = model.evaluate(validation_generator, verbose=VERBOSITY_LEVEL)
-    val_accuracy = history.history['val_accuracy'][-1]
-    val_auc = history.history['val_auc'][-1]
+    val_accuracy = history.history.get('full_size_val_accuracy', history.history['val_accuracy'][-1])
+    val_auc = history.history.get('full_size_val_auc', history.history['val_auc'][-1])
     #print('Val loss:', val_loss)
     #print('Val accuracy:', val_accuracy)
     #print('Val AUC:', val_auc)
@@ -533,20 +720,6 @@ def simple_NN_objective(trial): # simple NN
     #return val_accuracy
     return val_auc
 
-def decrease_num_negatives(df, desired_num_negative_examples):
-    '''
-    Create dataframe with desired_num_rows rows from df
-    '''
-    shuffled_df = df.sample(frac=1).reset_index(drop=True)
-    neg_examples = shuffled_df[shuffled_df['target'] == '0'].copy()
-    neg_examples = neg_examples.head( round(desired_num_negative_examples) ).copy()
-
-    pos_examples = shuffled_df[shuffled_df['target'] == '1'].copy()    
-    newdf = pd.concat([neg_examples, pos_examples], ignore_index=True)
-    newdf = newdf.sample(frac=1).reset_index(drop=True) #shuffle again
-    return newdf
-
-
 if __name__ == '__main__':
     print("=====================================")
     print("Model selection")
@@ -557,7 +730,13 @@ if __name__ == '__main__':
     print("Just copied current script as file", copied_script)
 
     #study = optuna.create_study(direction="maximize")
-    study = optuna.create_study(direction="maximize", sampler=optuna.samplers.TPESampler(), pruner=optuna.pruners.HyperbandPruner())
+    if USE_DATA_FIDELITY or USE_PROGRESSIVE_RESOLUTION:
+        # fidelity.get_fraction() and get_image_size() change right after the promotion checks of
+        # bracket 0 of this pruner (steps 1, 3 and 9), the other brackets check later
+        pruner = optuna.pruners.HyperbandPruner(min_resource=MIN_RESOURCE, reduction_factor=REDUCTION_FACTOR)
+    else:
+        pruner = optuna.pruners.HyperbandPruner()
+    study = optuna.create_study(direction="maximize", sampler=optuna.samplers.TPESampler(), pruner=pruner)
     #study.optimize(objective, n_trials=100)
     pruned_trials = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.PRUNED])
     complete_trials = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.COMPLETE])    
@@ -0,0 +1,151 @@
+"""
+Runs several Optuna workers in parallel over the study of
+model_selection_backend_outputs.py.
+
+The heads trained on the backend outputs are small MLPs that cannot use all
+cores of the machine on their own. This launcher starts num_workers processes
+against the same study (STUDY_NAME in the storage chosen by STORAGE_TYPE or
+--storage, see study_storage.py), splits the trial budget among them and
+partitions the cores: each worker gets its own set of cores (CPU affinity,
+when supported by the operating system) and sets the TensorFlow intra-op and
+inter-op thread counts accordingly.
+
+Usage (from the folder of the scripts):
+python optuna_workers.py --num_workers 8 --num_trials 150 --storage journal
+"""
+
+import argparse
+import multiprocessing
+import os
+
+
+def split_trials(num_trials, num_workers):
+    """Split num_trials into num_workers budgets that differ by at most one."""
+    budgets = [num_trials // num_workers] * num_workers
+    for i in range(num_trials % num_workers):
+        budgets[i] += 1
+    return budgets
+
+
+def get_available_cores():
+    """
+    Sorted numbers of the cores this process may run on. A node or container
+    can be limited to cores that are not numbered 0..n-1.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def get_worker_cores(worker_id, num_workers, cores):
+    """Slice of cores for worker worker_id (shared if there are more workers)."""
+    cores_per_worker = max(1, len(cores) // num_workers)
+    first = (worker_id * cores_per_worker) % len(cores)
+    return cores[first : first + cores_per_worker]
+
+
+def run_worker(worker_id, num_trials, cores, inter_op_threads, verbosity, storage_type):
+    num_threads = len(cores)
+    # must be set before TensorFlow creates its thread pools
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(num_threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = str(inter_op_threads)
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+    import model_selection_backend_outputs as msbo
+
+    msbo.VERBOSITY_LEVEL = verbosity
+    if storage_type != "":
+        msbo.STORAGE_TYPE = storage_type
+    print(
+        "Worker", worker_id, "runs", num_trials, "trials with cores", cores, flush=True
+    )
+    study = msbo.create_study()
+    msbo.run_study(study, num_trials)
+    print("Worker", worker_id, "dataset registry:", msbo.dataset_registry.get_stats())
+
+
+if __name__ == "__main__":
+    print("=====================================")
+    print("Parallel Optuna workers")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_workers", type=int, default=8, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--num_trials",
+        type=int,
+        default=-1,
+        help="Total number of trials (default: NUM_OPTUNA_TRIALS of the script)",
+    )
+    parser.add_argument(
+        "--num_cores",
+        type=int,
+        default=len(get_available_cores()),
+        help="Number of the available cores to partition among the workers",
+    )
+    parser.add_argument(
+        "--inter_op_threads",
+        type=int,
+        default=1,
+        help="TensorFlow inter-op threads per worker",
+    )
+    parser.add_argument(
+        "--verbosity",
+        type=int,
+        default=2,
+        help="Keras verbosity of the workers (2 prints one line per epoch)",
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        default="",
+        help="sqlite, journal or rdb (default: STORAGE_TYPE of the script)",
+    )
+    args = parser.parse_args()
+
+    import model_selection_backend_outputs as msbo
+
+    if args.storage != "":
+        msbo.STORAGE_TYPE = args.storage
+
+    num_trials = args.num_trials
+    if num_trials == -1:
+        num_trials = msbo.NUM_OPTUNA_TRIALS
+
+    # create the study once, such that the workers only load it
+    study = msbo.create_study()
+
+    # spawn: each worker starts a fresh interpreter and configures its own TensorFlow
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    budgets = split_trials(num_trials, args.num_workers)
+    available_cores = get_available_cores()[: args.num_cores]
+    for worker_id in range(args.num_workers):
+        cores = get_worker_cores(worker_id, args.num_workers, available_cores)
+        worker = context.Process(
+            target=run_worker,
+            args=(
+                worker_id,
+                budgets[worker_id],
+                cores,
+                args.inter_op_threads,
+                args.verbosity,
+                args.storage,
+            ),
+        )
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+        if worker.exitcode != 0:
+            print("Worker", worker.name, "finished with exit code", worker.exitcode)
+
+    msbo.save_study_results(msbo.create_study())
@@ -0,0 +1,500 @@
+"""
+Population training: fit many Optuna candidates of the dense heads at once.
+
+A head of model_selection_backend_outputs.py is a small stack of 1 to 4 Dense
+layers over the backend outputs, and training it alone is dominated by
+Python and Keras overhead. PopulationHeads stacks K heads into one model:
+each layer is a batched matmul over a head axis, with the widths padded to
+the largest head and masked, such that all heads train on the same batches
+in a single graph. Each head keeps its own hyperparameters (depth, widths,
+activation, dropout, batch normalization, regularization and learning rate),
+the same layer order as build_model() and the same Adam update as Keras.
+
+fit_population() reproduces, per head, the callbacks used by objective():
+EarlyStopping(patience=3, restore_best_weights=True), ModelCheckpoint
+(save_best_only) with the best weights kept in memory, ReduceLROnPlateau
+(factor=0.5, patience=3, min_delta=1e-4) and Optuna pruning reports.
+All heads of a population share the batch size.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from binary_metrics import roc_auc
+from fidelity import nested_subset_indices
+
+# Keras defaults
+ADAM_BETA_1 = 0.9
+ADAM_BETA_2 = 0.999
+ADAM_EPSILON = 1e-7
+BN_MOMENTUM = 0.99
+BN_EPSILON = 1e-3
+EARLY_STOPPING_PATIENCE = 3
+REDUCE_LR_PATIENCE = 3
+REDUCE_LR_FACTOR = 0.5
+REDUCE_LR_MIN_DELTA = 1e-4
+PREDICT_BATCH_SIZE = 1024
+
+
+def glorot_uniform(fan_in, fan_out, shape, rng):
+    limit = np.sqrt(6.0 / (fan_in + fan_out))
+    return rng.uniform(-limit, limit, size=shape).astype(np.float32)
+
+
+def compute_auc(y_true, scores):
+    if len(np.unique(y_true)) < 2:
+        return 0.0
+    return roc_auc(y_true, scores)
+
+
+class PopulationHeads:
+    """
+    K dense heads with different hyperparameters, stored as stacked variables
+    whose first axis is the head. hyperparameters_list holds the dictionaries
+    returned by suggest_hyperparameters().
+    """
+
+    def __init__(self, hyperparameters_list, input_dim, seed=None):
+        rng = np.random.default_rng(seed)
+        self.hyperparameters_list = hyperparameters_list
+        self.num_heads = len(hyperparameters_list)
+        depths = [h["num_dense_layers"] for h in hyperparameters_list]
+        self.max_depth = max(depths)
+
+        # pad each layer to the widest head that has it, and mask the remaining units
+        self.widths = []
+        unit_masks = []
+        for layer in range(self.max_depth):
+            head_widths = [
+                int(h["num_neurons_per_layer"][layer]) if depths[k] > layer else 0
+                for k, h in enumerate(hyperparameters_list)
+            ]
+            width = max(head_widths)
+            mask = np.zeros((self.num_heads, width), dtype=np.float32)
+            for k, head_width in enumerate(head_widths):
+                mask[k, :head_width] = 1.0
+            self.widths.append(width)
+            unit_masks.append(tf.constant(mask))
+        self.unit_masks = unit_masks
+        # selects the last hidden layer of each head, which feeds its output layer
+        last_layer = np.zeros((self.num_heads, self.max_depth), dtype=np.float32)
+        for k, depth in enumerate(depths):
+            last_layer[k, depth - 1] = 1.0
+        self.last_layer = tf.constant(last_layer)
+
+        def per_head(values):
+            return tf.constant(np.array(values, dtype=np.float32)[:, None, None])
+
+        self.is_swish = per_head(
+            [h["activation"] == "swish" for h in hyperparameters_list]
+        )
+        self.use_bn = per_head(
+            [h["use_batch_normalization"] for h in hyperparameters_list]
+        )
+        self.dropout_rate = per_head([h["dropout_rate"] for h in hyperparameters_list])
+        self.l1 = tf.constant([float(h["l1_weight"]) for h in hyperparameters_list])
+        self.l2 = tf.constant([float(h["l2_weight"]) for h in hyperparameters_list])
+
+        # Dense kernels initialized with glorot_uniform using the actual widths of each head
+        self.kernels, self.biases = [], []
+        self.out_kernels = []
+        self.gammas, self.betas, self.moving_means, self.moving_vars = [], [], [], []
+        for layer in range(self.max_depth):
+            fan_in = input_dim if layer == 0 else self.widths[layer - 1]
+            kernel = np.zeros((self.num_heads, fan_in, self.widths[layer]), np.float32)
+            out_kernel = np.zeros((self.num_heads, self.widths[layer], 1), np.float32)
+            for k, h in enumerate(hyperparameters_list):
+                if depths[k] <= layer:
+                    continue
+                n_in = (
+                    input_dim
+                    if layer == 0
+                    else int(h["num_neurons_per_layer"][layer - 1])
+                )
+                n_out = int(h["num_neurons_per_layer"][layer])
+                kernel[k, :n_in, :n_out] = glorot_uniform(
+                    n_in, n_out, (n_in, n_out), rng
+                )
+                if depths[k] == layer + 1:
+                    out_kernel[k, :n_out] = glorot_uniform(n_out, 1, (n_out, 1), rng)
+            self.kernels.append(tf.Variable(kernel))
+            self.biases.append(
+                tf.Variable(tf.zeros((self.num_heads, self.widths[layer])))
+            )
+            self.out_kernels.append(tf.Variable(out_kernel))
+            shape = (self.num_heads, self.widths[layer])
+            self.gammas.append(tf.Variable(tf.ones(shape)))
+            self.betas.append(tf.Variable(tf.zeros(shape)))
+            self.moving_means.append(tf.Variable(tf.zeros(shape), trainable=False))
+            self.moving_vars.append(tf.Variable(tf.ones(shape), trainable=False))
+        self.out_bias = tf.Variable(tf.zeros((self.num_heads, 1)))
+
+        self.trainable_variables = (
+            self.kernels
+            + self.biases
+            + self.out_kernels
+            + self.gammas
+            + self.betas
+            + [self.out_bias]
+        )
+        self.all_variables = (
+            self.trainable_variables + self.moving_means + self.moving_vars
+        )
+        # Adam slots, one learning rate per head
+        self.adam_m = [tf.Variable(tf.zeros_like(v)) for v in self.trainable_variables]
+        self.adam_v = [tf.Variable(tf.zeros_like(v)) for v in self.trainable_variables]
+        self.iterations = tf.Variable(0.0)
+        self.learning_rates = tf.Variable(
+            [float(h["learning_rate"]) for h in hyperparameters_list]
+        )
+        # heads that stopped (early stopping or pruning) are no longer updated
+        self.active = tf.Variable(tf.ones(self.num_heads))
+        # in-memory copies of the best weights of each head
+        self.best_variables = [tf.Variable(v) for v in self.all_variables]
+
+    def forward(self, x, training):
+        """
+        Return logits (K, B) and the per-head activity regularization (K,)
+        for a batch x (B, input_dim) shared by all heads.
+        """
+        batch_size = tf.cast(tf.shape(x)[0], tf.float32)
+        activity_penalty = tf.zeros(self.num_heads)
+        logits = tf.zeros((self.num_heads, tf.shape(x)[0]))
+        h = x
+        for layer in range(self.max_depth):
+            if layer == 0:
+                z = tf.einsum("bi,kio->kbo", h, self.kernels[layer])
+            else:
+                z = tf.einsum("kbi,kio->kbo", h, self.kernels[layer])
+            z = z + self.biases[layer][:, None, :]
+            a = self.is_swish * tf.nn.swish(z) + (1.0 - self.is_swish) * tf.nn.elu(z)
+            mask = self.unit_masks[layer][:, None, :]
+            a = a * mask
+            activity_penalty += (
+                self.l2 * tf.reduce_sum(tf.square(a), axis=[1, 2]) / batch_size
+            )
+            if layer > 0:
+                # as in build_model(): Dense -> BatchNormalization -> Dropout, except for the first layer
+                if training:
+                    mean, variance = tf.nn.moments(a, axes=[1])
+                    self.moving_means[layer].assign(
+                        BN_MOMENTUM * self.moving_means[layer]
+                        + (1.0 - BN_MOMENTUM) * mean
+                    )
+                    self.moving_vars[layer].assign(
+                        BN_MOMENTUM * self.moving_vars[layer]
+                        + (1.0 - BN_MOMENTUM) * variance
+                    )
+                else:
+                    mean, variance = self.moving_means[layer], self.moving_vars[layer]
+                normalized = (a - mean[:, None, :]) * tf.math.rsqrt(
+                    variance[:, None, :] + BN_EPSILON
+                )
+                normalized = (
+                    normalized * self.gammas[layer][:, None, :]
+                    + self.betas[layer][:, None, :]
+                )
+                a = self.use_bn * normalized + (1.0 - self.use_bn) * a
+                if training:
+                    keep = tf.cast(
+                        tf.random.uniform(tf.shape(a)) >= self.dropout_rate, tf.float32
+                    )
+                    a = a * keep / (1.0 - self.dropout_rate)
+                a = a * mask
+            # output layer applied on the last hidden layer of each head
+            out = tf.einsum("kbi,kio->kbo", a, self.out_kernels[layer])[:, :, 0]
+            logits += self.last_layer[:, layer : layer + 1] * out
+            h = a
+        logits += self.out_bias
+        activity_penalty += (
+            self.l2 * tf.reduce_sum(tf.square(tf.sigmoid(logits)), axis=1) / batch_size
+        )
+        return logits, activity_penalty
+
+    def weight_penalty(self):
+        """Kernel L1L2 and bias L2 regularization of each head, shape (K,)."""
+        penalty = tf.zeros(self.num_heads)
+        out_kernels = [
+            k * self.last_layer[:, layer, None, None]
+            for layer, k in enumerate(self.out_kernels)
+        ]
+        for kernel in self.kernels + out_kernels:
+            penalty += self.l1 * tf.reduce_sum(tf.abs(kernel), axis=[1, 2])
+            penalty += self.l2 * tf.reduce_sum(tf.square(kernel), axis=[1, 2])
+        for bias in self.biases + [self.out_bias]:
+            penalty += self.l2 * tf.reduce_sum(tf.square(bias), axis=1)
+        return penalty
+
+    def losses(self, x, y, sample_weight, training):
+        logits, activity_penalty = self.forward(x, training)
+        cross_entropy = tf.nn.sigmoid_cross_entropy_with_logits(
+            labels=tf.broadcast_to(y[None, :], tf.shape(logits)), logits=logits
+        )
+        # Keras reduction: sum over the batch divided by the batch size
+        cross_entropy = tf.reduce_mean(cross_entropy * sample_weight[None, :], axis=1)
+        return cross_entropy + activity_penalty + self.weight_penalty(), logits
+
+    def apply_adam(self, gradients):
+        self.iterations.assign_add(1.0)
+        t = self.iterations
+        scale = tf.sqrt(1.0 - ADAM_BETA_2**t) / (1.0 - ADAM_BETA_1**t)
+        head_lr = self.learning_rates * self.active * scale
+        for var, grad, m, v in zip(
+            self.trainable_variables, gradients, self.adam_m, self.adam_v
+        ):
+            m.assign(ADAM_BETA_1 * m + (1.0 - ADAM_BETA_1) * grad)
+            v.assign(ADAM_BETA_2 * v + (1.0 - ADAM_BETA_2) * tf.square(grad))
+            lr = tf.reshape(head_lr, [-1] + [1] * (len(var.shape) - 1))
+            var.assign_sub(lr * m / (tf.sqrt(v) + ADAM_EPSILON))
+
+    @tf.function
+    def train_step(self, x, y, sample_weight):
+        with tf.GradientTape() as tape:
+            losses, logits = self.losses(x, y, sample_weight, training=True)
+            # heads are independent, so the gradient of the sum is the gradient of each head
+            total_loss = tf.reduce_sum(losses * self.active)
+        # zero instead of None for unused variables (e.g. batch normalization of the first layer)
+        gradients = tape.gradient(
+            total_loss,
+            self.trainable_variables,
+            unconnected_gradients=tf.UnconnectedGradients.ZERO,
+        )
+        self.apply_adam(gradients)
+        return losses, logits
+
+    @tf.function
+    def test_step(self, x, y):
+        losses, logits = self.losses(x, y, tf.ones_like(y), training=False)
+        return losses, logits
+
+    def evaluate(self, X, y):
+        """Return per-head loss (K,) and logits (K, N) over the whole set."""
+        losses, logits = [], []
+        for start in range(0, len(y), PREDICT_BATCH_SIZE):
+            x_batch = np.asarray(
+                X[start : start + PREDICT_BATCH_SIZE], dtype=np.float32
+            )
+            y_batch = np.asarray(
+                y[start : start + PREDICT_BATCH_SIZE], dtype=np.float32
+            )
+            batch_losses, batch_logits = self.test_step(x_batch, y_batch)
+            losses.append(batch_losses.numpy() * len(y_batch))
+            logits.append(batch_logits.numpy())
+        return np.sum(losses, axis=0) / len(y), np.concatenate(logits, axis=1)
+
+    def copy_variables(self, heads, source, destination):
+        """Copy the weights of the heads in the boolean mask heads."""
+        heads = tf.constant(heads)
+        for src, dst in zip(source, destination):
+            mask = tf.reshape(heads, [-1] + [1] * (len(dst.shape) - 1))
+            dst.assign(tf.where(mask, src, dst))
+
+    def save_best_weights(self, heads):
+        self.copy_variables(heads, self.all_variables, self.best_variables)
+
+    def restore_best_weights(self, heads):
+        self.copy_variables(heads, self.best_variables, self.all_variables)
+
+    def set_keras_weights(self, k, model, use_best=True):
+        """
+        Copy the weights of head k into model, a Keras model created by
+        build_model() with the same hyperparameters.
+        """
+        variables = self.best_variables if use_best else self.all_variables
+        num_layers = self.max_depth
+        kernels = variables[0:num_layers]
+        biases = variables[num_layers : 2 * num_layers]
+        out_kernels = variables[2 * num_layers : 3 * num_layers]
+        gammas = variables[3 * num_layers : 4 * num_layers]
+        betas = variables[4 * num_layers : 5 * num_layers]
+        out_bias = variables[5 * num_layers]
+        moving_means = variables[5 * num_layers + 1 : 6 * num_layers + 1]
+        moving_vars = variables[6 * num_layers + 1 : 7 * num_layers + 1]
+
+        h = self.hyperparameters_list[k]
+        widths = [int(w) for w in h["num_neurons_per_layer"]]
+        dense_layers = [l for l in model.layers if isinstance(l, tf.keras.layers.Dense)]
+        bn_layers = [
+            l for l in model.layers if isinstance(l, tf.keras.layers.BatchNormalization)
+        ]
+        for layer in range(h["num_dense_layers"]):
+            n_in = kernels[layer].shape[1] if layer == 0 else widths[layer - 1]
+            dense_layers[layer].set_weights(
+                [
+                    kernels[layer][k, :n_in, : widths[layer]].numpy(),
+                    biases[layer][k, : widths[layer]].numpy(),
+                ]
+            )
+            if h["use_batch_normalization"] and layer > 0:
+                bn_layers[layer - 1].set_weights(
+                    [
+                        v[layer][k, : widths[layer]].numpy()
+                        for v in (gammas, betas, moving_means, moving_vars)
+                    ]
+                )
+        last = h["num_dense_layers"] - 1
+        dense_layers[-1].set_weights(
+            [out_kernels[last][k, : widths[last]].numpy(), out_bias[k].numpy()]
+        )
+
+
+def fit_population(
+    population,
+    trials,
+    train_data,
+    val_data,
+    batch_size,
+    epochs,
+    metric_to_monitor="val_accuracy",
+    class_weight=None,
+    fraction_function=None,
+    verbose=1,
+):
+    """
+    Train all heads of population on the same batches. Returns, per head,
+    the Keras-like history dictionary and whether the head was pruned.
+    With fraction_function (e.g. fidelity.get_fraction), each epoch only uses
+    the nested subset of the training set with fraction_function(epoch).
+    """
+    num_heads = population.num_heads
+    X_train = np.asarray(train_data[0], dtype=np.float32)
+    y_train = np.asarray(train_data[1], dtype=np.float32)
+    X_val, y_val = val_data[0], np.asarray(val_data[1])
+    sample_weight = np.ones_like(y_train)
+    if class_weight is not None:
+        sample_weight = np.where(y_train == 1, class_weight[1], class_weight[0]).astype(
+            np.float32
+        )
+
+    histories = [
+        {
+            key: []
+            for key in (
+                "loss",
+                "accuracy",
+                "auc",
+                "val_loss",
+                "val_accuracy",
+                "val_auc",
+                "lr",
+            )
+        }
+        for _ in range(num_heads)
+    ]
+    pruned = np.zeros(num_heads, dtype=bool)
+    stopped = np.zeros(num_heads, dtype=bool)
+    best_metric = np.full(num_heads, -np.inf)  # EarlyStopping and ModelCheckpoint
+    wait = np.zeros(num_heads, dtype=int)
+    plateau_best = np.full(num_heads, -np.inf)  # ReduceLROnPlateau
+    plateau_wait = np.zeros(num_heads, dtype=int)
+
+    for epoch in range(epochs):
+        active = ~(pruned | stopped)
+        population.active.assign(active.astype(np.float32))
+        if fraction_function is None:
+            permutation = np.random.permutation(len(y_train))
+        else:
+            fraction = fraction_function(epoch)
+            permutation = np.random.permutation(
+                nested_subset_indices(y_train, fraction)
+            )
+        steps_per_epoch = max(1, len(permutation) // batch_size)
+        train_losses = np.zeros(num_heads)
+        train_logits = []
+        for step in range(steps_per_epoch):
+            batch = permutation[step * batch_size : (step + 1) * batch_size]
+            losses, logits = population.train_step(
+                X_train[batch], y_train[batch], sample_weight[batch]
+            )
+            train_losses += losses.numpy()
+            train_logits.append(logits.numpy())
+        train_logits = np.concatenate(train_logits, axis=1)
+        y_seen = y_train[permutation[: steps_per_epoch * batch_size]]
+        val_losses, val_logits = population.evaluate(X_val, y_val)
+
+        learning_rates = population.learning_rates.numpy()
+        improved = np.zeros(num_heads, dtype=bool)
+        for k in np.flatnonzero(active):
+            history = histories[k]
+            history["loss"].append(train_losses[k] / steps_per_epoch)
+            history["accuracy"].append(np.mean((train_logits[k] > 0) == y_seen))
+            history["auc"].append(compute_auc(y_seen, train_logits[k]))
+            history["val_loss"].append(val_losses[k])
+            history["val_accuracy"].append(np.mean((val_logits[k] > 0) == y_val))
+            history["val_auc"].append(compute_auc(y_val, val_logits[k]))
+            history["lr"].append(learning_rates[k])
+            current = history[metric_to_monitor][-1]
+
+            # EarlyStopping and ModelCheckpoint(save_best_only=True)
+            wait[k] += 1
+            if current > best_metric[k]:
+                best_metric[k] = current
+                wait[k] = 0
+                improved[k] = True
+            if wait[k] >= EARLY_STOPPING_PATIENCE and epoch > 0:
+                stopped[k] = True
+
+            # ReduceLROnPlateau
+            if current > plateau_best[k] + REDUCE_LR_MIN_DELTA:
+                plateau_best[k] = current
+                plateau_wait[k] = 0
+            else:
+                plateau_wait[k] += 1
+                if plateau_wait[k] >= REDUCE_LR_PATIENCE:
+                    learning_rates[k] *= REDUCE_LR_FACTOR
+                    plateau_wait[k] = 0
+                    if verbose:
+                        print(
+                            "Trial {}: reducing learning rate to {}".format(
+                                trials[k].number, learning_rates[k]
+                            )
+                        )
+
+            # TFKerasPruningCallback
+            trials[k].report(float(current), step=epoch)
+            if trials[k].should_prune():
+                pruned[k] = True
+        population.learning_rates.assign(learning_rates)
+        population.save_best_weights(improved)
+
+        if verbose:
+            print(
+                "Epoch {}/{}: {} of {} heads active, best {} = {:.4f}".format(
+                    epoch + 1,
+                    epochs,
+                    np.sum(active),
+                    num_heads,
+                    metric_to_monitor,
+                    np.max(best_metric),
+                )
+            )
+        if np.all(pruned | stopped):
+            break
+
+    # EarlyStopping(restore_best_weights=True) restores heads that stopped early
+    population.restore_best_weights(stopped & ~pruned)
+    return histories, pruned
+
+
+def ask_population(study, population_size, suggest_function):
+    """
+    Ask the sampler for population_size trials that share the batch size of
+    the first one (the other hyperparameters are sampled as usual).
+    Returns the trials grouped by batch size: {batch_size: [(trial, hyperparameters)]}.
+    Usually there is a single group, unless another worker of the same study
+    took one of the enqueued trials. Trials that do not train a head (e.g. the
+    linear models) are returned with batch_size None.
+    """
+    first_trial = study.ask()
+    first_hyperparameters = suggest_function(first_trial)
+    batch_size = first_hyperparameters["batch_size"]
+    groups = {batch_size: [(first_trial, first_hyperparameters)]}
+    for _ in range(population_size - 1):
+        if batch_size is not None:
+            study.enqueue_trial({"batch_size": batch_size})
+        trial = study.ask()
+        hyperparameters = suggest_function(trial)
+        groups.setdefault(hyperparameters["batch_size"], []).append(
+            (trial, hyperparameters)
+        )
+    return groups
@@ -0,0 +1,350 @@
+"""
+Scores images with a trained model, in batches or as a local HTTP service.
+
+The training scripts are the only way to get predictions, and each run pays
+the load_model() of the saved best model. Here the model is loaded once and
+
+score_images()   scores a folder of JPEG files or the image_name column of a
+                 CSV file (e.g. test.csv) with a tf.data pipeline that
+                 decodes the images in parallel, in large batches, and
+                 writes image_name, score and prediction to a CSV file.
+MicroBatcher     collects the images of concurrent requests in a queue and
+                 runs the model on batches of up to max_batch_size images,
+                 waiting at most max_wait seconds after the first image of a
+                 batch, and keeps the latency of each request.
+
+With --serve, a ThreadingHTTPServer decodes each POST /predict (the body is
+the JPEG file) in its own thread and answers {"score": ..., "prediction": ...}.
+GET /stats returns the p50, p95 and p99 latencies in milliseconds, and the
+mean batch size.
+
+Usage (from the folder of the scripts):
+python predict.py --model ../outputs/<run>/best_model_<base_name> --input ../../data_ham1000/test.csv --images_dir ../../data_ham1000/HAM10000_images_part_1/
+python predict.py --model ../outputs/<run>/best_model_<base_name> --serve --port 8080
+curl --data-binary @ISIC_0024306.jpg http://localhost:8080/predict
+"""
+
+import argparse
+import collections
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import tensorflow_hub as hub
+from tensorflow.keras.models import load_model
+
+from binary_metrics import roc_auc
+from data_pipeline import AUTOTUNE, decode_and_resize, decode_image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+
+
+def load_trained_model(model_path):
+    # add custom_objects according to https://stackoverflow.com/questions/61814614/unknown-layer-keraslayer-when-i-try-to-load-model
+    start_time = time.time()
+    model = load_model(model_path, custom_objects={"KerasLayer": hub.KerasLayer})
+    print("Loaded", model_path, "in", round(time.time() - start_time, 3), "s")
+    return model
+
+
+def get_image_size(model, image_size=None):
+    """(height, width) of the model input, or image_size if it is not fixed."""
+    if image_size is not None:
+        return tuple(image_size)
+    height, width = model.input_shape[1:3]
+    if height is None or width is None:
+        raise ValueError(
+            "The model accepts any image size, choose it with --image_size"
+        )
+    return height, width
+
+
+def list_images(input_path, images_dir=None, x_col="image_name"):
+    """
+    Return a DataFrame with the image names of a CSV file (and its other
+    columns, e.g. target) or of the JPEG files of a folder, and the folder
+    of the images.
+    """
+    if os.path.isdir(input_path):
+        image_names = sorted(
+            name
+            for name in os.listdir(input_path)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        return pd.DataFrame({x_col: image_names}), input_path
+    dataframe = pd.read_csv(input_path, dtype=str)
+    return dataframe, images_dir or os.path.dirname(input_path)
+
+
+def make_image_dataset(file_names, image_size, batch_size):
+    """Batches of images rescaled to [0, 1], decoded in parallel."""
+    dataset = tf.data.Dataset.from_tensor_slices(file_names)
+    dataset = dataset.map(
+        lambda file_name: decode_and_resize(file_name, image_size),
+        num_parallel_calls=AUTOTUNE,
+    )
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(
+        lambda x: tf.cast(x, tf.float32) / 255.0, num_parallel_calls=AUTOTUNE
+    )
+    return dataset.prefetch(AUTOTUNE)
+
+
+def score_images(model, image_names, images_dir, image_size, batch_size=128):
+    """Scores of model for the images, in the order of image_names."""
+    file_names = [os.path.join(images_dir, name) for name in image_names]
+    dataset = make_image_dataset(file_names, image_size, batch_size)
+    start_time = time.time()
+    scores = model.predict(dataset, verbose=0).ravel()
+    seconds = time.time() - start_time
+    print(
+        "Scored",
+        len(scores),
+        "images in",
+        round(seconds, 3),
+        "s (",
+        round(len(scores) / max(seconds, 1e-9), 1),
+        "images/s)",
+    )
+    return scores
+
+
+def write_scores(output_file, dataframe, scores, threshold=0.5, x_col="image_name"):
+    results = pd.DataFrame(
+        {
+            x_col: dataframe[x_col],
+            "score": scores,
+            "prediction": (scores > threshold).astype(int),
+        }
+    )
+    tmp_file = output_file + ".tmp"
+    results.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, output_file)
+    print("Wrote", output_file)
+
+
+def get_percentiles(latencies, percentiles=(50, 95, 99)):
+    """Dictionary p50, p95, ... of latencies in seconds, in milliseconds."""
+    if len(latencies) == 0:
+        return {"p" + str(p): None for p in percentiles}
+    values = np.percentile(np.asarray(latencies) * 1000.0, percentiles)
+    return {"p" + str(p): float(value) for p, value in zip(percentiles, values)}
+
+
+class MicroBatcher:
+    """
+    Run predict_function on batches of the images given to predict() by
+    concurrent threads.
+    """
+
+    def __init__(
+        self, predict_function, max_batch_size=32, max_wait=0.01, history=10000
+    ):
+        self.predict_function = predict_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        # latest values only, such that a long running server keeps bounded memory
+        self.latencies = collections.deque(maxlen=history)
+        self.batch_sizes = collections.deque(maxlen=history)
+        self.num_requests = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def predict(self, image):
+        """Score of one image (float32 in [0, 1]), blocks until its batch ran."""
+        request = {
+            "image": image,
+            "start": time.perf_counter(),
+            "done": threading.Event(),
+        }
+        self.requests.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["score"]
+
+    def get_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            try:
+                images = np.stack([request["image"] for request in batch])
+                scores = np.asarray(self.predict_function(images)).ravel()
+                for request, score in zip(batch, scores):
+                    request["score"] = float(score)
+            except Exception as error:
+                for request in batch:
+                    request["error"] = error
+            end = time.perf_counter()
+            with self.lock:
+                self.batch_sizes.append(len(batch))
+                self.num_requests += len(batch)
+                for request in batch:
+                    self.latencies.append(end - request["start"])
+            for request in batch:
+                request["done"].set()
+
+    def get_report(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            batch_sizes = list(self.batch_sizes)
+            num_requests = self.num_requests
+        report = get_percentiles(latencies)
+        report["num_requests"] = num_requests
+        report["mean_batch_size"] = (
+            float(np.mean(batch_sizes)) if len(batch_sizes) > 0 else None
+        )
+        return report
+
+
+def make_predict_function(model):
+    @tf.function(reduce_retracing=True)
+    def predict_function(images):
+        return model(images, training=False)
+
+    return lambda images: predict_function(tf.convert_to_tensor(images)).numpy()
+
+
+def make_handler(batcher, image_size, threshold=0.5):
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, content):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self.send_json(200, batcher.get_report())
+            else:
+                self.send_json(404, {"error": "use POST /predict or GET /stats"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.send_json(404, {"error": "use POST /predict or GET /stats"})
+                return
+            contents = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                # decoded in the thread of the request, in parallel with other requests
+                image = decode_image(tf.constant(contents), image_size)
+            except (tf.errors.InvalidArgumentError, ValueError) as error:
+                self.send_json(
+                    400, {"error": "could not decode the image: " + str(error)}
+                )
+                return
+            score = batcher.predict(image.numpy().astype(np.float32) / 255.0)
+            self.send_json(200, {"score": score, "prediction": int(score > threshold)})
+
+        def log_message(self, format, *args):
+            pass  # one line per request would flood the console
+
+    return PredictionHandler
+
+
+def serve(
+    model, image_size, port=8080, max_batch_size=32, max_wait=0.01, threshold=0.5
+):
+    batcher = MicroBatcher(make_predict_function(model), max_batch_size, max_wait)
+    # compile the model function before the first request
+    batcher.predict(np.zeros(tuple(image_size) + (3,), dtype=np.float32))
+    server = ThreadingHTTPServer(
+        ("", port), make_handler(batcher, image_size, threshold)
+    )
+    print("Serving on port", port, "(POST /predict, GET /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("Latencies (ms) and batch sizes:", batcher.get_report())
+
+
+if __name__ == "__main__":
+    print("=====================================")
+    print("Inference with a trained model")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model", type=str, required=True, help="Saved model, e.g. best_model_<name>"
+    )
+    parser.add_argument(
+        "--input", type=str, help="Folder of JPEG files or CSV file with image_name"
+    )
+    parser.add_argument(
+        "--images_dir", type=str, default=None, help="Folder of the images of a CSV"
+    )
+    parser.add_argument(
+        "--output", type=str, default="scores.csv", help="CSV file with the scores"
+    )
+    parser.add_argument(
+        "--image_size",
+        type=int,
+        nargs=2,
+        default=None,
+        help="Height and width, if the model does not fix them",
+    )
+    parser.add_argument("--batch_size", type=int, default=128, help="Batch size")
+    parser.add_argument(
+        "--threshold", type=float, default=0.5, help="Positive if above"
+    )
+    parser.add_argument("--serve", action="store_true", help="Start the HTTP service")
+    parser.add_argument("--port", type=int, default=8080, help="Port of the service")
+    parser.add_argument(
+        "--max_batch_size", type=int, default=32, help="Largest batch of the service"
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=10.0,
+        help="Longest wait for a batch to fill, in milliseconds",
+    )
+    args = parser.parse_args()
+
+    model = load_trained_model(args.model)
+    image_size = get_image_size(model, args.image_size)
+    if args.input is not None:
+        dataframe, images_dir = list_images(args.input, args.images_dir)
+        scores = score_images(
+            model,
+            dataframe["image_name"].tolist(),
+            images_dir,
+            image_size,
+            args.batch_size,
+        )
+        write_scores(args.output, dataframe, scores, args.threshold)
+        if "target" in dataframe:
+            labels = dataframe["target"].astype(int).to_numpy()
+            print("AUC:", roc_auc(labels, scores))
+            print("Accuracy:", np.mean((scores > args.threshold) == (labels > 0.5)))
+    if args.serve:
+        serve(
+            model,
+            image_size,
+            args.port,
+            args.max_batch_size,
+            args.max_wait_ms / 1000.0,
+            args.threshold,
+        )
@@ -0,0 +1,287 @@
+"""
+Quantized CPU export of a trained model, with an accuracy and speed report.
+
+The saved models (best_model_<base_name>, optuna_best_model_<n>) are float32
+SavedModels, which are slow on the CPU inference nodes, especially with
+EfficientNetV2-XL at 512 pixels. export() converts a model into
+
+float32        TFLite model without quantization, as reference
+dynamic_range  TFLite model with int8 weights and float activations
+int8           TFLite model with int8 weights and activations, calibrated on
+               CALIBRATION_SIZE images sampled from train.csv (the input and
+               output stay float32, so the same pipeline feeds all models)
+
+and, with --onnx (needs tf2onnx and onnxruntime), the ONNX counterparts
+onnx_float32, onnx_dynamic_range and onnx_int8 (static quantization of
+onnxruntime with the same calibration images).
+
+report() scores validation.csv with the original model and each export, and
+keeps their AUC, accuracy, file size and images/second (model calls only, the
+decoding of the images is not timed). The model to ship is the fastest one
+whose AUC is at most --auc_tolerance below the AUC of the original model. The
+report is written to quantization_report.json in the output folder.
+
+Usage (from the folder of the scripts):
+python quantize.py --model ../outputs/<run>/best_model_<base_name> --output_dir ../outputs/<run>/quantized --auc_tolerance 0.005
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from binary_metrics import roc_auc
+from data_pipeline import make_dataset
+from predict import get_image_size, load_trained_model, make_image_dataset
+
+try:
+    import onnxruntime
+    import tf2onnx
+    from onnxruntime.quantization import QuantType, quantize_dynamic, quantize_static
+except ImportError:
+    onnxruntime = None  # only needed with --onnx
+
+CALIBRATION_SIZE = 200  # number of train.csv images used to calibrate int8
+TFLITE_MODES = ("float32", "dynamic_range", "int8")
+ONNX_MODES = ("onnx_float32", "onnx_dynamic_range", "onnx_int8")
+
+
+def get_calibration_images(
+    train_csv, images_dir, image_size, num_images=CALIBRATION_SIZE, seed=0
+):
+    """List of single image batches (float32 in [0, 1]) sampled from train_csv."""
+    dataframe = pd.read_csv(train_csv, dtype=str)
+    dataframe = dataframe.sample(min(num_images, len(dataframe)), random_state=seed)
+    file_names = [os.path.join(images_dir, name) for name in dataframe["image_name"]]
+    return [x.numpy() for x in make_image_dataset(file_names, image_size, 1)]
+
+
+def export_tflite(model, output_file, mode, calibration_images=None):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if mode != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == "int8":
+        converter.representative_dataset = lambda: ([x] for x in calibration_images)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    tflite_model = converter.convert()
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(tflite_model)
+    os.replace(tmp_file, output_file)
+
+
+class CalibrationReader:
+    """Calibration images in the format of onnxruntime.quantization."""
+
+    def __init__(self, input_name, calibration_images):
+        self.inputs = iter([{input_name: x} for x in calibration_images])
+
+    def get_next(self):
+        return next(self.inputs, None)
+
+
+def export_onnx(model, output_file, mode, calibration_images=None):
+    if onnxruntime is None:
+        raise ImportError("The ONNX export needs tf2onnx and onnxruntime")
+    float_file = output_file if mode == "onnx_float32" else output_file + ".float32"
+    input_signature = [
+        tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name="image")
+    ]
+    tf2onnx.convert.from_keras(model, input_signature, output_path=float_file)
+    if mode == "onnx_dynamic_range":
+        quantize_dynamic(float_file, output_file, weight_type=QuantType.QInt8)
+    elif mode == "onnx_int8":
+        reader = CalibrationReader("image", calibration_images)
+        quantize_static(float_file, output_file, reader)
+    if float_file != output_file:
+        os.remove(float_file)
+
+
+def export(model, output_dir, modes, calibration_images=None):
+    """Export model in each mode, return a dictionary mode -> file."""
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    files = {}
+    for mode in modes:
+        start_time = time.time()
+        if mode in ONNX_MODES:
+            files[mode] = os.path.join(output_dir, mode + ".onnx")
+            export_onnx(model, files[mode], mode, calibration_images)
+        else:
+            files[mode] = os.path.join(output_dir, mode + ".tflite")
+            export_tflite(model, files[mode], mode, calibration_images)
+        print("Exported", files[mode], "in", round(time.time() - start_time, 1), "s")
+    return files
+
+
+def make_tflite_function(model_file, num_threads=None):
+    """Function that maps a batch of images to the scores of a TFLite model."""
+    interpreter = tf.lite.Interpreter(model_path=model_file, num_threads=num_threads)
+    input_index = interpreter.get_input_details()[0]["index"]
+    output_index = interpreter.get_output_details()[0]["index"]
+    batch_shape = [None]
+
+    def predict_function(images):
+        if list(images.shape) != batch_shape[0]:
+            # the batch size changes only for the last batch
+            interpreter.resize_tensor_input(input_index, images.shape)
+            interpreter.allocate_tensors()
+            batch_shape[0] = list(images.shape)
+        interpreter.set_tensor(input_index, images.astype(np.float32))
+        interpreter.invoke()
+        return interpreter.get_tensor(output_index)
+
+    return predict_function
+
+
+def make_onnx_function(model_file, num_threads=None):
+    options = onnxruntime.SessionOptions()
+    if num_threads is not None:
+        options.intra_op_num_threads = num_threads
+    session = onnxruntime.InferenceSession(
+        model_file, options, providers=["CPUExecutionProvider"]
+    )
+    input_name = session.get_inputs()[0].name
+    return lambda images: session.run(None, {input_name: images.astype(np.float32)})[0]
+
+
+def make_keras_function(model):
+    @tf.function(reduce_retracing=True)
+    def predict_function(images):
+        return model(images, training=False)
+
+    return lambda images: predict_function(tf.convert_to_tensor(images)).numpy()
+
+
+def evaluate(predict_function, dataset, threshold=0.5):
+    """AUC, accuracy and images/second of predict_function on dataset."""
+    scores, labels = [], []
+    seconds = 0.0
+    for x, _ in dataset.take(1):
+        predict_function(x.numpy())  # tracing and memory allocation are not timed
+    for x, y in dataset:
+        start_time = time.perf_counter()
+        scores.append(np.asarray(predict_function(x.numpy())).ravel())
+        seconds += time.perf_counter() - start_time
+        labels.append(y.numpy().ravel())
+    scores = np.concatenate(scores)
+    labels = np.concatenate(labels)
+    return {
+        "auc": roc_auc(labels, scores),
+        "accuracy": float(np.mean((scores > threshold) == (labels > 0.5))),
+        "images_per_second": len(scores) / max(seconds, 1e-9),
+    }
+
+
+def report(model, files, dataset, auc_tolerance=0.005, num_threads=None):
+    """
+    Evaluate the original model and the exported files on dataset, and
+    return the results with the name of the fastest model within
+    auc_tolerance of the original AUC.
+    """
+    results = {"original": evaluate(make_keras_function(model), dataset)}
+    for mode, model_file in files.items():
+        if mode in ONNX_MODES:
+            predict_function = make_onnx_function(model_file, num_threads)
+        else:
+            predict_function = make_tflite_function(model_file, num_threads)
+        results[mode] = evaluate(predict_function, dataset)
+        results[mode]["file"] = model_file
+        results[mode]["megabytes"] = os.path.getsize(model_file) / 1e6
+    for name, result in results.items():
+        result["speedup"] = (
+            result["images_per_second"] / results["original"]["images_per_second"]
+        )
+        result["within_tolerance"] = (
+            result["auc"] >= results["original"]["auc"] - auc_tolerance
+        )
+        print(
+            name,
+            "AUC",
+            round(result["auc"], 4),
+            "accuracy",
+            round(result["accuracy"], 4),
+            "images/s",
+            round(result["images_per_second"], 1),
+            "speedup",
+            round(result["speedup"], 2),
+        )
+    candidates = [name for name in results if results[name]["within_tolerance"]]
+    best = max(candidates, key=lambda name: results[name]["images_per_second"])
+    print("Fastest model within an AUC tolerance of", auc_tolerance, ":", best)
+    return {"auc_tolerance": auc_tolerance, "best": best, "results": results}
+
+
+if __name__ == "__main__":
+    print("=====================================")
+    print("Quantized export of a trained model")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model", type=str, required=True, help="Saved model, e.g. best_model_<name>"
+    )
+    parser.add_argument(
+        "--output_dir", type=str, default="quantized", help="Folder of the exports"
+    )
+    parser.add_argument("--train_csv", type=str, default="../../data_ham1000/train.csv")
+    parser.add_argument(
+        "--validation_csv", type=str, default="../../data_ham1000/validation.csv"
+    )
+    parser.add_argument(
+        "--images_dir", type=str, default="../../data_ham1000/HAM10000_images_part_1/"
+    )
+    parser.add_argument(
+        "--image_size",
+        type=int,
+        nargs=2,
+        default=None,
+        help="Height and width, if the model does not fix them",
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="*",
+        default=list(TFLITE_MODES),
+        help="Exports among " + ", ".join(TFLITE_MODES + ONNX_MODES),
+    )
+    parser.add_argument(
+        "--onnx", action="store_true", help="Add the ONNX exports to --modes"
+    )
+    parser.add_argument(
+        "--calibration_size", type=int, default=CALIBRATION_SIZE, help="int8 images"
+    )
+    parser.add_argument(
+        "--auc_tolerance", type=float, default=0.005, help="Largest AUC loss to ship"
+    )
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size")
+    parser.add_argument(
+        "--num_threads", type=int, default=None, help="Threads of the CPU runtimes"
+    )
+    args = parser.parse_args()
+
+    modes = list(args.modes) + (list(ONNX_MODES) if args.onnx else [])
+    model = load_trained_model(args.model)
+    image_size = get_image_size(model, args.image_size)
+    calibration_images = None
+    if "int8" in modes or "onnx_int8" in modes:
+        calibration_images = get_calibration_images(
+            args.train_csv, args.images_dir, image_size, args.calibration_size
+        )
+    files = export(model, args.output_dir, modes, calibration_images)
+
+    validationdf = pd.read_csv(args.validation_csv, dtype=str)
+    validation_dataset = make_dataset(
+        validationdf, args.images_dir, image_size, args.batch_size, shuffle=False
+    )
+    quantization_report = report(
+        model, files, validation_dataset, args.auc_tolerance, args.num_threads
+    )
+    report_file = os.path.join(args.output_dir, "quantization_report.json")
+    tmp_file = report_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(quantization_report, f, indent=2)
+    os.replace(tmp_file, report_file)
+    print("Wrote", report_file)
@@ -0,0 +1,214 @@
+"""
+Run log of the trained models in one sqlite file.
+
+Each trial used to write a trainHistoryDict.pickle file into its own model
+folder, so comparing the trials of a study meant opening one pickle per
+trial. log_run() appends the history of a trial to the tables of
+RUN_LOG_FILE, in long format, keyed by run (e.g. the study name) and trial:
+
+runs     one row per trial: state, objective value, start time, duration
+params   one row per hyperparameter (values stored as text)
+epochs   one row per epoch and metric (loss, val_auc, lr, epoch_time, ...)
+metrics  one row per scalar of the trial (test_accuracy, f1, ...)
+curves   one row per element of the arrays (roc_fpr, pr_recall, ...)
+
+Several workers can append at the same time (sqlite locks each write).
+Cross-trial analysis is then one query, e.g.
+read_table("epochs", "ID_10").pivot_table(index="trial", columns="epoch", values="value")
+or get_epoch_metric("val_auc", "ID_10").max(axis=1).
+
+The trainHistoryDict.pickle files already written can be imported with
+python run_log.py --import_dir ../../outputs/optuna_backend_outputs/id_10/ --run ID_10
+"""
+
+import argparse
+import os
+import pickle
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+RUN_LOG_FILE = "../../outputs/run_log.sqlite3"
+SQLITE_TIMEOUT = 60  # seconds a worker waits for the sqlite lock
+
+TABLES = {
+    "runs": "run TEXT, trial INTEGER, state TEXT, value REAL, start_time REAL, duration REAL",
+    "params": "run TEXT, trial INTEGER, name TEXT, value TEXT",
+    "epochs": "run TEXT, trial INTEGER, epoch INTEGER, name TEXT, value REAL",
+    "metrics": "run TEXT, trial INTEGER, name TEXT, value REAL",
+    "curves": "run TEXT, trial INTEGER, name TEXT, idx INTEGER, value REAL",
+}
+
+
+def connect(file_name=RUN_LOG_FILE):
+    folder = os.path.dirname(file_name)
+    if folder != "" and not os.path.exists(folder):
+        os.makedirs(folder)
+    connection = sqlite3.connect(file_name, timeout=SQLITE_TIMEOUT)
+    # readers do not block the writers
+    connection.execute("PRAGMA journal_mode=WAL")
+    for table, columns in TABLES.items():
+        connection.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(table, columns))
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS {0}_run ON {0} (run, trial)".format(table)
+        )
+    return connection
+
+
+def split_history(history):
+    """
+    Split a Keras-like history dictionary into per-epoch lists, scalars and
+    arrays (e.g. the ROC curve added by single_model_train_test.py). None
+    scalars (e.g. backbone_load_time without a backbone) are kept and logged
+    as NULL, other scalars that are not numbers are skipped.
+    """
+    epochs, scalars, arrays = {}, {}, {}
+    for name, values in history.items():
+        if isinstance(values, list):
+            epochs[name] = values
+        elif values is None or (np.ndim(values) == 0 and is_number(values)):
+            scalars[name] = values
+        elif np.ndim(values) == 0:
+            continue
+        else:
+            arrays[name] = np.asarray(values).ravel()
+    return epochs, scalars, arrays
+
+
+def is_number(value):
+    if isinstance(value, (str, bytes)):
+        return False
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def to_real(value):
+    """float(value), or None (NULL) for None."""
+    return None if value is None else float(value)
+
+
+def log_run(
+    run,
+    trial,
+    history,
+    params=None,
+    value=None,
+    state="COMPLETE",
+    start_time=None,
+    duration=None,
+    file_name=RUN_LOG_FILE,
+):
+    """
+    Append the history of a trained model (trial is the Optuna trial number,
+    or -1 outside of a study) to the run log, in one transaction.
+    """
+    epochs, scalars, arrays = split_history(history)
+    rows = {
+        "runs": [
+            (
+                run,
+                trial,
+                state,
+                to_real(value),
+                start_time,
+                duration,
+            )
+        ],
+        "params": [(run, trial, name, str(v)) for name, v in (params or {}).items()],
+        "epochs": [
+            (run, trial, epoch, name, to_real(v))
+            for name, values in epochs.items()
+            for epoch, v in enumerate(values)
+        ],
+        "metrics": [(run, trial, name, to_real(v)) for name, v in scalars.items()],
+        "curves": [
+            (run, trial, name, idx, float(v))
+            for name, values in arrays.items()
+            for idx, v in enumerate(values)
+        ],
+    }
+    connection = connect(file_name)
+    with connection:  # commits, or rolls back on error
+        for table, table_rows in rows.items():
+            if len(table_rows) == 0:
+                continue
+            placeholders = ", ".join(["?"] * len(table_rows[0]))
+            connection.executemany(
+                "INSERT INTO {} VALUES ({})".format(table, placeholders), table_rows
+            )
+    connection.close()
+
+
+def read_table(table, run=None, file_name=RUN_LOG_FILE):
+    """Return a table of the run log as a DataFrame, optionally of one run."""
+    connection = connect(file_name)
+    if run is None:
+        df = pd.read_sql_query("SELECT * FROM " + table, connection)
+    else:
+        df = pd.read_sql_query(
+            "SELECT * FROM " + table + " WHERE run = ?", connection, params=(run,)
+        )
+    connection.close()
+    return df
+
+
+def get_epoch_metric(name, run, file_name=RUN_LOG_FILE):
+    """DataFrame trials x epochs with the values of one per-epoch metric."""
+    df = read_table("epochs", run, file_name)
+    df = df[df["name"] == name]
+    return df.pivot_table(index="trial", columns="epoch", values="value")
+
+
+class EpochTimer(tf.keras.callbacks.Callback):
+    """Add the duration of each epoch (in seconds) to the logs, as "epoch_time"."""
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start_time = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None:
+            logs["epoch_time"] = time.time() - self.start_time
+
+
+def import_pickles(folder, run, file_name=RUN_LOG_FILE):
+    """
+    Append the trainHistoryDict.pickle files found in the optuna_best_model_<n>
+    subfolders of folder to the run log.
+    """
+    for name in sorted(os.listdir(folder)):
+        pickle_file_path = os.path.join(folder, name, "trainHistoryDict.pickle")
+        if not os.path.exists(pickle_file_path):
+            continue
+        trial = name.split("_")[-1]
+        trial = int(trial) if trial.isdigit() else -1
+        with open(pickle_file_path, "rb") as file_pi:
+            history = pickle.load(file_pi)
+        log_run(run, trial, history, state="IMPORTED", file_name=file_name)
+        print("Imported", pickle_file_path)
+
+
+if __name__ == "__main__":
+    print("=====================================")
+    print("Import trainHistoryDict.pickle files into the run log")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--import_dir",
+        type=str,
+        required=True,
+        help="Folder with optuna_best_model_<n> subfolders",
+    )
+    parser.add_argument(
+        "--run", type=str, required=True, help="Run name, e.g. the study name"
+    )
+    parser.add_argument(
+        "--run_log", type=str, default=RUN_LOG_FILE, help="sqlite file of the run log"
+    )
+    args = parser.parse_args()
+    import_pickles(args.import_dir, args.run, args.run_log)
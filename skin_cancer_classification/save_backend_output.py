@@ -4,7 +4,7 @@ Find models at https://tfhub.dev/google/collections/efficientnet_v2/1
 '''
 
 # from math import exp
-# import tensorflow as tf
+import tensorflow as tf
 import tensorflow_hub as hub
 from tensorflow.keras.models import Sequential
 # import tensorflow_hub as hub
@@ -20,6 +20,7 @@ import os
 import sys
 import shutil
 import pickle
+import time
 #import argparse
 import pandas as pd
 # from tensorflow.keras.applications.resnet import ResNet152, preprocess_input
@@ -33,6 +34,17 @@ import pandas as pd
 
 # from keras.models import Sequential
 
+try:
+    import resource  # peak memory of this process (not available on Windows)
+except ImportError:
+    resource = None
+
+from backbone_registry import load_backbone
+from class_sampling import decrease_num_negatives
+from data_pipeline import get_datasets
+from feature_store import write_split
+from image_cache import flow_from_cache
+
 # To avoid the warning in
 # https://github.com/tensorflow/tensorflow/issues/47554
 from absl import logging
@@ -59,15 +71,13 @@ TRAIN_FOLDER = '../../data_ham1000/HAM10000_images_part_1'
 NUM_TRAIN_EXAMPLES = 5589  # maximum is 5589 given current training set
 # NUM_DESIRED_NEGATIVE_TRAINING_EXAMPLES = 3754  # maximum is 3754 given current training set
 
-# Choose the model
+# Choose the model (resolved by backbone_registry.py, which has the TF Hub URLs)
 if True:
     # Model with 7 M parameters
-    MODEL_URL = 'https://tfhub.dev/google/imagenet/efficientnet_v2_imagenet1k_b1/feature_vector/2'
     MODEL_NAME = 'efficientnet_v2_imagenet1k_b1'
     NUM_PIXELS = 240
 else:
     # Model with 200 M parameters
-    MODEL_URL = 'https://tfhub.dev/google/imagenet/efficientnet_v2_imagenet21k_ft1k_xl/feature_vector/2'
     MODEL_NAME = 'efficientnet_v2_imagenet21k_ft1k_xl'
     NUM_PIXELS = 512 # Define the input shape of the images
 
@@ -78,24 +88,79 @@ if not os.path.exists(OUTPUT_DIR):
     os.makedirs(OUTPUT_DIR)
     print("Created folder ", OUTPUT_DIR)
 VERBOSITY_LEVEL = 1  # use 1 to see the progress bar when training and testing
+USE_IMAGE_CACHE = True  # read decoded images from image_cache.py instead of decoding JPEGs
+USE_TF_DATA = True  # use the parallel tf.data pipeline of data_pipeline.py instead of Python generators
+BATCH_SIZE = None  # use None to probe the fastest batch size with find_best_batch_size()
+MAX_BATCH_SIZE = 256  # largest batch size tried by the probe
+MEMORY_LIMIT_MB = 8000  # the probe does not try batch sizes beyond this peak memory
+SAVE_PICKLE_FILES = False  # also write the old train.pickle, test.pickle and validation.pickle files
 IMAGESIZE = (NUM_PIXELS, NUM_PIXELS)      # Define the input shape of the images
 INPUTSHAPE = (NUM_PIXELS, NUM_PIXELS, 3)  # NN input
 
 
+def get_peak_memory_mb():
+    if resource is None:
+        return 0
+    # ru_maxrss is given in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def find_best_batch_size(model, max_batch_size=MAX_BATCH_SIZE, memory_limit_mb=MEMORY_LIMIT_MB, num_repetitions=3):
+    '''
+    Measure images/second of model.predict_on_batch for batch sizes 1, 2, 4, ...
+    and return the fastest one. Stops when the peak memory of the process exceeds
+    memory_limit_mb or when doubling the batch size makes throughput drop.
+    '''
+    best_batch_size, best_throughput = 1, 0.0
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        x = np.random.rand(batch_size, *INPUTSHAPE).astype(np.float32)
+        try:
+            model.predict_on_batch(x)  # warm up: first call traces the graph
+            start_time = time.perf_counter()
+            for _ in range(num_repetitions):
+                model.predict_on_batch(x)
+            elapsed_time = time.perf_counter() - start_time
+        except (MemoryError, tf.errors.ResourceExhaustedError):
+            print("Batch size", batch_size, "does not fit in memory")
+            break
+        throughput = num_repetitions * batch_size / elapsed_time
+        peak_memory_mb = get_peak_memory_mb()
+        print("Batch size {}: {:.1f} images/second, peak memory {:.0f} MB".format(batch_size, throughput, peak_memory_mb))
+        if peak_memory_mb > memory_limit_mb:
+            print("Peak memory exceeds", memory_limit_mb, "MB")
+            break
+        if throughput > best_throughput:
+            best_batch_size, best_throughput = batch_size, throughput
+        elif throughput < 0.9 * best_throughput:
+            break  # larger batches are only getting slower
+        batch_size *= 2
+    print("Chose batch size", best_batch_size, "with {:.1f} images/second".format(best_throughput))
+    return best_batch_size
+
+
 def save_outputs(model, generator, dataset_type):
     y_true = np.array(generator.classes)
+    start_time = time.perf_counter()
     X = model.predict(generator, verbose=VERBOSITY_LEVEL)
+    elapsed_time = time.perf_counter() - start_time
+    print("Processed {} images of {} set in {:.1f} seconds ({:.1f} images/second)".format(
+        len(y_true), dataset_type, elapsed_time, len(y_true) / elapsed_time))
 
     examples = (X, y_true)
 
     print("Shapes:")
     print(examples[0].shape, examples[1].shape)
 
-    # https://stackoverflow.com/questions/41061457/keras-how-to-save-the-training-history-attribute-of-the-history-object
-    pickle_file_path = os.path.join(OUTPUT_DIR, dataset_type + '.pickle')
-    with open(pickle_file_path, 'wb') as file_pi:
-        pickle.dump(examples, file_pi)
-    print("Wrote", pickle_file_path)
+    # memory-mappable .npy arrays and a JSON manifest, see feature_store.py
+    write_split(OUTPUT_DIR, dataset_type, X, y_true, generator.filenames, MODEL_NAME, NUM_PIXELS)
+
+    if SAVE_PICKLE_FILES:
+        # https://stackoverflow.com/questions/41061457/keras-how-to-save-the-training-history-attribute-of-the-history-object
+        pickle_file_path = os.path.join(OUTPUT_DIR, dataset_type + '.pickle')
+        with open(pickle_file_path, 'wb') as file_pi:
+            pickle.dump(examples, file_pi)
+        print("Wrote", pickle_file_path)
 
 
 def get_all_jpg_files_under_folder(root_folder):
@@ -167,6 +232,19 @@ def get_data_generators_from_dataframe(batch_size):
         print('validation:')
         print(validationdf['target'].value_counts())
 
+    if USE_TF_DATA:
+        # parallel decode, resize and rescale, prefetching batches while the backend runs
+        # (no shuffling: the order must match generator.classes)
+        return get_datasets(traindf, testdf, validationdf, train_folder, IMAGESIZE, batch_size,
+                            shuffle=False, use_image_cache=USE_IMAGE_CACHE)
+
+    if USE_IMAGE_CACHE:
+        # decode each JPEG only once per image size, and read it from memory-mapped shards afterwards
+        train_generator = flow_from_cache(traindf, train_folder, IMAGESIZE, batch_size, shuffle=False)
+        validation_generator = flow_from_cache(validationdf, validation_folder, IMAGESIZE, batch_size, shuffle=False)
+        test_generator = flow_from_cache(testdf, test_folder, IMAGESIZE, batch_size, shuffle=False)
+        return train_generator, validation_generator, test_generator
+
     train_datagen = ImageDataGenerator(rescale=1./255)
 
     train_generator = train_datagen.flow_from_dataframe(
@@ -220,56 +298,29 @@ def save_best_model_callback(study, trial):
 
 
 def save_backend_outputs():
-    batch_size = 1
-    train_generator, validation_generator, test_generator = get_data_generators_from_dataframe(batch_size)
-
     # Define the CNN model
     model = Sequential()
 
     #Find models at https://tfhub.dev/google/collections/efficientnet_v2/1
     # Load the respective EfficientNet model but exclude the classification layers
     trainable = False
-    model_url = MODEL_URL
-    extractor = hub.KerasLayer(model_url, input_shape=INPUTSHAPE, trainable=trainable)
+    # local copy of the registry if fetched, and prints the load time, see backbone_registry.py
+    extractor = load_backbone(MODEL_NAME, INPUTSHAPE, trainable=trainable)
 
     model.add(extractor)
 
     model.summary()
+
+    batch_size = BATCH_SIZE
+    if batch_size is None:
+        batch_size = find_best_batch_size(model)
+    train_generator, validation_generator, test_generator = get_data_generators_from_dataframe(batch_size)
+
     save_outputs(model, train_generator, "train")
     save_outputs(model, test_generator, "test")
     save_outputs(model, validation_generator, "validation")
 
 
-def decrease_num_negatives_and_positives(df, desired_num_negative_examples):
-    '''
-    Create dataframe with desired_num_rows rows from df
-    '''
-    shuffled_df = df.sample(frac=1).reset_index(drop=True)
-    neg_examples = shuffled_df[shuffled_df['target'] == '0'].copy()
-    neg_examples = neg_examples.head( round(desired_num_negative_examples) ).copy()
-
-    num_positive_examples = NUM_TRAIN_EXAMPLES - desired_num_negative_examples
-    pos_examples = shuffled_df[shuffled_df['target'] == '1'].copy()    
-    pos_examples = pos_examples.head( num_positive_examples ).copy()
-
-    newdf = pd.concat([neg_examples, pos_examples], ignore_index=True)
-    newdf = newdf.sample(frac=1).reset_index(drop=True) #shuffle again
-    return newdf
-
-def decrease_num_negatives(df, desired_num_negative_examples):
-    '''
-    Create dataframe with desired_num_rows rows from df
-    '''
-    shuffled_df = df.sample(frac=1).reset_index(drop=True)
-    neg_examples = shuffled_df[shuffled_df['target'] == '0'].copy()
-    neg_examples = neg_examples.head( round(desired_num_negative_examples) ).copy()
-
-    pos_examples = shuffled_df[shuffled_df['target'] == '1'].copy()    
-    newdf = pd.concat([neg_examples, pos_examples], ignore_index=True)
-    newdf = newdf.sample(frac=1).reset_index(drop=True) #shuffle again
-    return newdf
-
-
 if __name__ == '__main__':
     print("=====================================")
     print("Save backend outputs to files")
@@ -1,6 +1,7 @@
 """
 v6    
 Uses datagen.flow_from_dataframe instead of datagen.flow_from_directory
+The history (including AUC, ROC, etc) is appended to the run log of run_log.py instead of a pickle file.
 v5
 This version provides support to Resnet, and training some backend model layers
 From:
@@ -17,7 +18,6 @@ Aldebaro, 2023
 
 import argparse
 import os
-import pickle
 import shutil
 import sys
 
@@ -25,22 +25,12 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sn
-import sklearn.metrics
 import tensorflow as tf
 import tensorflow_hub as hub
 
 # To avoid the warning in
 # https://github.com/tensorflow/tensorflow/issues/47554
 from absl import logging
-from sklearn.metrics import (
-    auc,
-    confusion_matrix,
-    f1_score,
-    precision_recall_curve,
-    precision_score,
-    recall_score,
-    roc_curve,
-)
 from tensorflow.keras.applications.resnet import ResNet152, preprocess_input
 from tensorflow.keras.callbacks import (
     EarlyStopping,
@@ -63,6 +53,16 @@ from tensorflow.keras.models import Model, Sequential, load_model
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
 
+from backbone_registry import load_backbone
+from backbones import get_last_load_time
+from binary_metrics import BinaryMetrics
+from class_sampling import get_balanced_dataframe
+from activation_cache import get_activations, keep_full_model, split_frozen_layers
+from data_pipeline import get_datasets, make_dataset
+from evaluation import evaluate_test_set
+from image_cache import flow_from_cache
+from run_log import log_run
+
 logging.set_verbosity(logging.ERROR)
 
 
@@ -83,10 +83,12 @@ def get_training_model_xception(url, trainable=False):
     return model
 
 
-def get_training_model_resnet(trainable=False):
+def get_training_model_resnet(trainable=False, layer_num=None):
     # from https://www.apriorit.com/dev-blog/647-ai-applying-deep-learning-to-classify-skin-cancer-types
     # Download data from https://storage.googleapis.com/tensorflow/keras-applications/resnet/resnet152_weights_tf_dim_ordering_tf_kernels_notop.h5
-    base_model = ResNet152(weights="imagenet", include_top=False)
+    # or copy them with python backbone_registry.py --fetch resnet152
+    # (the layers are frozen below)
+    base_model = load_backbone("resnet152", trainable=True)
     x = base_model.output
     x = GlobalAveragePooling2D()(x)
     # x = Dense(1000, activation='relu')(x)
@@ -97,13 +99,12 @@ def get_training_model_resnet(trainable=False):
     for i, layer in enumerate(base_model.layers):
         print(i, layer.name)
 
-    if True:
+    if layer_num is None:
         # freeze all layers
         for layer in base_model.layers:
             layer.trainable = False
     else:
-        # freeze up to given layer
-        layer_num = 483
+        # freeze up to given layer, e.g. 483 keeps the conv5 block trainable
         for layer in base_model.layers[:layer_num]:
             layer.trainable = False
         for layer in base_model.layers[layer_num:]:
@@ -114,11 +115,9 @@ def get_training_model_resnet(trainable=False):
     return model
 
 
-def get_training_model_effnet(url, trainable=False):
+def get_training_model_effnet(name, trainable=False):
     # Load the respective EfficientNet model but exclude the classification layers
-    extractor = hub.KerasLayer(
-        url, input_shape=(img_size, img_size, 3), trainable=trainable
-    )
+    extractor = load_backbone(name, (img_size, img_size, 3), trainable=trainable)
 
     # Construct the head of the model that will be placed on top of the
     # the base model
@@ -223,38 +222,6 @@ def get_training_model_fixed():
     return model
 
 
-def decrease_num_negatives(df, desired_num_negative_examples):
-    """
-    Create dataframe with desired_num_rows rows from df
-    """
-    shuffled_df = df.sample(frac=1).reset_index(drop=True)
-    neg_examples = shuffled_df[shuffled_df["target"] == "0"].copy()
-    neg_examples = neg_examples.head(round(desired_num_negative_examples)).copy()
-
-    pos_examples = shuffled_df[shuffled_df["target"] == "1"].copy()
-    newdf = pd.concat([neg_examples, pos_examples], ignore_index=True)
-    newdf = newdf.sample(frac=1).reset_index(drop=True)  # shuffle again
-    return newdf
-
-
-def get_balanced_dataframe(
-    df, desired_num_negative_examples, desired_num_positive_examples
-):
-    """
-    Create dataframe with desired_num_rows rows from df
-    """
-    shuffled_df = df.sample(frac=1).reset_index(drop=True)
-    neg_examples = shuffled_df[shuffled_df["target"] == "0"].copy()
-    neg_examples = neg_examples.head(round(desired_num_negative_examples)).copy()
-
-    pos_examples = shuffled_df[shuffled_df["target"] == "1"].copy()
-    pos_examples = pos_examples.head(round(desired_num_positive_examples)).copy()
-
-    newdf = pd.concat([neg_examples, pos_examples], ignore_index=True)
-    newdf = newdf.sample(frac=1).reset_index(drop=True)  # shuffle again
-    return newdf
-
-
 def lr_scheduler(epoch, lr, epochs=50):
     """Decrease learning rate over epochs"""
     initial = 1e-3
@@ -300,12 +267,10 @@ if __name__ == "__main__":
     # Choose the model
     if True:
         # Model with 7 M parameters
-        MODEL_URL = "https://tfhub.dev/google/imagenet/efficientnet_v2_imagenet1k_b1/feature_vector/2"
         MODEL_NAME = "efficientnet_v2_imagenet1k_b1"
         NUM_PIXELS = 240
     else:
         # Model with 200 M parameters
-        MODEL_URL = "https://tfhub.dev/google/imagenet/efficientnet_v2_imagenet21k_ft1k_xl/feature_vector/2"
         MODEL_NAME = "efficientnet_v2_imagenet21k_ft1k_xl"
         NUM_PIXELS = 512  # Define the input shape of the images
 
@@ -393,58 +358,91 @@ if __name__ == "__main__":
     shutil.copy2(sys.argv[0], copied_script)
     print("Just copied current script as file", copied_script)
 
-    # model = get_training_model_effnet(model_url, trainable=False)
-    model = get_training_model_resnet(trainable=False)
+    # model = get_training_model_effnet(MODEL_NAME, trainable=False)
+    # None freezes all the ResNet152 layers, 483 fine-tunes the conv5 block
+    fine_tune_layer_num = None
+    model = get_training_model_resnet(trainable=False, layer_num=fine_tune_layer_num)
+    backbone_name = "resnet152"  # identifies the frozen layers in the activation cache
     # model = get_training_model_fixed()
     print("just got the model")
 
-    model.compile(
+    # the same loss, optimizer and metrics (with their names) for the layers
+    # trained on cached activations, see below
+    compile_arguments = dict(
         loss="binary_crossentropy",
         optimizer=Adam(learning_rate=0.005),
         metrics=["accuracy", tf.keras.metrics.AUC()],
     )
+    model.compile(**compile_arguments)
     # metrics=["accuracy"])
 
     model.summary()
 
-    train_datagen = ImageDataGenerator(rescale=1.0 / 255)
-
-    train_generator = train_datagen.flow_from_dataframe(
-        dataframe=traindf,
-        directory=train_folder,
-        x_col="image_name",
-        y_col="target",
-        target_size=image_size,
-        batch_size=batch_size,
-        class_mode="binary",
-        shuffle=True,
-    )
+    # read decoded images from image_cache.py instead of decoding JPEGs every epoch
+    use_image_cache = True
+    # use the parallel tf.data pipeline of data_pipeline.py instead of Python generators
+    use_tf_data = True
+    if use_tf_data:
+        train_generator, validation_generator, test_generator = get_datasets(
+            traindf,
+            testdf,
+            validationdf,
+            train_folder,
+            image_size,
+            batch_size,
+            shuffle=True,
+            cache=not use_image_cache,
+            use_image_cache=use_image_cache,
+        )
+    elif use_image_cache:
+        train_generator = flow_from_cache(
+            traindf, train_folder, image_size, batch_size, shuffle=True
+        )
+        validation_generator = flow_from_cache(
+            validationdf, validation_folder, image_size, batch_size, shuffle=True
+        )
+        test_generator = flow_from_cache(
+            testdf, test_folder, image_size, batch_size, shuffle=False
+        )
+    else:
+        train_datagen = ImageDataGenerator(rescale=1.0 / 255)
+
+        train_generator = train_datagen.flow_from_dataframe(
+            dataframe=traindf,
+            directory=train_folder,
+            x_col="image_name",
+            y_col="target",
+            target_size=image_size,
+            batch_size=batch_size,
+            class_mode="binary",
+            shuffle=True,
+        )
 
-    # Loading and preprocessing the training, validation, and test data
-    validation_datagen = ImageDataGenerator(rescale=1.0 / 255)
-    test_datagen = ImageDataGenerator(rescale=1.0 / 255)
-
-    validation_generator = validation_datagen.flow_from_dataframe(
-        dataframe=validationdf,
-        directory=validation_folder,
-        x_col="image_name",
-        y_col="target",
-        target_size=image_size,
-        batch_size=batch_size,
-        class_mode="binary",
-        shuffle=True,
-    )
+        # Loading and preprocessing the training, validation, and test data
+        validation_datagen = ImageDataGenerator(rescale=1.0 / 255)
+        test_datagen = ImageDataGenerator(rescale=1.0 / 255)
+
+        validation_generator = validation_datagen.flow_from_dataframe(
+            dataframe=validationdf,
+            directory=validation_folder,
+            x_col="image_name",
+            y_col="target",
+            target_size=image_size,
+            batch_size=batch_size,
+            class_mode="binary",
+            shuffle=True,
+        )
 
-    test_generator = test_datagen.flow_from_dataframe(
-        dataframe=testdf,
-        directory=test_folder,
-        x_col="image_name",
-        y_col="target",
-        target_size=image_size,
-        batch_size=batch_size,
-        class_mode="binary",
-        shuffle=True,
-    )
+        test_generator = test_datagen.flow_from_dataframe(
+            dataframe=testdf,
+            directory=test_folder,
+            x_col="image_name",
+            y_col="target",
+            target_size=image_size,
+            batch_size=batch_size,
+            class_mode="binary",
+            shuffle=False,
+        )
 
     # Count effective number of examples, to make sure
     # print(train_generator.classes)  # numpy array with all labels
@@ -504,14 +502,56 @@ if __name__ == "__main__":
         write_images=True,
     )
 
+    # run the frozen layers once per image and train only the layers after
+    # them, see activation_cache.py (there is no augmentation to lose: the
+    # images are only rescaled)
+    use_activation_cache = True
+    frozen_split = split_frozen_layers(model) if use_activation_cache else None
+
     # Training the model
-    history = model.fit(
-        train_generator,
-        steps_per_epoch=train_generator.samples // batch_size,
-        epochs=epochs,
-        validation_data=validation_generator,
-        callbacks=[early_stopping, mcp_save, reduce_lr, tensorboard],
-    )
+    callbacks = [early_stopping, mcp_save, reduce_lr, tensorboard]
+    if frozen_split is not None:
+        prefix_model, suffix_model = frozen_split
+        cache_name = backbone_name + "/" + prefix_model.layers[-1].name
+        (X_train, y_train), (X_validation, y_validation) = [
+            get_activations(
+                prefix_model,
+                cache_name,
+                image_size,
+                split,
+                dataframe["image_name"].tolist(),
+                dataframe["target"].astype(int).to_numpy(),
+                lambda dataframe=dataframe: make_dataset(
+                    dataframe,
+                    train_folder,
+                    image_size,
+                    batch_size,
+                    shuffle=False,
+                    use_image_cache=use_image_cache,
+                ),
+                dtype=np.float16,
+            )
+            for split, dataframe in (("train", traindf), ("validation", validationdf))
+        ]
+        print("Training on the activations of", cache_name, X_train.shape[1:])
+        suffix_model.compile(**compile_arguments)
+        history = suffix_model.fit(
+            X_train,
+            y_train,
+            batch_size=batch_size,
+            epochs=epochs,
+            validation_data=(X_validation, y_validation),
+            shuffle=True,
+            callbacks=keep_full_model(callbacks, model),
+        )
+    else:
+        history = model.fit(
+            train_generator,
+            steps_per_epoch=train_generator.samples // batch_size,
+            epochs=epochs,
+            validation_data=validation_generator,
+            callbacks=callbacks,
+        )
 
     # Save the last model
     # look at https://www.tensorflow.org/guide/keras/serialization_and_saving
@@ -526,15 +566,15 @@ if __name__ == "__main__":
     # add custom_objects according to https://stackoverflow.com/questions/61814614/unknown-layer-keraslayer-when-i-try-to-load-model
     model = load_model(best_model_name, custom_objects={"KerasLayer": hub.KerasLayer})
 
-    # Evaluating the best model on the test set
-    test_loss, test_accuracy, test_auc = model.evaluate(test_generator)
+    # Evaluating the best model on the test set, and generating the predictions
+    # (with the true labels of the same batches) in the same pass
+    test_loss, test_accuracy, test_auc, predictions, true_labels = evaluate_test_set(
+        model, test_generator
+    )
     print("Test loss:", test_loss)
     print("Test accuracy:", test_accuracy)
     print("Test AUC:", test_auc)
 
-    # Generate predictions --> labels: predicted and true
-    predictions = model.predict(test_generator)
-
     # defining the metrics
     train_loss = history.history["loss"]
     val_loss = history.history["val_loss"]
@@ -555,37 +595,29 @@ if __name__ == "__main__":
     # plt.title('Metrics - ' + title_id)
     plt.savefig(os.path.join(output_dir, metrics_name))
 
-    # Convert predictions into values 0 or 1
-    N = len(predictions)
-    pred_labels = np.zeros((N,))
+    # All metrics from a single sort of the predictions, see binary_metrics.py
     my_threshold = 0.5  # assume a threshold given predictions are in range [0, 1]
-    for i in range(N):
-        if predictions[i] > my_threshold:
-            pred_labels[i] = 1
-        else:
-            pred_labels[i] = 0
-    true_labels = test_generator.classes
+    test_metrics = BinaryMetrics.from_scores(true_labels, predictions)
 
-    true_labels = test_generator.classes
-
-    fpr, tpr, thresholds = roc_curve(true_labels, predictions, pos_label=1)
-    auc = auc(fpr, tpr)
+    fpr, tpr, thresholds = test_metrics.roc_curve()
+    auc = test_metrics.roc_auc()
     print("AUC:", auc)
 
-    recall = recall_score(true_labels, pred_labels)
-    f1 = f1_score(true_labels, pred_labels)
-    precis = precision_score(true_labels, pred_labels)
+    recall, precis, f1 = test_metrics.scores_at(my_threshold)
 
-    pr_precision, pr_recall, pr_thresholds = precision_recall_curve(
-        true_labels, predictions, pos_label=1
-    )
+    pr_precision, pr_recall, pr_thresholds = test_metrics.pr_curve()
+
+    best_f1_threshold, best_f1 = test_metrics.best_f1()
+    youden_threshold, youden_index = test_metrics.youden()
 
     print("Recall: ", recall)
     print("Precision: ", precis)
     print("F1-score: ", f1)
+    print("Best F1-score: ", best_f1, "with threshold", best_f1_threshold)
+    print("Youden index: ", youden_index, "with threshold", youden_threshold)
 
     # Compute confusion matrix
-    cm = confusion_matrix(true_labels, pred_labels)
+    cm = test_metrics.confusion_matrix(my_threshold)
 
     # Plot confusion matrix with Seaborn
     plt.figure()
@@ -601,6 +633,7 @@ if __name__ == "__main__":
 
     # add to history
     history.history["num_desired_train_examples"] = num_desired_train_examples
+    history.history["backbone_load_time"] = get_last_load_time()
     history.history["test_accuracy"] = test_accuracy
     history.history["test_loss"] = test_loss
     history.history["test_confusion_matrix"] = cm
@@ -614,11 +647,20 @@ if __name__ == "__main__":
     history.history["pr_precision"] = pr_precision
     history.history["pr_recall"] = pr_recall
     history.history["pr_thresholds"] = pr_thresholds
-
-    # https://stackoverflow.com/questions/41061457/keras-how-to-save-the-training-history-attribute-of-the-history-object
-    pickle_file_path = os.path.join(output_dir, "trainHistoryDict.pickle")
-    with open(pickle_file_path, "wb") as file_pi:
-        pickle.dump(history.history, file_pi)
+    history.history["best_f1"] = best_f1
+    history.history["best_f1_threshold"] = best_f1_threshold
+    history.history["youden_index"] = youden_index
+    history.history["youden_threshold"] = youden_threshold
+
+    # one run log for all models instead of a trainHistoryDict.pickle per output folder
+    params = {
+        "model_name": MODEL_NAME,
+        "image_size": image_size,
+        "batch_size": batch_size,
+        "epochs": epochs,
+    }
+    run_name = "train_test_id_" + str(simulation_ID) + "/" + base_name
+    log_run(run_name, -1, history.history, params, value=test_auc)
 
     # Write accuracies and losses to a text file
     file_name = "classification_output_" + base_name + ".txt"
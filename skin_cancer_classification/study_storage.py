@@ -0,0 +1,110 @@
+"""
+Storage of Optuna studies for many concurrent workers.
+
+With dozens of workers, the sqlite database serializes the writes and the
+workers wait on "database is locked" retries. The storage type is chosen
+with STORAGE_TYPE in model_selection_backend_outputs.py (or --storage in
+optuna_workers.py):
+
+sqlite   the original sqlite:/// file, with a longer lock timeout
+journal  Optuna's journal file storage: workers append to a log file,
+         without a database lock (recommended for local workers)
+rdb      a database server (e.g. postgresql:// or mysql://) given by its URL
+
+The studies already stored in optuna_db.sqlite3 can be copied to the new
+storage, keeping their history for the dashboard:
+python study_storage.py --to journal
+"""
+
+import argparse
+
+import optuna
+
+try:
+    from optuna.storages.journal import JournalFileBackend, JournalFileOpenLock
+except ImportError:
+    # Optuna 3.x names
+    from optuna.storages import JournalFileOpenLock
+    from optuna.storages import JournalFileStorage as JournalFileBackend
+
+SQLITE_URL = "sqlite:///../../outputs/optuna_db.sqlite3"
+JOURNAL_FILE = "../../outputs/optuna_journal.log"
+SQLITE_TIMEOUT = 60  # seconds a worker waits for the sqlite lock
+
+
+def get_storage(storage_type="sqlite", url=SQLITE_URL, journal_file=JOURNAL_FILE):
+    """Return an Optuna storage object of the given type."""
+    if storage_type == "sqlite":
+        return optuna.storages.RDBStorage(
+            url, engine_kwargs={"connect_args": {"timeout": SQLITE_TIMEOUT}}
+        )
+    elif storage_type == "journal":
+        # the open() based lock also works on Windows and NFS, unlike symlinks
+        backend = JournalFileBackend(
+            journal_file, lock_obj=JournalFileOpenLock(journal_file)
+        )
+        return optuna.storages.JournalStorage(backend)
+    elif storage_type == "rdb":
+        # a database server handles concurrent connections by itself
+        return optuna.storages.RDBStorage(url)
+    else:
+        raise Exception("Storage type must be sqlite, journal or rdb")
+
+
+def migrate_studies(from_storage, to_storage, prefix="ID_"):
+    """
+    Copy the studies whose names start with prefix, including all their
+    trials, from from_storage to to_storage. Studies already present in
+    to_storage are skipped.
+    """
+    existing_names = optuna.study.get_all_study_names(storage=to_storage)
+    for study_name in optuna.study.get_all_study_names(storage=from_storage):
+        if not study_name.startswith(prefix):
+            continue
+        if study_name in existing_names:
+            print("Skipping", study_name, "(already in the destination storage)")
+            continue
+        optuna.copy_study(
+            from_study_name=study_name,
+            from_storage=from_storage,
+            to_storage=to_storage,
+        )
+        print("Copied study", study_name)
+
+
+if __name__ == "__main__":
+    print("=====================================")
+    print("Copy Optuna studies to another storage")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--to",
+        type=str,
+        default="journal",
+        help="Destination storage type: journal or rdb",
+    )
+    parser.add_argument(
+        "--from_url", type=str, default=SQLITE_URL, help="Source sqlite database"
+    )
+    parser.add_argument(
+        "--to_url",
+        type=str,
+        default="",
+        help="Destination database URL when using --to rdb",
+    )
+    parser.add_argument(
+        "--journal_file",
+        type=str,
+        default=JOURNAL_FILE,
+        help="Destination journal file when using --to journal",
+    )
+    parser.add_argument(
+        "--prefix", type=str, default="ID_", help="Copy only studies with this prefix"
+    )
+    args = parser.parse_args()
+    if args.to == "rdb" and args.to_url == "":
+        parser.error("--to rdb needs the destination database URL in --to_url")
+
+    from_storage = get_storage("sqlite", url=args.from_url)
+    to_storage = get_storage(args.to, url=args.to_url, journal_file=args.journal_file)
+    migrate_studies(from_storage, to_storage, prefix=args.prefix)
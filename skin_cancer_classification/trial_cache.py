@@ -0,0 +1,58 @@
+"""
+Memoization of the results of duplicate hyperparameter configurations.
+
+Most of the search space of model_selection_backend_outputs.py is categorical
+or small integers, so TPE often proposes a configuration that was already
+trained, in particular in long studies and when an existing study is
+continued. Each trial stores in its user attributes a canonical hash of its
+parameters, the dataset fingerprint and the training settings
+("config_hash"). get_cached_value() looks for complete trials with the same
+hash in the study (also the ones run by other workers): once the
+configuration was trained max_repeats times, the trial returns the mean of
+their values without training, and is marked with the user attribute
+"memoized_from". max_repeats > 1 averages out the noise of training.
+"""
+
+import hashlib
+import json
+
+import numpy as np
+import optuna
+
+
+def get_config_hash(params, fingerprint, settings=None):
+    """Hash of the parameters of a trial, independent of their order."""
+    config = {"params": params, "fingerprint": fingerprint, "settings": settings}
+    text = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def get_cached_value(trial, fingerprint, settings=None, max_repeats=1):
+    """
+    Call after all the parameters of trial were suggested. Returns the mean
+    value of the earlier trainings of the same configuration, or None if it
+    was trained less than max_repeats times.
+    """
+    config_hash = get_config_hash(trial.params, fingerprint, settings)
+    trial.set_user_attr("config_hash", config_hash)
+    trained = [
+        other
+        for other in trial.study.get_trials(
+            deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)
+        )
+        if other.user_attrs.get("config_hash") == config_hash
+        and "memoized_from" not in other.user_attrs
+    ]
+    if len(trained) < max_repeats:
+        return None
+    trial.set_user_attr("memoized_from", [other.number for other in trained])
+    value = float(np.mean([other.value for other in trained]))
+    print(
+        "Trial",
+        trial.number,
+        "repeats the configuration of trials",
+        [other.number for other in trained],
+        "with mean value",
+        value,
+    )
+    return value